@@ -1,10 +1,73 @@
 #!/usr/bin/python
 
+# Report on where the time went in a pipeline run, using the timeline
+# of per-step records (timeline.jsonl) written by run()/run_log. For
+# runs that predate the timeline, fall back to estimating durations
+# from the timestamps in the log files.
+
 from datetime import datetime
 import glob
 import os
+import sys
+import json
 import numpy as np
-import matplotlib.pyplot as plt
+
+def read_timeline(filename):
+    records=[]
+    for l in open(filename).readlines():
+        try:
+            records.append(json.loads(l))
+        except ValueError:
+            print 'Skipping bad timeline line',l
+    return records
+
+def category(step):
+    # log names are of the form Program-details, e.g. DDF-image_full_low
+    # or KillMS-<ms>_DDS3_full
+    if '-' in step:
+        return step.split('-')[0]
+    return step
+
+def fmt_bytes(b):
+    if b is None:
+        return '-'
+    for unit in ['B','K','M','G','T']:
+        if abs(b)<1024.0:
+            return '%.1f%s' % (b,unit)
+        b/=1024.0
+    return '%.1fP' % b
+
+def report_timeline(records):
+    if len(records)==0:
+        # e.g. the pipeline died before the first step finished
+        print 'No steps recorded in the timeline'
+        return []
+    print '%-60s %-19s %9s %9s %5s %8s %8s %8s %4s' % ('Step','Start','Wall(s)','CPU(s)','Util','MaxRSS','Read','Written','Ret')
+    print '-'*140
+    for r in sorted(records,key=lambda r:r['start']):
+        cpu=r['utime']+r['stime']
+        util=cpu/r['elapsed'] if r['elapsed']>0 else 0
+        print '%-60s %-19s %9.0f %9.0f %5.1f %8s %8s %8s %4i' % (r['step'][:60],r['start_time'],r['elapsed'],cpu,util,fmt_bytes(r['maxrss_kb']*1024),fmt_bytes(r['read_bytes']),fmt_bytes(r['write_bytes']),r['retval'])
+
+    sums={}
+    for r in records:
+        c=category(r['step'])
+        wall,cpu,n=sums.get(c,(0,0,0))
+        sums[c]=(wall+r['elapsed'],cpu+r['utime']+r['stime'],n+1)
+
+    print '\n------------------------------------------------------------\nOperation                  Count   Wall(s)    CPU(s)  Util\n------------------------------------------------------------'
+    for c in sorted(sums,key=lambda c:-sums[c][0]):
+        wall,cpu,n=sums[c]
+        print "%-25s %6i %9.0f %9.0f %5.1f" % (c,n,wall,cpu,cpu/wall if wall>0 else 0)
+
+    tt=np.sum([s[0] for s in sums.values()])
+    span=max(r['end'] for r in records)-min(r['start'] for r in records)
+    print '------------------------------------------------------------\n\nTotal step time %.0f seconds -- %.2f days' % (tt,tt/86400.0)
+    print 'Elapsed from first step start to last step end %.0f seconds -- %.2f days' % (span,span/86400.0)
+    failed=[r for r in records if r['retval']!=0]
+    if failed:
+        print '%i steps returned non-zero values, last was %s' % (len(failed),failed[-1]['step'])
+    return [(c,sums[c][0]) for c in sums]
 
 def get_time_range(file):
     lines=open(file).readlines()
@@ -12,47 +75,69 @@ def get_time_range(file):
     end=datetime.strptime(lines[-2][:19], '%Y-%m-%d %H:%M:%S')
     return (end-start).total_seconds()
 
-os.chdir('logs')
-g=glob.glob('*')
-times=[]
-for f in g:
-    dt=get_time_range(f)
-    times.append(dt)
-
-labels=['Miscellaneous','Dynspec','Clipcal','Shift','Wide-field KillMS','KillMS phase 60sb','KillMS amp/phase 60sb', 'KillMS amp/phase full', 'KillMS amp/phase full 2', 'Wide-field DDF dirin', 'Predict wide-field', 'DDF dirin', 'DDF phase 60sb', 'DDF amp-phase 60sb', 'DDF band images','DDF full', 'DDF full 2', 'DDF full low QU','DDF full vlow QU','DDF full low V','DDF full low', 'DDF bootstrap', 'DDF bootstrap single-band','KillMS DIS0','KillMS DDS0','KillMS DIS1','KillMS DDS1','KillMS DIS2','KillMS DDS2','KillMS DDS3','DDF full DI','DDF predict']
-fragments=['***','dynspec','ClipCal','shift','wide_killms_p1','killms_p1','killms_ap1','killms_f_ap1','killms_f_ap2','wide_image_dirin', 'wide_image_phase1_predict', 'image_dirin','image_phase1','image_ampphase1','NS_Band','image_full_ampphase1','image_full_ampphase2', 'image_full_low_QU', 'image_full_vlow_QU', 'image_full_low_stokesV','image_full_low','image_bootstrap','image_low','_DIS0','_DDS0','_DIS1','_DDS1','_DIS2','_DDS2','_DDS3','image_full_ampphase_di','DDF-Predict']
-sums=np.zeros(len(labels))
-print len(labels),len(fragments)
-
-# classify each file
-for j,f in enumerate(g):
-    label=0
+def report_logs(logdir):
+    g=glob.glob(logdir+'/*')
+    times=[]
+    for f in g:
+        dt=get_time_range(f)
+        times.append(dt)
+
+    labels=['Miscellaneous','Dynspec','Clipcal','Shift','Wide-field KillMS','KillMS phase 60sb','KillMS amp/phase 60sb', 'KillMS amp/phase full', 'KillMS amp/phase full 2', 'Wide-field DDF dirin', 'Predict wide-field', 'DDF dirin', 'DDF phase 60sb', 'DDF amp-phase 60sb', 'DDF band images','DDF full', 'DDF full 2', 'DDF full low QU','DDF full vlow QU','DDF full low V','DDF full low', 'DDF bootstrap', 'DDF bootstrap single-band','KillMS DIS0','KillMS DDS0','KillMS DIS1','KillMS DDS1','KillMS DIS2','KillMS DDS2','KillMS DDS3','DDF full DI','DDF predict']
+    fragments=['***','dynspec','ClipCal','shift','wide_killms_p1','killms_p1','killms_ap1','killms_f_ap1','killms_f_ap2','wide_image_dirin', 'wide_image_phase1_predict', 'image_dirin','image_phase1','image_ampphase1','NS_Band','image_full_ampphase1','image_full_ampphase2', 'image_full_low_QU', 'image_full_vlow_QU', 'image_full_low_stokesV','image_full_low','image_bootstrap','image_low','_DIS0','_DDS0','_DIS1','_DDS1','_DIS2','_DDS2','_DDS3','image_full_ampphase_di','DDF-Predict']
+    sums=np.zeros(len(labels))
+    print len(labels),len(fragments)
+
+    # classify each file
+    for j,f in enumerate(g):
+        label=0
+        for i in range(len(labels)):
+            if fragments[i] in f:
+                label=i
+                break
+
+        print f,times[j],labels[label],fragments[label]
+        sums[label]+=times[j]
+
+    print '------\n'
+
+    result=[]
+    print '---------------------------------\nOperation                 Time(s)\n---------------------------------'
     for i in range(len(labels)):
-        if fragments[i] in f:
-            label=i
-            break
-    
-    print f,times[j],labels[label],fragments[label]
-    sums[label]+=times[j]
-
-print '------\n'
-
-pl=[]
-ps=[]
-print '---------------------------------\nOperation                 Time(s)\n---------------------------------'
-for i in range(len(labels)):
-    if sums[i]:
-        print "%-25s %7.0f" % (labels[i],sums[i])
-        pl.append(labels[i])
-        ps.append(sums[i])
-
-tt=np.sum(sums)
-print '---------------------------------\n\nTotal time %.0f seconds -- %.2f days' % (tt,tt/86400.0)
-
-cmap = plt.cm.spectral
-colors = cmap(np.linspace(0.1, 1., len(pl)))
-
-fig1, ax1 = plt.subplots()
-ax1.pie(ps,labels=pl,autopct='%1.1f%%',colors=colors)
-ax1.axis('equal')
-plt.show()
+        if sums[i]:
+            print "%-25s %7.0f" % (labels[i],sums[i])
+            result.append((labels[i],sums[i]))
+
+    tt=np.sum(sums)
+    print '---------------------------------\n\nTotal time %.0f seconds -- %.2f days' % (tt,tt/86400.0)
+    return result
+
+def plot_pie(result):
+    import matplotlib.pyplot as plt
+    pl=[r[0] for r in result]
+    ps=[r[1] for r in result]
+    cmap = plt.cm.spectral
+    colors = cmap(np.linspace(0.1, 1., len(pl)))
+
+    fig1, ax1 = plt.subplots()
+    ax1.pie(ps,labels=pl,autopct='%1.1f%%',colors=colors)
+    ax1.axis('equal')
+    plt.show()
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Report on the time taken by the steps of a pipeline run')
+    parser.add_argument('--timeline', default='timeline.jsonl', help='Timeline file written by the pipeline')
+    parser.add_argument('--logdir', default='logs', help='Log directory to use if there is no timeline')
+    parser.add_argument('--noplot', action='store_true', help='Do not plot a pie chart')
+    args = parser.parse_args()
+
+    records=[]
+    if os.path.isfile(args.timeline):
+        records=read_timeline(args.timeline)
+    if len(records)>0:
+        result=report_timeline(records)
+    else:
+        print 'No timeline records in',args.timeline,'found, estimating times from the logs'
+        result=report_logs(args.logdir)
+    if not args.noplot and len(result)>0:
+        plot_pie(result)
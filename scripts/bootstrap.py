@@ -14,6 +14,7 @@ import pyrap.tables as pt
 import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline
 from pipeline import ddf_image,make_external_mask
+from ms_metadata import get_metadata
 import shutil
 from astropy.io import fits
 
@@ -141,9 +142,7 @@ def run_bootstrap(o):
         if os.path.isfile(obsid+'crossmatch-1.fits'):
             warn('Crossmatch table exists, skipping crossmatch')
         else:
-            t = pt.table(omslist[0]+ '/FIELD', readonly=True, ack=False)
-            direction = t[0]['PHASE_DIR']
-            ra, dec = direction[0]
+            ra, dec = m.metadata[m.mss.index(omslist[0])]['phase_dir']
 
             if (ra<0):
                 ra+=2*np.pi
@@ -165,7 +164,7 @@ def run_bootstrap(o):
         if os.path.isfile(obsid+'crossmatch-results-1.npy'):
             warn('Results 1 exists, skipping first fit')
         else:
-            fitting_factors.run_all(1, name=obsid)
+            fitting_factors.run_all(1, name=obsid, ncpu=o['NCPU_DDF'])
 
         nreject=-1 # avoid error if we fail somewhere
         if os.path.isfile(obsid+'crossmatch-2.fits'):
@@ -181,7 +180,7 @@ def run_bootstrap(o):
         if os.path.isfile(obsid+'crossmatch-results-2.npy'):
             warn('Results 2 exists, skipping first fit')
         else:
-            fitting_factors.run_all(2, name=obsid)
+            fitting_factors.run_all(2, name=obsid, ncpu=o['NCPU_DDF'])
 
         # Now apply corrections
 
@@ -197,19 +196,12 @@ def run_bootstrap(o):
             bigmslist=[s.strip() for s in open(o['full_mslist']).readlines()]
             obigmslist = [ms for ms in bigmslist if obsid in ms]
             
-            for ms in obigmslist:
-                t = pt.table(ms)
-                try:
-                    dummy=t.getcoldesc('SCALED_DATA')
-                except RuntimeError:
-                    dummy=None
-                t.close()
-                if dummy is not None:
+            for ms,meta in zip(obigmslist,get_metadata(obigmslist)):
+                if 'SCALED_DATA' in meta['colnames']:
                     warn('Table '+ms+' has already been corrected, skipping')
                 else:
                     # in this version we need to scale both the original data and the data in colname
-                    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-                    frq=t[0]['REF_FREQUENCY']
+                    frq=meta['ref_frequency']
                     factor=spl(frq)
                     print frq,factor
                     t=pt.table(ms,readonly=False)
@@ -219,11 +211,7 @@ def run_bootstrap(o):
                     d=t.getcol(o['colname'])
                     d*=factor
                     t.putcol('SCALED_DATA',d)
-                    try:
-                        dummy=t.getcoldesc(colname)
-                    except RuntimeError:
-                        dummy=None
-                    if dummy is not None:
+                    if colname in meta['colnames']:
                         desc=t.getcoldesc(colname)
                         newname=colname+'_SCALED'
                         desc['name']=newname
@@ -1,6 +1,6 @@
 import numpy as np
 from pipeline import ddf_image,ddf_shift
-from pyrap.tables import table
+from ms_metadata import get_metadata,chan_freq
 
 def do_spectral_restored(colname,
                          CurrentMaskName,
@@ -21,7 +21,7 @@ def do_spectral_restored(colname,
     filenames=[l.strip() for l in open(mslist,'r').readlines()]
 
     
-    fMS=[table("%s::SPECTRAL_WINDOW"%MSName,ack=False).getcol("CHAN_FREQ").mean() for MSName in filenames]
+    fMS=[chan_freq(meta).mean() for meta in get_metadata(filenames)]
     
     # f0=np.mean(fMS[0:9])/1e6
     # f1=np.mean(fMS[9:17])/1e6
@@ -3,32 +3,65 @@
 
 import os
 import glob
+from multiprocessing import Pool
 import pyrap.tables as pt
 import numpy as np
 from auxcodes import warn
 from surveys_db import use_database,update_status
+from ms_metadata import get_metadata,update_metadata
 
-def check_flagged(ms):
-    t = pt.table(ms, readonly=True)
-    tc = t.getcol('FLAG').flatten()
-    return float(np.sum(tc))/len(tc)
+def check_flagged(ms,blockrows=100000):
+    # count flags a block of rows at a time so that the whole FLAG
+    # column never has to be held in memory
+    t = pt.table(ms, readonly=True, ack=False)
+    nrows=t.nrows()
+    flagged=0
+    total=0
+    for start in range(0,nrows,blockrows):
+        tc = t.getcol('FLAG',start,min(blockrows,nrows-start))
+        flagged+=np.count_nonzero(tc)
+        total+=tc.size
+    t.close()
+    return float(flagged)/total
 
-def get_timerange(ms):
-    t = pt.table(ms +'/OBSERVATION', readonly=True, ack=False)
-    return t.getcell('TIME_RANGE',0)
+def check_flagged_mslist(mss,jobs=8,workdir='.',metadata=None):
+    """
+    Return the flagged fraction of each MS in mss. Values already in
+    the MS metadata cache are used; the other MSs are scanned in
+    parallel and their values recorded in the cache
+    """
+    if metadata is None:
+        metadata=get_metadata(mss,jobs=jobs,workdir=workdir)
+    todo=[ms for ms,meta in zip(mss,metadata) if meta is None or meta.get('flagfrac') is None]
+    jobs=max(1,min(jobs,len(todo)))
+    if jobs==1:
+        found=[check_flagged(ms) for ms in todo]
+    else:
+        pool=Pool(jobs)
+        try:
+            found=pool.map(check_flagged,todo)
+        finally:
+            pool.close()
+            pool.join()
+    found=dict(zip(todo,found))
+    if found:
+        update_metadata(dict((ms,{'flagfrac':ff}) for ms,ff in found.items()),workdir=workdir)
+    return [found[ms] if ms in found else meta['flagfrac'] for ms,meta in zip(mss,metadata)]
 
-def make_list(workdir='.',force=False):
+def make_list(workdir='.',force=False,jobs=8):
     g=sorted(glob.glob(workdir+'/*.ms'))
+    metadata=get_metadata(g,jobs=jobs,workdir=workdir)
+    flagfracs=check_flagged_mslist(g,jobs=jobs,workdir=workdir,metadata=metadata)
     full_mslist=[]
     start_times=[]
-    for ms in g:
-        ff=check_flagged(ms)
-        t0,t1=get_timerange(ms)
+    for ms,meta,ff in zip(g,metadata,flagfracs):
+        t0,t1=meta['time_range']
         print ms,ff
         if ff<0.8:
             full_mslist.append(os.path.basename(ms))
             start_times.append(t0)
     full_mslist = np.array(full_mslist)
+    start_times = np.array(start_times)
             
     # check for multiple observations
     Ustart_times = np.unique(start_times)
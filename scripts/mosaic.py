@@ -6,8 +6,9 @@
 
 from pipeline_version import version
 from reproject import reproject_interp,reproject_exact
-from reproj_test import reproject_interp_chunk_2d
-from auxcodes import die, get_rms, flatten
+from reproj_test import reproject_interp_chunk_2d_multi
+from auxcodes import die, flatten
+from noise import get_rms
 import sys
 from astropy.io import fits
 from astropy.table import Table
@@ -31,10 +32,12 @@ def make_mosaic(args):
     else:
         rootname=''
 
-    if args.exact:
-        reproj=reproject_exact
-    else:
-        reproj=reproject_interp_chunk_2d
+    def reproj(images,header):
+        # reproject a list of images onto header, returning just the
+        # arrays: the footprints are never used here
+        if args.exact:
+            return [reproject_exact(h,header,hdu_in=0,parallel=False)[0] for h in images]
+        return reproject_interp_chunk_2d_multi(images,header,hdu_in=0,ncpu=args.ncpu,return_footprint=False)
 
     if args.do_lowres:
         intname='image_full_low_m.int.restored.fits'
@@ -231,31 +234,39 @@ def make_mosaic(args):
     print 'now making the mosaic'
     for i in range(len(hdus)):
         print 'image',i,'(',name[i],')'
-        outname=rootname+'reproject-'+name[i]+'.fits'
-        if args.load and os.path.exists(outname):
+        rname=rootname+'reproject-'+name[i]+'.fits'
+        wname=rootname+'weight-'+name[i]+'.fits'
+        r=w=None
+        if not args.exact and not(args.load and (os.path.exists(rname) or os.path.exists(wname))):
+            # image and weights are on the same grid, so reproject
+            # them together
+            print 'reprojecting image and weights...'
+            r,w = reproj([hdus[i],app[i]], header)
+        if args.load and os.path.exists(rname):
             print 'loading...'
-            hdu=fits.open(outname)
+            hdu=fits.open(rname)
             r=hdu[0].data
         else:
-            print 'reprojecting...'
-            r, footprint = reproj(hdus[i], header, hdu_in=0, parallel=False)
+            if r is None:
+                print 'reprojecting...'
+                r, = reproj([hdus[i]], header)
             r[np.isnan(r)]=0
             hdu = fits.PrimaryHDU(header=header,data=r)
-            if args.save: hdu.writeto(outname,clobber=True)
+            if args.save: hdu.writeto(rname,clobber=True)
         print 'weights',i,'(',name[i],')'
-        outname=rootname+'weight-'+name[i]+'.fits'
-        if args.load and os.path.exists(outname):
+        if args.load and os.path.exists(wname):
             print 'loading...'
-            hdu=fits.open(outname)
+            hdu=fits.open(wname)
             w=hdu[0].data
             mask|=(w>0)
         else:
-            print 'reprojecting...'
-            w, footprint = reproj(app[i], header, hdu_in=0, parallel=False)
+            if w is None:
+                print 'reprojecting...'
+                w, = reproj([app[i]], header)
             mask|=~np.isnan(w)
             w[np.isnan(w)]=0
             hdu = fits.PrimaryHDU(header=header,data=w)
-            if args.save: hdu.writeto(outname,clobber=True)
+            if args.save: hdu.writeto(wname,clobber=True)
         print 'add to mosaic...'
         if args.scale is not None:
             print 'Applying scale %s to %s'%(args.scale[i],name[i])
@@ -286,6 +297,7 @@ if __name__=='__main__':
     parser.add_argument('--rootname', dest='rootname', default='', help='Root name for output files, default uses no prefix')
     parser.add_argument('--beamcut', dest='beamcut', default=0.3, help='Beam level to cut at')
     parser.add_argument('--exact', dest='exact', action='store_true', help='Do exact reprojection (slow)')
+    parser.add_argument('--ncpu', dest='ncpu', type=int, help='Number of processes for reprojection, default all the CPUs')
     parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate images')
     parser.add_argument('--load', dest='load', action='store_true', help='Load existing intermediate images')
     parser.add_argument('--noise', dest='noise', type=float, nargs='+', help='UNSCALED Central noise level for weighting: must match numbers of maps')
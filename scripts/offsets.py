@@ -17,13 +17,15 @@ from quality_pipeline import sepn
 import requests
 import os
 from get_cat import get_cat
-import glob
-from astropy.table import Table, vstack, unique
+from catstore import column_names,update_store,merge_store
+from astropy.table import Table
 import numpy as np
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
 import sys
 from scipy.special import gammaln
-from facet_offsets import RegPoly
+from facet_offsets import RegPoly,facet_label_image
+from crossmatch_utils import radec_to_xyz,candidate_pairs
 from astropy.io import fits
 from astropy.wcs import WCS
 import pickle
@@ -38,14 +40,39 @@ import sys
 def model(x,norm,sigma,offset,bl,radius=60):
     return bl*np.sqrt(radius**2.0-x**2.0)/radius+norm*np.exp(-(x-offset)**2.0/(2*sigma**2.0))
 
+class WalkerMap(object):
+    # emcee evaluates the walkers with pool.map(lnpostfn,positions) if
+    # given a pool; this does it with one vectorised call instead
+    def __init__(self,fn):
+        self.fn=fn
+    def map(self,f,positions):
+        return list(self.fn(np.array(list(positions))))
+
+def fit_histogram(args):
+    # Pool worker for Offsets.fit_offsets: fit one histogram, returning
+    # the parameters, their errors and the list of chains made
+    fitmethod,bcenter,h,vectorize,seed=args
+    np.random.seed(seed)
+    oo=Offsets(None,fitmethod=fitmethod,vectorize=vectorize)
+    oo.bcenter=bcenter
+    if fitmethod=='mcmc':
+        p,perr=oo.fit_emcee(h)
+    else:
+        p,perr=oo.fit_chi2(h)
+    return p,perr,oo.chains
+
 class Offsets(object):
-    def __init__(self,prefix,n=45,cellsize=1.5,imroot=None,fitmethod='mcmc'):
+    def __init__(self,prefix,n=45,cellsize=1.5,imroot=None,fitmethod='mcmc',ncpu=1,vectorize=True):
+        # ncpu is the number of histograms to fit at once; vectorize
+        # evaluates the likelihood for all walkers in one call
         self.prefix=prefix
         self.n=n
         self.chains=[]
         self.cellsize=cellsize
         self.imroot=imroot
         self.fitmethod=fitmethod
+        self.ncpu=ncpu
+        self.vectorize=vectorize
         if imroot is not None:
             self.read_regfile(imroot+'.tessel.reg')
 
@@ -58,6 +85,52 @@ class Offsets(object):
         self.pli=self.r.plab_int
 
     def find_offsets(self,tf,ot,sep=1.0):
+        # offsets in arcsec of all comparison sources within sep arcmin
+        # of each LOFAR source, per facet, using one tree of the
+        # comparison catalogue for all the facets
+        self.dral=[]
+        self.ddecl=[]
+        self.lofar_table=tf
+        ora=np.array(ot['ra'])
+        odec=np.array(ot['dec'])
+        tree=cKDTree(radec_to_xyz(ora,odec))
+        for f in range(self.n):
+            t=tf[tf['Facet']==f]
+            if len(t)==0:
+                print 'No sources in facet',f
+                self.dral.append(None)
+                self.ddecl.append(None)
+                continue
+            ra=np.array(t['RA'])
+            dec=np.array(t['DEC'])
+            minra=np.min(ra)
+            maxra=np.max(ra)
+            mindec=np.min(dec)
+            maxdec=np.max(dec)
+            inbox=((ora>=(minra-sep/60.0)) & (ora<=(maxra+sep/60.0)) &
+                   (odec>=(mindec-sep/60.0)) & (odec<=(maxdec+sep/60.0)))
+            print 'Facet %2i has %4i LOFAR sources and %6i comparison sources' % (f,len(t),np.sum(inbox))
+
+            # a pair within sep with the flat metric below is separated
+            # on the sky by at most sep*sqrt(1+sep/cos(dec)) (sep in
+            # radians), so search only slightly further than sep
+            srad=sep/60.0*degtorad
+            margin=1.001*np.sqrt(1+srad/np.cos(np.max(np.abs(dec))*degtorad))
+            oi,li=candidate_pairs(ora,odec,ra,dec,sep*60.0,tree1=tree,margin=margin)
+            keep=inbox[oi]
+            oi=oi[keep]
+            li=li[keep]
+            dra=3600.0*(ra[li]-ora[oi])*np.cos(dec[li]*np.pi/180.0)
+            ddec=3600.0*(dec[li]-odec[oi])
+            d2dmask=np.sqrt(dra**2.0+ddec**2.0)<sep*60.0
+            # same order as looping over the LOFAR sources
+            order=np.lexsort((oi[d2dmask],li[d2dmask]))
+
+            self.dral.append(dra[d2dmask][order])
+            self.ddecl.append(ddec[d2dmask][order])
+
+    def find_offsets_loop(self,tf,ot,sep=1.0):
+        # the original version, kept for comparison
         self.dral=[]
         self.ddecl=[]
         self.lofar_table=tf
@@ -124,6 +197,18 @@ class Offsets(object):
     def lnpost(self,parms,h):
         return self.lnprior(parms)+self.lnlike(parms,h)
 
+    def lnpost_walkers(self,X,h):
+        # lnpost for an array of parameters, one row per walker
+        X=np.asarray(X)
+        good=(X[:,0]>=0) & (X[:,3]>=0) & (X[:,1]>=0) & (X[:,1]<=5) & (np.abs(X[:,2])<=5)
+        result=-np.inf*np.ones(len(X))
+        if np.any(good):
+            Xg=X[good]
+            mv=model(self.bcenter[None,:],*[Xg[:,i,None] for i in range(4)])
+            lv=h*np.log(mv)-mv-gammaln(h+1)
+            result[good]=np.sum(lv,axis=1)
+        return result
+
     def lnprior(self,X):
         # gaussian norm, sigma, offset; baseline norm
         if X[0]<0 or X[3]<0 or X[1]<0:
@@ -150,7 +235,11 @@ class Offsets(object):
         parms=np.array(parms)
         for i in (0,1,3):
             parms[:,i]=np.abs(parms[:,i])
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, self.lnpost, args=(h,))
+        if self.vectorize:
+            pool=WalkerMap(lambda X: self.lnpost_walkers(X,h))
+        else:
+            pool=None
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, self.lnpost, args=(h,), pool=pool)
         
         sampler.run_mcmc(parms,1000)
         chain=sampler.chain
@@ -176,11 +265,7 @@ class Offsets(object):
         return means,err
 
     def fit_offsets(self,minv=-40,maxv=40,nbins=150):
-        if self.fitmethod=='mcmc':
-            fitfn=self.fit_emcee
-        elif self.fitmethod=='chi2':
-            fitfn=self.fit_chi2
-        else:
+        if self.fitmethod not in ['mcmc','chi2']:
             raise NotImplementedError('Fit method '+self.fitmethod)
         self.bins=np.linspace(minv,maxv,nbins+1)
         self.bcenter=0.5*(self.bins[:-1]+self.bins[1:])
@@ -190,6 +275,29 @@ class Offsets(object):
         self.dece=[]
         self.rah=[]
         self.dech=[]
+        # the RA and DEC histograms of each facet are independent, so
+        # fit them all at once, ncpu at a time
+        for i in range(self.n):
+            if self.dral[i] is not None:
+                h,_=np.histogram(self.dral[i],self.bins)
+                self.rah.append(h)
+                h,_=np.histogram(self.ddecl[i],self.bins)
+                self.dech.append(h)
+        hists=[h for pair in zip(self.rah,self.dech) for h in pair]
+        seeds=np.random.randint(0,2**31-1,len(hists))
+        args=[(self.fitmethod,self.bcenter,h,self.vectorize,seed) for h,seed in zip(hists,seeds)]
+        if self.ncpu>1 and len(args)>1:
+            from multiprocessing import Pool
+            pool=Pool(min(self.ncpu,len(args)))
+            try:
+                results=pool.map(fit_histogram,args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results=map(fit_histogram,args)
+        # gather the results in facet order
+        results=iter(results)
         for i in range(self.n):
             print 'Facet',i
             if self.dral[i] is None:
@@ -198,19 +306,16 @@ class Offsets(object):
                 self.rae.append([100,100,100,100])
                 self.decr.append([0,0,0,0])
                 self.dece.append([100,100,100,100])
-                pass
             else:
-                h,_=np.histogram(self.dral[i],self.bins)
-                self.rah.append(h)
-                p,perr=fitfn(h)
+                p,perr,chains=next(results)
                 print 'RA Offset is ',p[2],'+/-',perr[2]
                 self.rar.append(p)
                 self.rae.append(perr)
-                h,_=np.histogram(self.ddecl[i],self.bins)
-                self.dech.append(h)
-                p,perr=fitfn(h)
+                self.chains+=chains
+                p,perr,chains=next(results)
                 self.decr.append(p)
                 self.dece.append(perr)
+                self.chains+=chains
                 print 'DEC Offset is ',p[2],'+/-',perr[2]
         self.rar=np.array(self.rar)
         self.rae=np.array(self.rae)
@@ -327,22 +432,15 @@ class Offsets(object):
         hdus[0].header['CDELT2']*=factor
         hdus[0].header['CRPIX1']/=factor
         hdus[0].header['CRPIX2']/=factor
-        w=WCS(hdus[0].header)
+        hdus[0].header['NAXIS1']=xd
+        hdus[0].header['NAXIS2']=yd
         rmap=np.ones((1,1,yd,xd))*np.nan
-        # this would be faster with use of e.g. PIL
-        for y in range(yd):
-            print '.',
-            sys.stdout.flush()
-            xv=np.array(range(xd))
-            yv=y*np.ones_like(xv)
-            ra,dec,_,_=w.wcs_pix2world(xv,yv,0,0,0)
-            dra,ddec=self.r.coordconv(ra,dec)[1]
-            for i,x in enumerate(xv):
-                number=self.r.which_poly(dra[i],ddec[i],convert=False)
-                if number is not None:
-                    direction=self.pli[number]
-                    rmap[0,0,y,x]=np.sqrt(self.rae[direction,2]**2.0+self.dece[direction,2]**2.0)
-        print
+        # polygon number of each pixel of the reduced grid
+        labels=facet_label_image(self.r.inreg,hdus[0].header,self.r.cra,self.r.cdec)
+        direction=np.array(self.pli)
+        errors=np.sqrt(self.rae[direction,2]**2.0+self.dece[direction,2]**2.0)
+        inside=labels>=0
+        rmap[0,0][inside]=errors[labels[inside]]
         hdus[0].data=rmap
         hdus.writeto(outname,clobber=True)
 
@@ -357,21 +455,10 @@ class Offsets(object):
             return pickle.load(f)
 
 def merge_cat(rootname,rastr='ra',decstr='dec'):
-    g=glob.glob(rootname+'/*.vo')
-    tlist=[]
-    for f in g:
-        try:
-            t=Table.read(f)
-        except:
-            print 'Error reading table',f
-            raise
-        t2=Table()
-        t2['ra']=t[rastr]
-        t2['dec']=t[decstr]
-        tlist.append(t2)
-
-    t=vstack(tlist)
-    t2=unique(t,keys=['ra','dec'])
+    # merge the tiles in the catalogue store, adding any that get_cat
+    # didn't
+    update_store(rootname,rastr,decstr)
+    t2=merge_store(rootname)
     t2.write(rootname+'.fits',overwrite=True)
     return t2
 
@@ -391,17 +478,8 @@ def do_offsets(o):
         warn('Merged file exists, reading from disk instead')
         data=Table.read(method+'.fits')
     else:
-        if method=='pslocal':
-            data=Table.read(method+'/'+method+'.txt',format='ascii')
-            data['RA'].name='ra'
-            data['DEC'].name='dec'
-            data.write(method+'.fits')
-        else:    
-            kwargs={}
-            if 'panstarrs' in method:
-                kwargs['rastr']='ramean'
-                kwargs['decstr']='decmean'
-            data=merge_cat(method,**kwargs)
+        rastr,decstr=column_names(method)
+        data=merge_cat(method,rastr=rastr,decstr=decstr)
 
     if o['mode']=='test':
         image_root+='_shift'
@@ -435,7 +513,7 @@ def do_offsets(o):
     report('Set up structure')
 
     NDir=np.load("image_dirin_SSD_m.npy.ClusterCat.npy").shape[0]
-    oo=Offsets(method,n=NDir,imroot=image_root,cellsize=o['cellsize'],fitmethod=o['fit'])
+    oo=Offsets(method,n=NDir,imroot=image_root,cellsize=o['cellsize'],fitmethod=o['fit'],ncpu=o['NCPU_DDF'],vectorize=o['vectorize'])
     report('Label table')
     lofar_l=oo.r.add_facet_labels(lofar)
     report('Finding offsets')
@@ -452,8 +530,44 @@ def do_offsets(o):
         oo.make_astrometry_map('astromap.fits',20)
         oo.offsets_to_facetshift('facet-offset.txt')
 
+def benchmark(nlofar=3000,density=1e5,size=2.0,nfacets=9,sep=1.0):
+    # compare find_offsets with the original loop on a synthetic
+    # comparison catalogue of density sources per square degree (about
+    # the PanSTARRS density) covering size x size degrees
+    import time
+    cra,cdec=180.0,55.0
+    cosd=np.cos(cdec*degtorad)
+    nopt=int(density*size*size)
+    ot=Table()
+    ot['ra']=cra+np.random.uniform(-size/2,size/2,nopt)/cosd
+    ot['dec']=cdec+np.random.uniform(-size/2,size/2,nopt)
+    # LOFAR sources, some with a small offset from a comparison source
+    tf=Table()
+    tf['RA']=cra+np.random.uniform(-size/2,size/2,nlofar)/cosd
+    tf['DEC']=cdec+np.random.uniform(-size/2,size/2,nlofar)
+    idx=np.random.randint(0,nopt,nlofar/2)
+    tf['RA'][:nlofar/2]=ot['ra'][idx]+(0.5+np.random.normal(0,0.3,nlofar/2))/3600.0/cosd
+    tf['DEC'][:nlofar/2]=ot['dec'][idx]+(-0.3+np.random.normal(0,0.3,nlofar/2))/3600.0
+    # square facets
+    nside=int(np.sqrt(nfacets))
+    fx=np.clip(((tf['RA']-cra)*cosd/size+0.5)*nside,0,nside-1).astype(int)
+    fy=np.clip(((tf['DEC']-cdec)/size+0.5)*nside,0,nside-1).astype(int)
+    tf['Facet']=fx+nside*fy
+    o1=Offsets('benchmark',n=nside*nside)
+    o2=Offsets('benchmark',n=nside*nside)
+    t0=time.time()
+    o1.find_offsets(tf,ot,sep=sep)
+    t1=time.time()
+    o2.find_offsets_loop(tf,ot,sep=sep)
+    t2=time.time()
+    same=all(np.array_equal(a,b) for a,b in zip(o1.dral+o1.ddecl,o2.dral+o2.ddecl))
+    print '%i LOFAR and %i comparison sources: tree %.2f s, loop %.2f s, speedup %.1f, identical output: %s' % (nlofar,nopt,t1-t0,t2-t1,(t2-t1)/(t1-t0),same)
+
 if __name__=='__main__':
-    from options import options
-    from parset import option_list
-    o=options(sys.argv[1:],option_list)
-    do_offsets(o)
+    if len(sys.argv)>1 and sys.argv[1]=='benchmark':
+        benchmark()
+    else:
+        from options import options
+        from parset import option_list
+        o=options(sys.argv[1:],option_list)
+        do_offsets(o)
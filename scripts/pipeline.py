@@ -22,24 +22,31 @@ import sys,os
 if "PYTHONPATH_FIRST" in os.environ.keys() and int(os.environ["PYTHONPATH_FIRST"]):
     sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
 import os.path
-from auxcodes import report,run,warn,die,Catcher,dotdict,separator,MSList
+from auxcodes import report,run,warn,die,fail,Catcher,dotdict,separator,MSList
 from parset import option_list
 from options import options,print_options
 from shutil import copyfile,rmtree,move
 import glob
 import pyrap.tables as pt
-from modify_mask import modify_mask
-from make_extended_mask import make_extended_mask,merge_mask,add_manual_mask
+from make_extended_mask import make_extended_mask,compose_mask
 from histmsamp import find_uvmin,sumdico
+from solint import give_dt_dnu
+from ms_metadata import get_metadata,has_column
+from solfiles import get_solutions_timerange
 import numpy as np
 from astropy.io import fits
 from pipeline_version import version
 __version__=version()
 import datetime
 import threading
+import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from remove_bootstrap import remove_columns
 from killMS.Other import MyPickle
 from surveys_db import use_database,update_status,SurveysDB
+from scheduler import StepScheduler
+from ledger import skip_step,commit_step
 
 def summary(o):
     with open('summary.txt','w') as f:
@@ -69,10 +76,6 @@ def logfilename(s,options=None):
     else:
         return None
 
-def get_solutions_timerange(sols):
-    t = np.load(sols)['BeamTimes']
-    return np.min(t),np.max(t)
-
 def find_cache_dir(options):
     cache_dir=options['cache_dir']
 
@@ -84,6 +87,67 @@ def find_cache_dir(options):
         cache_dir='.'
     return cache_dir
 
+def run_job(s,dryrun=False,log=None,quiet=False):
+    # run() for a job under run_jobs: raise on failure, leaving the
+    # cleanup to the caller once the other running jobs have finished
+    retval=run(s,proceed=True,dryrun=dryrun,log=log,quiet=quiet)
+    if retval:
+        raise RuntimeError('FAILED to run '+s+': return value is '+str(retval))
+    return retval
+
+class catch_errors(object):
+    # wraps a job for run_jobs so that it returns (True,result) or
+    # (False,message) rather than raising; a class rather than a
+    # closure so that it can be sent to a process pool
+    def __init__(self,function):
+        self.function=function
+    def __call__(self,item):
+        try:
+            return True,self.function(item)
+        except Exception as e:
+            traceback.print_exc()
+            return False,str(e)
+
+def run_jobs(function,items,njobs,pool_class=ThreadPool,catcher=None):
+    """
+    Call function on each of items, njobs at a time. Once a job has
+    failed no more are started, and the ones already running are
+    waited for. Returns the message from the first failure, or None
+    """
+    job=catch_errors(function)
+    if njobs<=1:
+        for item in items:
+            if catcher: catcher.check()
+            ok,result=job(item)
+            if not ok:
+                return result
+        return None
+    state={'running':0,'error':None}
+    condition=threading.Condition()
+    def finished(r):
+        ok,result=r
+        with condition:
+            state['running']-=1
+            if not ok and state['error'] is None:
+                state['error']=result
+            condition.notify()
+    pool=pool_class(njobs)
+    try:
+        for item in items:
+            if catcher: catcher.check()
+            with condition:
+                # timeout keeps the main thread responsive to signals
+                while state['running']>=njobs and state['error'] is None:
+                    condition.wait(10)
+                if state['error'] is not None:
+                    break
+                state['running']+=1
+            pool.apply_async(job,(item,),callback=finished)
+    finally:
+        pool.close()
+        pool.join()
+    return state['error']
+
 def check_imaging_weight(mslist_name):
 
     # returns a boolean that says whether it did something
@@ -91,23 +155,15 @@ def check_imaging_weight(mslist_name):
     error=False
     report('Checking for IMAGING_WEIGHT in input MSS')
     mslist=[s.strip() for s in open(mslist_name).readlines()]
-    for ms in mslist:
-        try:
-            t = pt.table(ms)
-        except RuntimeError:
+    for ms,meta in zip(mslist,get_metadata(mslist)):
+        if meta is None:
             print 'Failed to open table',ms,'-- table may be missing or corrupt'
             error=True
+        elif 'IMAGING_WEIGHT' in meta['colnames']:
+            warn('Table '+ms+' already has imaging weights')
         else:
-            try:
-                dummy=t.getcoldesc('IMAGING_WEIGHT')
-            except RuntimeError:
-                dummy=None
-            t.close()
-            if dummy is not None:
-                warn('Table '+ms+' already has imaging weights')
-            else:
-                pt.addImagingColumns(ms)
-                result=True
+            pt.addImagingColumns(ms)
+            result=True
     if error:
         raise RuntimeError('One or more tables failed to open')
     return result
@@ -201,14 +257,7 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
 
     if cubemode:
         # number of channels equals number of distinct freqs in data
-        freqs=[]
-        mss=[l.rstrip() for l in open(mslist).readlines()]
-        for ms in mss:
-            t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-            freq=t[0]['REF_FREQUENCY']
-            if freq not in freqs:
-                freqs.append(freq)
-        channels=len(freqs)
+        channels=len(set(MSList(mslist).freqs))
         runcommand+=' --Output-Cubes I --Freq-NBand=%i' % channels
 
     if polcubemode:
@@ -276,7 +325,13 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
         
     if phasecenter is not None:
         runcommand += " --Image-PhaseCenterRADEC=[%s,%s]"%(phasecenter[0],phasecenter[1])
-    if options['restart'] and os.path.isfile(fname):
+
+    inputs=[mslist,cleanmask,clusterfile]
+    if use_dicomodel:
+        inputs.append(dicomodel_base+'.DicoModel')
+    if applysols is not None:
+        inputs+=solutions_files(mslist,ddsols,options)
+    if skip_step(options,runcommand,inputs,[fname]):
         warn('File '+fname+' already exists, skipping DDF step')
         if verbose:
             print 'would have run',runcommand
@@ -287,7 +342,8 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
 
         # Ugly way to see if predict has been already done
         if PredictSettings is not None:
-            fname=os.system("touch %s"%fname)
+            os.system("touch %s"%fname)
+        commit_step(options,runcommand,inputs,[fname])
     return imagename
         
 def make_external_mask(fname,templatename,use_tgss=True,options=None,extended_use=None,clobber=False,cellsize='cellsize'):
@@ -300,23 +356,23 @@ def make_external_mask(fname,templatename,use_tgss=True,options=None,extended_us
     if options['restart'] and os.path.isfile(fname) and not clobber:
         warn('External mask already exists, not creating it')
     else:
-        report('Make blank external mask')
-        hdus=fits.open(templatename)
-        hdus[0].data=np.zeros_like(hdus[0].data,dtype=np.int32)
-        hdus.writeto(fname,clobber=True)
-        hdus.close()
+        report('Make external mask')
+        catalogue=None
+        masks=[]
         if use_tgss and options['tgss'] is not None:
             report('Merging the mask with TGSS catalogue')
             # TGSS path is provided, this means we want to add the positions of bright TGSS sources to the mask
-            modify_mask(fname,fname,options['tgss'],options['tgss_radius'],options['tgss_flux'],do_extended=options['tgss_extended'],cellsize=options[cellsize],pointsize=options['tgss_pointlike'])
+            catalogue={'table':options['tgss'],'radius':options['tgss_radius'],'fluxlim':options['tgss_flux'],'do_extended':options['tgss_extended'],'cellsize':options[cellsize],'pointsize':options['tgss_pointlike']}
 
         if options['region'] is not None:
             report('Merging with mask with user-specified region')
-            add_manual_mask(fname,options['region'],fname)
 
         if options['extended_size'] is not None and extended_use is not None:
             report('Merging with automatic extended mask')
-            merge_mask(fname,extended_use,fname)
+            masks.append(extended_use)
+
+        # everything is combined in memory and the mask written once
+        compose_mask(templatename,fname,masks=masks,region=options['region'],catalogue=catalogue)
 
 
 def clusterGA(imagename="image_dirin_SSD_m.app.restored.fits",OutClusterCat=None,options=None,use_makemask_products=False):
@@ -363,24 +419,42 @@ def make_mask(imagename,thresh,verbose=False,options=None,external_mask=None,cat
     if OutMaskExtended is not None:
         runcommand += " --OutMaskExtended %s --OutNameNoiseMap Noise"%(OutMaskExtended)
 
-
-        
-    if options['restart'] and os.path.isfile(fname):
+    if external_mask is None:
+        external_masks=[]
+    elif type(external_mask) is str:
+        external_masks=[external_mask]
+    else:
+        external_masks=list(external_mask)
+    inputs=[imagename]+external_masks
+    if skip_step(options,runcommand,inputs,[fname]):
         warn('File '+fname+' already exists, skipping MakeMask step')
         if verbose:
             print 'Would have run',runcommand
     else:
         run(runcommand,dryrun=options['dryrun'],log=logfilename('MM-'+imagename+'.log',options=options),quiet=options['quiet'])
-        if external_mask is not None:
-            if type(external_mask) is str:
-                merge_mask(fname,external_mask,fname)
-            else:
-                for mask in external_mask:
-                    merge_mask(fname,mask,fname)
+        if external_masks:
+            compose_mask(fname,fname,include_template=True,masks=external_masks)
+        commit_step(options,runcommand,inputs,[fname])
     return fname
             
 
 
+def solutions_filename(ms,solsname,options):
+    SolsDir=options["SolsDir"]
+    if SolsDir is None or SolsDir=="":
+        return ms+'/killMS.'+solsname+'.sols.npz'
+    else:
+        MSName=os.path.abspath(ms).split("/")[-1]
+        return os.path.abspath(SolsDir)+"/"+MSName+'/killMS.'+solsname+'.sols.npz'
+
+def solutions_files(mslist,ddsols,options):
+    # all the per-MS solution files named by a DDSols string such as
+    # 'DDS3_full_smoothed' or '[DDS3_full_smoothed,DDS3_full_slow_merged]'
+    if ddsols is None:
+        return []
+    mss=[l.strip() for l in open(mslist).readlines()]
+    return [solutions_filename(ms,s,options) for ms in mss for s in ddsols.strip('[]').split(',')]
+
 def killms_data(imagename,mslist,outsols,clusterfile=None,colname='CORRECTED_DATA',niterkf=6,dicomodel=None,
                 uvrange=None,wtuv=None,robust=None,catcher=None,dt=None,options=None,
                 SolverType="KAFCA",PolMode="Scalar",MergeSmooth=False,NChanSols=1,
@@ -392,79 +466,86 @@ def killms_data(imagename,mslist,outsols,clusterfile=None,colname='CORRECTED_DAT
 
     cache_dir=find_cache_dir(options)
 
-    # run killms individually on each MS -- allows restart if it failed in the middle
+    # run killms individually on each MS -- allows restart if it failed in the middle.
+    # Several MS can be run at once, each with a share of NCPU_killms
     filenames=[l.strip() for l in open(mslist,'r').readlines()]
-    for f in filenames:
-        if catcher: catcher.check()
+    njobs=max(1,min(options['killms_jobs'],len(filenames)))
+    ncpu=max(1,options['NCPU_killms']/njobs)
 
-        SolsDir=options["SolsDir"]
-        fname=f
-        if SolsDir is None or SolsDir=="":
-            solname =fname+'/killMS.'+outsols+'.sols.npz'
-        else:
-            MSName=os.path.abspath(f).split("/")[-1]
-            solname =os.path.abspath(SolsDir)+"/"+MSName+'/killMS.'+outsols+'.sols.npz'
+    def killms_ms(f):
+        solname=solutions_filename(f,outsols,options)
         checkname=solname
 
+        runcommand = "kMS.py --MSName %s --SolverType %s --PolMode %s --BaseImageName %s --dt %f --NIterKF %i --CovQ %f --LambdaKF=%f --NCPU %i --OutSolsName %s --InCol %s"%(f,SolverType,PolMode,imagename,dt,niterkf, CovQ, o['LambdaKF'], ncpu, outsols,colname)
 
-
-        #checkname=f+'/killMS.'+outsols+'.sols.npz'
-        if o['restart'] and os.path.isfile(checkname):
-
-            warn('Solutions file '+checkname+' already exists, not running killMS step')
-            
+        if robust is None:
+            runcommand+=' --Weighting Natural'
         else:
-            runcommand = "kMS.py --MSName %s --SolverType %s --PolMode %s --BaseImageName %s --dt %f --NIterKF %i --CovQ %f --LambdaKF=%f --NCPU %i --OutSolsName %s --InCol %s"%(f,SolverType,PolMode,imagename,dt,niterkf, CovQ, o['LambdaKF'], o['NCPU_killms'], outsols,colname)
-
-            if robust is None:
-                runcommand+=' --Weighting Natural'
+            runcommand+=' --Weighting Briggs --Robust=%f' % robust
+        if uvrange is not None:
+            if wtuv is not None:
+                runcommand+=' --WTUV=%f --WeightUVMinMax=%f,%f' % (wtuv, uvrange[0], uvrange[1])
             else:
-                runcommand+=' --Weighting Briggs --Robust=%f' % robust
-            if uvrange is not None:
-                if wtuv is not None:
-                    runcommand+=' --WTUV=%f --WeightUVMinMax=%f,%f' % (wtuv, uvrange[0], uvrange[1])
-                else:
-                    runcommand+=' --UVMinMax=%f,%f' % (uvrange[0], uvrange[1])
-            if o['nobar']:
-                runcommand+=' --DoBar=0'
+                runcommand+=' --UVMinMax=%f,%f' % (uvrange[0], uvrange[1])
+        if o['nobar']:
+            runcommand+=' --DoBar=0'
+
+        runcommand+=' --SolsDir=%s'%options["SolsDir"]
+
+        inputs=[dicomodel,clusterfile]
+        if PreApplySols:
+            runcommand+=' --PreApplySols=[%s]'%PreApplySols
+            inputs+=[solutions_filename(f,s,options) for s in PreApplySols.strip('[]').split(',')]
+
+        if DISettings is None:
+            runcommand+=' --NChanSols %i' % NChanSols
+            runcommand+=' --BeamMode LOFAR --LOFARBeamMode=A --DDFCacheDir=%s'%cache_dir
+            if clusterfile is not None:
+                runcommand+=' --NodesFile '+clusterfile
+            if dicomodel is not None:
+                runcommand+=' --DicoModel '+dicomodel
+            if EvolutionSolFile is not None:
+                runcommand+=' --EvolutionSolFile '+EvolutionSolFile
+                inputs.append(solutions_filename(f,EvolutionSolFile,options))
+        else:
+            runcommand+=" --SolverType %s --PolMode %s --SkyModelCol %s --OutCol %s --ApplyToDir 0"%DISettings
 
-            runcommand+=' --SolsDir=%s'%options["SolsDir"]
-            
-            if PreApplySols:
-                runcommand+=' --PreApplySols=[%s]'%PreApplySols
+        # the solution intervals for the DI case are derived from the
+        # data, so the ledger is keyed on the command without them
+        stepcommand=runcommand
 
-                
-            if DISettings is None:
-                runcommand+=' --NChanSols %i' % NChanSols
-                runcommand+=' --BeamMode LOFAR --LOFARBeamMode=A --DDFCacheDir=%s'%cache_dir
-                if clusterfile is not None:
-                    runcommand+=' --NodesFile '+clusterfile
-                if dicomodel is not None:
-                    runcommand+=' --DicoModel '+dicomodel
-                if EvolutionSolFile is not None:
-                    runcommand+=' --EvolutionSolFile '+EvolutionSolFile
-                    
-            else:
-                runcommand+=" --SolverType %s --PolMode %s --SkyModelCol %s --OutCol %s --ApplyToDir 0"%DISettings
-                _,_,ModelColName,_=DISettings
-                _,dt,_,n_df=give_dt_dnu(f,
-                                        DataCol=colname,
-                                        ModelCol=ModelColName,
-                                        T=10.)
-                runcommand+=" --dt %f --NChanSols %i"%(dt+1e-4,n_df)
-                
-                
-            rootfilename=outsols.split('/')[-1]
-            f_=f.replace("/","_")
-            run(runcommand,dryrun=o['dryrun'],log=logfilename('KillMS-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
-
-            # Clip anyway - on IMAGING_WEIGHT by default
-            if DISettings is not None:
-                ClipCol=DISettings[-1]
-            else:
-                ClipCol=colname
-            runcommand="ClipCal.py --MSName %s --ColName %s"%(f,ClipCol)
-            run(runcommand,dryrun=o['dryrun'],log=logfilename('ClipCal-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
+        if skip_step(options,stepcommand,inputs,[checkname]):
+            warn('Solutions file '+checkname+' already exists, not running killMS step')
+            return
+
+        if DISettings is not None:
+            _,_,ModelColName,_=DISettings
+            _,dt_di,_,n_df=give_dt_dnu(f,
+                                       DataCol=colname,
+                                       ModelCol=ModelColName,
+                                       T=10.)
+            runcommand+=" --dt %f --NChanSols %i"%(dt_di+1e-4,n_df)
+
+        rootfilename=outsols.split('/')[-1]
+        f_=f.replace("/","_")
+        run_job(runcommand,dryrun=o['dryrun'],log=logfilename('KillMS-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
+
+        # Clip anyway - on IMAGING_WEIGHT by default
+        if DISettings is not None:
+            ClipCol=DISettings[-1]
+        else:
+            ClipCol=colname
+        runcommand="ClipCal.py --MSName %s --ColName %s"%(f,ClipCol)
+        run_job(runcommand,dryrun=o['dryrun'],log=logfilename('ClipCal-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
+        commit_step(options,stepcommand,inputs,[checkname])
+
+    if njobs>1:
+        report('Running killMS on %i MS at a time with %i CPUs each' % (njobs,ncpu))
+    # a failed MS stops new ones being started; the shared memory is
+    # only cleaned up once the running ones have finished
+    error=run_jobs(killms_ms,filenames,njobs,catcher=catcher)
+    if error is not None:
+        fail(error)
 
     if MergeSmooth:
         outsols=smooth_solutions(mslist,outsols,catcher=None,dryrun=o['dryrun'],InterpToMSListFreqs=InterpToMSListFreqs,
@@ -475,9 +556,11 @@ def killms_data(imagename,mslist,outsols,clusterfile=None,colname='CORRECTED_DAT
 
     return outsols
 
-def compress_fits(filename,q):
+def compress_fits(filename,q,options=None):
+    if options is None:
+        options=o # attempt to get global if it exists
     command='fpack -q %i %s' % (q,filename)
-    run(command,dryrun=o['dryrun'])
+    run(command,dryrun=options['dryrun'])
     
 def make_model(maskname,imagename,catcher=None):
     # returns True if the step was run, False if skipped
@@ -495,11 +578,12 @@ def make_model(maskname,imagename,catcher=None):
 def mask_dicomodel(indico,maskname,outdico,catcher=None):
     if catcher: catcher.check()
 
-    if o['restart'] and os.path.isfile(outdico):
+    runcommand = "MaskDicoModel.py --MaskName=%s --InDicoModel=%s --OutDicoModel=%s"%(maskname,indico,outdico)
+    if skip_step(o,runcommand,[indico,maskname],[outdico]):
         warn('File '+outdico+' already exists, skipping MaskDicoModel step')
     else:
-        runcommand = "MaskDicoModel.py --MaskName=%s --InDicoModel=%s --OutDicoModel=%s"%(maskname,indico,outdico) 
         run(runcommand,dryrun=o['dryrun'],log=logfilename('MaskDicoModel-'+maskname+'.log'),quiet=o['quiet'])
+        commit_step(o,runcommand,[indico,maskname],[outdico])
     return outdico.split(".")[0]
 
 def rmtglob(path):
@@ -553,7 +637,6 @@ def smooth_solutions(mslist,ddsols,catcher=None,dryrun=False,InterpToMSListFreqs
             t0,t1 = get_solutions_timerange(solname)
             start_times.append(t0)
             full_sollist.append(solname)
-            f.write('%s\n'%(solname))
     else:
         for fname in filenames:
             MSName=os.path.abspath(fname).split("/")[-1]
@@ -564,62 +647,76 @@ def smooth_solutions(mslist,ddsols,catcher=None,dryrun=False,InterpToMSListFreqs
 
     Ustart_times = np.unique(start_times)
 
-    for start_time in Ustart_times:
+    # the merge/smooth/interpolate chains for different observations
+    # are independent, so several start times can be processed at once
+    def process_start_time(start_time):
+        sollist=[full_sollist[i] for i in range(0,len(full_sollist)) if start_times[i] == start_time]
         with open('solslist_%s.txt'%start_time,'w') as f:
-            for i in range(0,len(full_sollist)):
-                if start_times[i] == start_time:
-                    solname = full_sollist[i]
-                    f.write('%s\n'%(solname))
+            for solname in sollist:
+                f.write('%s\n'%(solname))
         
         checkname='%s_%s_merged.npz'%(ddsols,start_time)
-        if o['restart'] and os.path.isfile(checkname):
+        ss='MergeSols.py --SolsFilesIn=solslist_%s.txt --SolFileOut=%s_%s_merged.npz'%(start_time,ddsols,start_time)
+        if SigmaFilterOutliers:
+            ss+=" --SigmaFilterOutliers %f"%SigmaFilterOutliers
+        if skip_step(o,ss,sollist,[checkname]):
             warn('Solutions file '+checkname+' already exists, not running MergeSols step')
         else:
-            ss='MergeSols.py --SolsFilesIn=solslist_%s.txt --SolFileOut=%s_%s_merged.npz'%(start_time,ddsols,start_time)
-            if SigmaFilterOutliers:
-                ss+=" --SigmaFilterOutliers %f"%SigmaFilterOutliers
-            run(ss,dryrun=dryrun)
+            run_job(ss,dryrun=dryrun,log=logfilename('MergeSols-%s_%s.log'%(ddsols,start_time)),quiet=o['quiet'])
+            commit_step(o,ss,sollist,[checkname])
             
         checkname='%s_%s_smoothed.npz'%(ddsols,start_time)
-        if o['restart'] and os.path.isfile(checkname):
-            warn('Solutions file '+checkname+' already exists, not running SmoothSols step')
-        elif SkipSmooth:
+        ss='SmoothSols.py --SolsFileIn=%s_%s_merged.npz --SolsFileOut=%s_%s_smoothed.npz --InterpMode=%s'%(ddsols,start_time,ddsols,start_time,o['smoothingtype'])
+        inputs=['%s_%s_merged.npz'%(ddsols,start_time)]
+        if SkipSmooth:
             warn('Skipping smoothing Solutions file')
+        elif skip_step(o,ss,inputs,[checkname]):
+            warn('Solutions file '+checkname+' already exists, not running SmoothSols step')
         else:
-            run('SmoothSols.py --SolsFileIn=%s_%s_merged.npz --SolsFileOut=%s_%s_smoothed.npz --InterpMode=%s'%(ddsols,start_time,ddsols,start_time,o['smoothingtype']),dryrun=dryrun)
+            run_job(ss,dryrun=dryrun,log=logfilename('SmoothSols-%s_%s.log'%(ddsols,start_time)),quiet=o['quiet'])
+            commit_step(o,ss,inputs,[checkname])
 
         smoothoutname='%s_%s_smoothed.npz'%(ddsols,start_time)
 
         if InterpToMSListFreqs:
             interp_outname="%s_%s_interp.npz"%(smoothoutname,start_time)
             checkname=interp_outname
-            if o['restart'] and os.path.isfile(checkname):
+            command="InterpSols.py --SolsFileIn %s --SolsFileOut %s --MSOutFreq %s"%(smoothoutname,interp_outname,InterpToMSListFreqs)
+            if skip_step(o,command,[smoothoutname,InterpToMSListFreqs],[checkname]):
                 warn('Solutions file '+checkname+' already exists, not running MergeSols step')
             else:
-                command="InterpSols.py --SolsFileIn %s --SolsFileOut %s --MSOutFreq %s"%(smoothoutname,interp_outname,InterpToMSListFreqs)
-                run(command,dryrun=dryrun)
-        
+                run_job(command,dryrun=dryrun,log=logfilename('InterpSols-%s_%s.log'%(ddsols,start_time)),quiet=o['quiet'])
+                commit_step(o,command,[smoothoutname,InterpToMSListFreqs],[checkname])
+
+    njobs=max(1,min(o['solutions_jobs'],len(Ustart_times)))
+    if njobs>1:
+        report('Processing solutions for %i observations, %i at a time' % (len(Ustart_times),njobs))
+    error=run_jobs(process_start_time,Ustart_times,njobs,catcher=catcher)
+    if error is not None:
+        fail(error)
+
+    # only point the MS at the new solutions once every chain has succeeded
+    for start_time in Ustart_times:
         for i in range(0,len(full_sollist)):
             if start_times[i] == start_time:
-		if not SkipSmooth:
+                if not SkipSmooth:
                     symsolname = full_sollist[i].replace(ddsols,ddsols+'_smoothed')
                 else:
-                    symsolname = full_sollist[i].replace(ddsols,ddsols+'_merged')                 
+                    symsolname = full_sollist[i].replace(ddsols,ddsols+'_merged')
                 # always overwrite the symlink to allow the dataset to move -- costs nothing
                 if os.path.islink(symsolname):
-	            warn('Symlink ' + symsolname + ' already exists, recreating')
+                    warn('Symlink ' + symsolname + ' already exists, recreating')
                     os.unlink(symsolname)
 
                 if not SkipSmooth:
                     os.symlink(os.path.abspath('%s_%s_smoothed.npz'%(ddsols,start_time)),symsolname)
                 else:
                     os.symlink(os.path.abspath('%s_%s_merged.npz'%(ddsols,start_time)),symsolname)
-                    
-                    
-        if SkipSmooth:
-            outname = ddsols + '_merged'
-        else:
-            outname = ddsols + '_smoothed'
+
+    if SkipSmooth:
+        outname = ddsols + '_merged'
+    else:
+        outname = ddsols + '_smoothed'
 
     return outname
 
@@ -632,58 +729,44 @@ def full_clearcache(o,extras=None):
         for mslist in extras:
             clearcache(mslist,o)
 
-def subtract_data(mslist,col1,col2):
-    filenames=[l.strip() for l in open(mslist,'r').readlines()]
-    for f in filenames:
-        print 'Subtracting',f
-        t = pt.table(f,readonly=False)
+def subtract_columns(msname,col1,col2,outcol,rows=100000):
+    # outcol=col1-col2, streaming through the table in blocks of rows
+    # so that memory use does not depend on the size of the MS
+    t=pt.table(msname,readonly=False,ack=False)
+    if outcol not in t.colnames():
+        report('Adding column %s in %s'%(outcol,msname))
         desc=t.getcoldesc(col1)
-        desc['name']='SUBTRACTED_DATA'
+        desc['name']=outcol
+        desc['comment']=desc['comment'].replace(" ","_")
         t.addcols(desc)
-        d1=t.getcol(col1)
-        d2=t.getcol(col2)
-        t.putcol('SUBTRACTED_DATA',d1-d2)
+    nrows=t.nrows()
+    if nrows==0:
         t.close()
-
-def give_dt_dnu(msname,DataCol="DATA",ModelCol="DI_PREDICT",T=10.):
-    t=pt.table(msname,ack=False)
-    d=t.getcol(DataCol)
-    dt_bin_sec=t.getcol("INTERVAL",0,1,1)[0]
-    _,nch,_=d.shape
-    f=t.getcol("FLAG")
-    p=t.getcol(ModelCol)
+        return
+    cell=t.getcell(col1,0)
+    d=np.empty((min(rows,nrows),)+cell.shape,dtype=cell.dtype)
+    p=np.empty_like(d)
+    for start in range(0,nrows,rows):
+        n=min(rows,nrows-start)
+        dv=d[:n]
+        pv=p[:n]
+        t.getcolnp(col1,dv,start,n)
+        t.getcolnp(col2,pv,start,n)
+        np.subtract(dv,pv,out=dv)
+        t.putcol(outcol,dv,start,n)
     t.close()
-    fp=f[:,:,np.array([1,2])]
-    dp=d[:,:,np.array([1,2])]
-    dps=dp[fp==0]
-    da=np.abs(d[:,:,0][f[:,:,0]==0])
-    S=np.std(dps)
-    M=np.mean(da)
-    nb=T**2/(M/S)**2
-
-    # find the size of the channel step  
-    nch_step=int(round(np.sqrt(nb)))
-    nch_step=np.max([1,nch_step])
-    nch_step=np.min([nch,nch_step])
-    warn('nch_step=%i'%(nch_step))
-
-    # find the step to have equal interval size
-    #nch_bin=int(nch/nch_step)+1
-    #nch_step=int(nch/float(nch_bin))
-    lDiv=np.array([i for i in range(1,nch+1) if nch%i==0])
-    inch=np.argmin(np.abs(lDiv-nch_step))
-    nch_step=lDiv[inch]
-    nch_step=np.max([1,nch_step])
-    nch_step=np.min([nch,nch_step])
-    
-    nt_step=int(round(nb/float(nch_step)))
-    nt_step=np.max([1,nt_step])
 
-    SNR=np.sqrt(nt_step*nch_step)*M/S
-    warn('Using (dt,df)=(%i,%i) for self-cal run of %s with (<|model|>,std)=(%.2f,%.2f) giving SNR=%.2f'%(nt_step,nch_step,msname,M,S,SNR))
-    
-    return nt_step, nt_step*dt_bin_sec/60.0, nch_step, nch/nch_step
-    
+def _subtract_columns(args):
+    # job wrapper for run_jobs
+    return subtract_columns(*args)
+
+def subtract_mslist(filenames,col1,col2,outcol,rows=100000,jobs=1):
+    jobs=max(1,min(jobs,len(filenames)))
+    tasks=[(f,col1,col2,outcol,rows) for f in filenames]
+    error=run_jobs(_subtract_columns,tasks,jobs,pool_class=Pool)
+    if error is not None:
+        die('Subtraction failed: '+error)
+
 def cubical_data(mslist,
                  NameSol="DI0",
                  n_dt=1,
@@ -766,25 +849,10 @@ def ingest_dynspec(obsid='*'):
         
     
 
-def subtract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB"):
-    from pyrap.tables import table
-    f=file(mslist)
-    mslist=f.readlines()
-    mslist=[msname.replace("\n","") for msname in mslist]
-    for msname in mslist:
-        report('Subtracting: %s = %s - %s'%(out_colname,colname_a,colname_b))
-        t=table(msname,readonly=False)
-        d=t.getcol(colname_a)
-        p=t.getcol(colname_b)
-        d-=p
-        if out_colname not in t.colnames():
-            report('Adding column %s in %s'%(out_colname,msname))
-            desc=t.getcoldesc(colname_a)
-            desc["name"]=out_colname
-            desc['comment']=desc['comment'].replace(" ","_")
-            t.addcols(desc)
-        t.putcol(out_colname,d)
-        t.close()
+def subtract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB",rows=100000,jobs=1):
+    filenames=[l.strip() for l in open(mslist,'r').readlines()]
+    report('Subtracting: %s = %s - %s for %i MS'%(out_colname,colname_a,colname_b,len(filenames)))
+    subtract_mslist(filenames,colname_a,colname_b,out_colname,rows=rows,jobs=jobs)
     
 
 def subtractOuterSquare(o):
@@ -877,7 +945,7 @@ def subtractOuterSquare(o):
     if o['restart'] and os.path.isfile(FileHasSubtracted):
         warn('File %s already exists, skipping subtract vis step'%FileHasSubtracted)
     else:
-        subtract_vis(mslist=o['full_mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB")
+        subtract_vis(mslist=o['full_mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB",rows=o['subtract_rows'],jobs=o['subtract_jobs'])
         os.system("touch %s"%FileHasSubtracted)
 
 
@@ -896,6 +964,206 @@ def subtractOuterSquare(o):
             catcher=catcher)
 
 
+def step_options(o,name,ncpu):
+    # options for a scheduled step: its own CPU count, and its own DDF
+    # cache directory so that steps running at the same time never
+    # share a cache
+    so=dict(o)
+    so['NCPU_DDF']=ncpu
+    cache_dir=find_cache_dir(o)+'/step-'+name
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    so['cache_dir']=cache_dir
+    return so
+
+def make_low_images(colname,CurrentDDkMSSolName,low_uvrange,low_imsize,options=None,catcher=None):
+    if options is None:
+        options=o
+    separator("Low-resolution image")
+    # if mask-low exists then use it
+    if os.path.isfile('bootstrap-mask-low.fits'):
+        extmask='bootstrap-mask-low.fits'
+    else:
+        extmask=None
+
+    ddf_image('image_full_low',options['full_mslist'],
+              cleanmask=extmask,
+              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+              applysols='AP',
+              AllowNegativeInitHMP=True,
+              majorcycles=2,robust=options['low_robust'],
+              colname=colname,use_dicomodel=False,
+              uvrange=low_uvrange,beamsize=options['low_psf_arcsec'],
+              imsize=low_imsize,cellsize=options['low_cell'],peakfactor=0.001,
+              smooth=True,automask=True,automask_threshold=5,normalization=options['normalize'][2],
+              options=options,catcher=catcher)
+
+    make_mask('image_full_low.app.restored.fits',3.0,external_mask=extmask,options=options,catcher=catcher)
+
+    ddf_image('image_full_low_im',options['full_mslist'],
+              cleanmask='image_full_low.app.restored.fits.mask.fits',
+              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+              applysols='AP',
+              AllowNegativeInitHMP=True,
+              majorcycles=1,robust=options['low_robust'],
+              uvrange=low_uvrange,beamsize=options['low_psf_arcsec'],
+              imsize=low_imsize,cellsize=options['low_cell'],peakfactor=0.001,
+              smooth=True,automask=True,automask_threshold=5,normalization=options['normalize'][2],colname=colname,
+              reuse_psf=True,dirty_from_resid=True,use_dicomodel=True,dicomodel_base='image_full_low',
+              options=options,catcher=catcher)
+
+    if options['restart'] and os.path.isfile('full-mask-low.fits'):
+        warn('Full-bw mask exists, not making it')
+    else:
+        report('Making the full-bw extended source mask')
+        if os.path.isfile('image_dirin_SSD.app.restored.fits'):
+            # Normal pipeline run.
+            make_extended_mask('image_full_low_im.app.restored.fits','image_dirin_SSD.app.restored.fits',rmsthresh=options['extended_rms'],sizethresh=1500,rootname='full',rmsfacet=options['rmsfacet'])
+        elif (not os.path.isfile('image_dirin_SSD.app.restored.fits')) and os.path.isfile('image_full_ampphase_di.app.restored.fits'):
+            # Input model was given.
+            make_extended_mask('image_full_low_im.app.restored.fits','image_full_ampphase_di.app.restored.fits',rmsthresh=options['extended_rms'],sizethresh=1500,rootname='full',rmsfacet=options['rmsfacet'],ds9region='image_full_ampphase_di_m.tessel.reg')
+        else:
+            # Something may be wrong.
+            die('Could not find the required products for the full-bw extended source mask!')
+        report('Make_extended_mask returns')
+    extmask='full-mask-low.fits'
+    make_mask('image_full_low_im.app.restored.fits',3.0,external_mask=extmask,options=options,catcher=catcher)
+
+    ddf_image('image_full_low_m',options['full_mslist'],
+              cleanmask='image_full_low_im.app.restored.fits.mask.fits',
+              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+              applysols='AP',
+              AllowNegativeInitHMP=True,
+              majorcycles=1,robust=options['low_robust'],
+              uvrange=low_uvrange,beamsize=options['low_psf_arcsec'],
+              imsize=low_imsize,cellsize=options['low_cell'],peakfactor=0.001,
+              smooth=True,automask=True,automask_threshold=4,normalization=options['normalize'][2],colname=colname,
+              reuse_psf=True,dirty_from_resid=True,use_dicomodel=True,dicomodel_base='image_full_low_im',
+              options=options,catcher=catcher,rms_factor=options['final_rmsfactor'])
+    external_mask='external_mask_ext-deep.fits'
+    if os.path.isfile(external_mask):
+        warn('Deep external mask already exists, skipping creation')
+    else:
+        report('Make deep external mask')
+        make_external_mask(external_mask,'image_full_ampphase_di.app.restored.fits',use_tgss=True,clobber=False,extended_use='full-mask-high.fits',options=options)
+
+def make_final_image(colname,CurrentMaskName,CurrentBaseDicoModelName,CurrentDDkMSSolName,uvrange,ddf_kw,facet_offset_file,download_thread=None,options=None,catcher=None):
+    if options is None:
+        options=o
+    # full resolution, one iter of deconvolution
+    separator("DD imaging (full resolution)")
+    ddf_image('image_full_ampphase_di_m.NS',options['full_mslist'],
+              cleanmask=CurrentMaskName,
+              reuse_psf=False,
+              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+              applysols='AP',majorcycles=1,robust=options['final_robust'],
+              colname=colname,use_dicomodel=True,
+              dicomodel_base=CurrentBaseDicoModelName,
+              AllowNegativeInitHMP=True,
+              peakfactor=0.001,automask=True,automask_threshold=options['thresholds'][2],
+              normalization=options['normalize'][1],uvrange=uvrange,smooth=True,
+              apply_weights=options['apply_weights'][2],use_weightspectrum=options['use_weightspectrum'],catcher=catcher,RMSFactorInitHMP=1.,
+              PredictSettings=("Clean","DD_PREDICT"),options=options,
+              **ddf_kw)
+
+    # check for the offset files
+    if options['method'] is not None:
+        from get_cat import get_cat, download_required
+        separator('Offset correction')
+        # have we got the catalogue?
+        if download_thread is not None and download_thread.isAlive():
+            warn('Waiting for background download thread to finish...')
+            download_thread.join()
+        # maybe the thread died, check the files are there
+        if download_required(options['method']):
+            warn('Retrying download for some or all of the catalogue')
+            try:
+                get_cat(options['method'],jobs=options['download_jobs'],per_host=options['download_per_host'])
+            except RuntimeError:
+                die('Failed to download catalogue with method '+options['method'])
+
+        # we should now have the catalogue, find the offsets
+        if options['restart'] and os.path.isfile(facet_offset_file):
+            warn('Offset file already exists, not running offsets.py')
+        else:
+            run('offsets.py '+' '.join(sys.argv[1:]),log=None)
+
+        # apply the offsets
+        ddf_shift('image_full_ampphase_di_m.NS',facet_offset_file,options=options,catcher=catcher)
+
+def make_polcubes(colname,CurrentDDkMSSolName,uvrange,imageoutname,ddf_kw,beamsize,imsize,cellsize,robust,cubefiles,options=None,catcher=None):
+    from do_polcubes import do_polcubes
+    if options is None:
+        options=o
+    separator('Stokes Q and U cubes')
+    if options['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
+        warn('Compressed %s QU cube product exists, not making new images' % imageoutname)
+    else:
+        do_polcubes(colname,CurrentDDkMSSolName,uvrange,imageoutname,ddf_kw,beamsize=beamsize,imsize=imsize,cellsize=cellsize,robust=robust,options=options,catcher=catcher)
+
+def compress_cube(cubefile,options=None):
+    if options is None:
+        options=o
+    if options['restart'] and os.path.isfile(cubefile+'.fz'):
+        warn('Compressed cube file '+cubefile+'.fz already exists, not compressing')
+        return
+    report('Compressing '+cubefile)
+    compress_fits(cubefile,options['fpack_q'],options=options)
+    if options['delete_compressed']:
+        warn('Deleting compressed file %s' % cubefile)
+        os.remove(cubefile)
+
+def make_stokesv(colname,CurrentDDkMSSolName,low_uvrange,low_imsize,options=None,catcher=None):
+    if options is None:
+        options=o
+    separator('Stokes V image')
+    ddf_image('image_full_low_stokesV',options['full_mslist'],
+              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+              applysols='AP',stokes='IV',
+              AllowNegativeInitHMP=True,
+              majorcycles=0,robust=options['low_robust'],
+              colname=colname,use_dicomodel=False,
+              uvrange=low_uvrange,beamsize=options['low_psf_arcsec'],
+              imsize=low_imsize,cellsize=options['low_cell'],peakfactor=0.001,
+              smooth=True,automask=True,automask_threshold=5,normalization=options['normalize'][2],
+              options=options,catcher=catcher)
+
+def make_dynspec(colname,CurrentDDkMSSolName,options=None,catcher=None):
+    if options is None:
+        options=o
+    separator('Dynamic spectra')
+
+    if options['bright_threshold'] is not None and options['method'] is not None:
+        warn('Finding bright sources from offsets list')
+        from find_bright_offset_sources import find_bright
+        find_bright(cutoff=options['bright_threshold'])
+
+    m=MSList(options['full_mslist'])
+    uobsid = set(m.obsids)
+
+    for obsid in uobsid:
+        if catcher: catcher.check()
+        LastImageI="image_full_ampphase_di_m.NS.int.restored.fits"
+        LastImageV="image_full_low_stokesV.dirty.corr.fits"
+        warn('Running ms2dynspec for obsid %s' % obsid)
+        umslist='mslist-%s.txt' % obsid
+        print 'Writing temporary ms list',umslist
+        with open(umslist,'w') as file:
+            for ms,ob in zip(m.mss,m.obsids):
+                if ob==obsid:
+                    file.write(ms+'\n')
+
+        g=glob.glob('DynSpec*'+obsid+'*')
+        if len(g)>0:
+            warn('DynSpecs results directory %s already exists, skipping DynSpecs' % g[0])
+        else:
+            runcommand="ms2dynspec.py --ms %s --data %s --model DD_PREDICT --sols %s --rad 2. --imageI %s --imageV %s --LogBoring %i --SolsDir %s --BeamModel LOFAR --BeamNBand 1"%(umslist,colname,CurrentDDkMSSolName,LastImageI,LastImageV,options['nobar'],options["SolsDir"])
+            if options['bright_threshold'] is not None:
+                runcommand+=' --srclist brightlist.csv'
+            run(runcommand,dryrun=options['dryrun'],log=logfilename('ms2dynspec.log',options=options),quiet=options['quiet'])
+            if use_database():
+                ingest_dynspec(obsid)
+
 def main(o=None):
     if o is None:
         o=MyPickle.Load("ddf-pipeline.last")
@@ -936,13 +1204,7 @@ def main(o=None):
     # before we check imaging weights, because that will create empty
     # versions of e.g. CORRECTED_DATA
     mslist=[s.strip() for s in open(o['mslist']).readlines()]
-    t = pt.table(mslist[0])
-    try:
-        dummy=t.getcoldesc(colname)
-    except RuntimeError:
-        dummy=None
-    t.close()
-    if dummy is None:
+    if not has_column(mslist[0],colname):
         die('Dataset does not contain the column "%s"' % colname)
     
     # Clear the shared memory
@@ -972,6 +1234,9 @@ def main(o=None):
             pass
         elif o['redofrom']=='dirin':
             keep+=glob.glob('image_dirin_SSD_init.*') + glob.glob('image_dirin_SSD.*') + glob.glob('image_dirin_SSD_m.*') + glob.glob('MaskDiffuse*') + glob.glob('Noise*.fits')
+            # ledger entries for the kept images; entries for archived
+            # products are ignored since their outputs are now missing
+            keep+=glob.glob('step-ledger.json')
         else:
             die('Redofrom option not implemented')
             
@@ -1058,7 +1323,17 @@ def main(o=None):
                     catcher=catcher,
                     OutMaskExtended="MaskDiffuse")
         separator("Merge diffuse emission mask into external mask")
-        merge_mask(external_mask,"MaskDiffuse.fits",external_mask)
+        # write the merged mask to a new file rather than in place, so
+        # that the ledger entries of steps that used the original
+        # external mask stay valid on restart
+        diffuse_mask='external_mask_diffuse.fits'
+        inputs=[external_mask,"MaskDiffuse.fits"]
+        if skip_step(o,'merge_mask',inputs,[diffuse_mask]):
+            warn('File '+diffuse_mask+' already exists, not merging masks')
+        elif not o['dryrun']:
+            compose_mask(external_mask,diffuse_mask,include_template=True,masks=["MaskDiffuse.fits"])
+            commit_step(o,'merge_mask',inputs,[diffuse_mask])
+        external_mask=diffuse_mask
 
         # make a mask from the final image
         separator("Make mask for next iteration")
@@ -1532,101 +1807,65 @@ def main(o=None):
 
         CurrentDDkMSSolName="[%s,%s]"%(CurrentDDkMSSolName_FastSmoothed,CurrentDDkMSSolName)
     
+    low_uvrange=None
+    low_imsize=None
     if o['low_psf_arcsec'] is not None:
-        separator("Low-resolution image")
-        # low-res image requested
         low_uvrange=[o['image_uvmin'],2.5*206.0/o['low_psf_arcsec']]
         if o['low_imsize'] is not None:
             low_imsize=o['low_imsize'] # allow over-ride
         else:
             low_imsize=o['imsize']*o['cellsize']/o['low_cell']
-            # if mask-low exists then use it
-        if os.path.isfile('bootstrap-mask-low.fits'):
-            extmask='bootstrap-mask-low.fits'
-        else:
-            extmask=None
-
-        ddf_image('image_full_low',o['full_mslist'],
-                  cleanmask=extmask,
-                  cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-                  applysols='AP',
-		  AllowNegativeInitHMP=True,
-                  majorcycles=2,robust=o['low_robust'],
-                  colname=colname,use_dicomodel=False,
-                  uvrange=low_uvrange,beamsize=o['low_psf_arcsec'],
-                  imsize=low_imsize,cellsize=o['low_cell'],peakfactor=0.001,
-                  smooth=True,automask=True,automask_threshold=5,normalization=o['normalize'][2],
-                  catcher=catcher)
-
-        make_mask('image_full_low.app.restored.fits',3.0,external_mask=extmask,catcher=catcher)
-
-        ddf_image('image_full_low_im',o['full_mslist'],
-              cleanmask='image_full_low.app.restored.fits.mask.fits',
-              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-              applysols='AP',
-	      AllowNegativeInitHMP=True,
-              majorcycles=1,robust=o['low_robust'],
-              uvrange=low_uvrange,beamsize=o['low_psf_arcsec'],
-              imsize=low_imsize,cellsize=o['low_cell'],peakfactor=0.001,
-              smooth=True,automask=True,automask_threshold=5,normalization=o['normalize'][2],colname=colname,
-              reuse_psf=True,dirty_from_resid=True,use_dicomodel=True,dicomodel_base='image_full_low',
-              catcher=catcher)
 
+    # The remaining products only depend on the final solutions and
+    # (in some cases) on each other, so they are handed to the step
+    # scheduler which runs independent ones at the same time
+    scheduler=StepScheduler(o['NCPU_budget'],memory=o['memory_budget'])
+    if o['NCPU_step'] is not None:
+        step_ncpu=o['NCPU_step']
+    else:
+        step_ncpu=o['NCPU_DDF']
 
-        if o['restart'] and os.path.isfile('full-mask-low.fits'):
-            warn('Full-bw mask exists, not making it')
-        else:
-            report('Making the full-bw extended source mask')
-            if os.path.isfile('image_dirin_SSD.app.restored.fits'):
-                # Normal pipeline run.
-                make_extended_mask('image_full_low_im.app.restored.fits','image_dirin_SSD.app.restored.fits',rmsthresh=o['extended_rms'],sizethresh=1500,rootname='full',rmsfacet=o['rmsfacet'])
-            elif (not os.path.isfile('image_dirin_SSD.app.restored.fits')) and os.path.isfile('image_full_ampphase_di.app.restored.fits'):
-                # Input model was given.
-                make_extended_mask('image_full_low_im.app.restored.fits','image_full_ampphase_di.app.restored.fits',rmsthresh=o['extended_rms'],sizethresh=1500,rootname='full',rmsfacet=o['rmsfacet'],ds9region='image_full_ampphase_di_m.tessel.reg')
-            else:
-                # Something may be wrong.
-                die('Could not find the required products for the full-bw extended source mask!')
-            report('Make_extended_mask returns')
-        extmask='full-mask-low.fits'
-        make_mask('image_full_low_im.app.restored.fits',3.0,external_mask=extmask,catcher=catcher)
+    def add_step(name,function,args,inputs=None,outputs=None,ncpu=step_ncpu,memory=o['memory_step']):
+        return scheduler.add(name,function,args=args,kwargs={'options':step_options(o,name,ncpu),'catcher':catcher},inputs=inputs,outputs=outputs,ncpu=ncpu,memory=memory)
 
-        ddf_image('image_full_low_m',o['full_mslist'],
-              cleanmask='image_full_low_im.app.restored.fits.mask.fits',
-              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-              applysols='AP',
-	      AllowNegativeInitHMP=True,
-              majorcycles=1,robust=o['low_robust'],
-              uvrange=low_uvrange,beamsize=o['low_psf_arcsec'],
-              imsize=low_imsize,cellsize=o['low_cell'],peakfactor=0.001,
-              smooth=True,automask=True,automask_threshold=4,normalization=o['normalize'][2],colname=colname,
-              reuse_psf=True,dirty_from_resid=True,use_dicomodel=True,dicomodel_base='image_full_low_im',
-              catcher=catcher,rms_factor=o['final_rmsfactor'])
-        external_mask='external_mask_ext-deep.fits'
-        if os.path.isfile(external_mask):
-            warn('Deep external mask already exists, skipping creation')
-        else:
-            report('Make deep external mask')
-            make_external_mask(external_mask,'image_full_ampphase_di.app.restored.fits',use_tgss=True,clobber=False,extended_use='full-mask-high.fits')
+    def run_steps():
+        # a failed step only raises, so that the steps running with it
+        # can finish; shared memory is cleaned up once they have
+        try:
+            scheduler.run()
+        except Exception as e:
+            if catcher is not None and catcher.stop:
+                raise
+            fail('Pipeline step failed: %s' % e)
+
+    # The final image writes DD_PREDICT into the MSs of full_mslist,
+    # so every other step that reads those MSs waits for its products
+    # rather than reading tables while they are being written
+    final_products=['image_full_ampphase_di_m.NS.app.restored.fits','image_full_ampphase_di_m.NS.int.restored.fits']
+
+    if o['low_psf_arcsec'] is not None:
+        add_step('low',make_low_images,(colname,CurrentDDkMSSolName,low_uvrange,low_imsize),
+                 inputs=final_products,
+                 outputs=['image_full_low_im.app.restored.fits','image_full_low_m.app.restored.fits','full-mask-low.fits','full-mask-high.fits'])
 
     # ##########################################################
     if o['exitafter'] == 'fulllow':
+        run_steps()
         warn('User specified exit after full low.')
         stop(2)
 
     # before starting the final image, run the download thread if needed
+    download_thread = None
     if o['method'] is not None:
         separator('Offset image downloads')
         report('Checking if optical catalogue download is required')
         from get_cat import get_cat, download_required
         if download_required(o['method']):
-            download_thread = threading.Thread(target=get_cat, args=(o['method'],))
+            download_thread = threading.Thread(target=get_cat, args=(o['method'],), kwargs={'jobs':o['download_jobs'],'per_host':o['download_per_host']})
             download_thread.start()
         else:
             warn('All data present, skipping download')
-            download_thread = None
 
-    # full resolution, one iter of deconvolution
-    separator("DD imaging (full resolution)")
     ddf_kw={}
     if o['final_psf_arcsec'] is not None:
         ddf_kw['beamsize']=o['final_psf_arcsec']
@@ -1635,154 +1874,50 @@ def main(o=None):
                 die('If final minor axis is supplied, position angle must be supplied too')
             ddf_kw['beamsize_minor']=o['final_psf_minor_arcsec']
             ddf_kw['beamsize_pa']=o['final_psf_pa_deg']
-    ddf_image('image_full_ampphase_di_m.NS',o['full_mslist'],
-              cleanmask=CurrentMaskName,
-              reuse_psf=False,
-              cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-              applysols='AP',majorcycles=1,robust=o['final_robust'],
-              colname=colname,use_dicomodel=True,
-              dicomodel_base=CurrentBaseDicoModelName,
-              AllowNegativeInitHMP=True,
-              peakfactor=0.001,automask=True,automask_threshold=o['thresholds'][2],
-              normalization=o['normalize'][1],uvrange=uvrange,smooth=True,
-              apply_weights=o['apply_weights'][2],use_weightspectrum=o['use_weightspectrum'],catcher=catcher,RMSFactorInitHMP=1.,
-              PredictSettings=("Clean","DD_PREDICT"),
-              **ddf_kw)
 
-    # check for the offset files
+    facet_offset_file='facet-offset.txt'
     if o['method'] is not None:
-        separator('Offset correction')
-        # have we got the catalogue?
-        if download_thread is not None and download_thread.isAlive():
-            warn('Waiting for background download thread to finish...')
-            download_thread.join()
-        # maybe the thread died, check the files are there
-        if download_required(o['method']):
-            warn('Retrying download for some or all of the catalogue')
-            try:
-                get_cat(o['method'])
-            except RuntimeError:
-                die('Failed to download catalogue with method '+o['method'])
-
-        # we should now have the catalogue, find the offsets
-        facet_offset_file='facet-offset.txt'
-        if o['restart'] and os.path.isfile(facet_offset_file):
-            warn('Offset file already exists, not running offsets.py')
-        else:
-            run('offsets.py '+' '.join(sys.argv[1:]),log=None)
+        offset_products=[facet_offset_file]
+    else:
+        offset_products=[]
+    add_step('full',make_final_image,(colname,CurrentMaskName,CurrentBaseDicoModelName,CurrentDDkMSSolName,uvrange,ddf_kw,facet_offset_file,download_thread),
+             outputs=final_products+offset_products)
 
-        # apply the offsets
-        ddf_shift('image_full_ampphase_di_m.NS',facet_offset_file,options=o,catcher=catcher)
-    
-            
-    spectral_mslist=None
+    spectral_step=None
     if o['spectral_restored']:
         import do_spectral_restored
-        separator('Spectral restored images')
-        spectral_mslist=do_spectral_restored.do_spectral_restored(colname,
-                                                  CurrentMaskName,
-                                                  CurrentBaseDicoModelName,
-                                                  CurrentDDkMSSolName,
-                                                  uvrange,
-                                                  ddf_kw,
-                                                  facet_offset_file,
-                                                  options=o,
-                                                  catcher=catcher)
+        spectral_step=add_step('spectral',do_spectral_restored.do_spectral_restored,
+                               (colname,CurrentMaskName,CurrentBaseDicoModelName,CurrentDDkMSSolName,uvrange,ddf_kw,facet_offset_file),
+                               inputs=final_products+offset_products)
 
     if o['polcubes']:
-        from do_polcubes import do_polcubes
-        separator('Stokes Q and U cubes')
-        cthreads=[]
-        flist=[]
-        cubefiles=['image_full_low_QU.cube.dirty.fits','image_full_low_QU.cube.dirty.corr.fits']
-        if o['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
-            warn('Compressed low QU cube product exists, not making new images')
-        else:
-            do_polcubes(colname,CurrentDDkMSSolName,low_uvrange,'image_full_low',ddf_kw,beamsize=o['low_psf_arcsec'],imsize=low_imsize,cellsize=o['low_cell'],robust=o['low_robust'],options=o,catcher=catcher)
+        vlow_uvrange=[o['image_uvmin'],1.6]
+        for name,imageoutname,uvr,beamsize,imsize,cellsize,robust in (
+                ('polcubes-low','image_full_low',low_uvrange,o['low_psf_arcsec'],low_imsize,o['low_cell'],o['low_robust']),
+                ('polcubes-vlow','image_full_vlow',vlow_uvrange,o['vlow_psf_arcsec'],o['vlow_imsize'],o['vlow_cell'],o['vlow_robust'])):
+            cubefiles=[imageoutname+'_QU.cube.dirty.fits',imageoutname+'_QU.cube.dirty.corr.fits']
+            add_step(name,make_polcubes,(colname,CurrentDDkMSSolName,uvr,imageoutname,ddf_kw,beamsize,imsize,cellsize,robust,cubefiles),
+                     inputs=final_products,outputs=cubefiles)
             if o['compress_polcubes']:
                 for cubefile in cubefiles:
-                    if o['restart'] and os.path.isfile(cubefile+'.fz'):
-                        warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
-                    else:
-                        report('Starting compression thread for '+cubefile)
-                        thread = threading.Thread(target=compress_fits, args=(cubefile,o['fpack_q']))
-                        thread.start()
-                        cthreads.append(thread)
-                        flist.append(cubefile)
-        cubefiles=['image_full_vlow_QU.cube.dirty.fits','image_full_vlow_QU.cube.dirty.corr.fits']
-        if o['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
-            warn('Compressed vlow QU cube product exists, not making new images')
-        else:
-            vlow_uvrange=[o['image_uvmin'],1.6]
-            do_polcubes(colname,CurrentDDkMSSolName,vlow_uvrange,'image_full_vlow',ddf_kw,beamsize=o['vlow_psf_arcsec'],imsize=o['vlow_imsize'],cellsize=o['vlow_cell'],robust=o['vlow_robust'],options=o,catcher=catcher)
-            if o['compress_polcubes']:
-                for cubefile in cubefiles:
-                    if o['restart'] and os.path.isfile(cubefile+'.fz'):
-                        warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
-                    else:
-                        report('Starting compression thread for '+cubefile)
-                        thread = threading.Thread(target=compress_fits, args=(cubefile,o['fpack_q']))
-                        thread.start()
-                        cthreads.append(thread)
-                        flist.append(cubefile)
-        
+                    scheduler.add('compress-'+cubefile,compress_cube,args=(cubefile,),kwargs={'options':o},
+                                  inputs=[cubefile],outputs=[cubefile+'.fz'])
+
+    stokesv_products=[]
     if o['stokesv']:
-        separator('Stokes V image')
-        ddf_image('image_full_low_stokesV',o['full_mslist'],
-                  cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-                  applysols='AP',stokes='IV',
-		  AllowNegativeInitHMP=True,
-                  majorcycles=0,robust=o['low_robust'],
-                  colname=colname,use_dicomodel=False,
-                  uvrange=low_uvrange,beamsize=o['low_psf_arcsec'],
-                  imsize=low_imsize,cellsize=o['low_cell'],peakfactor=0.001,
-                  smooth=True,automask=True,automask_threshold=5,normalization=o['normalize'][2],
-                  catcher=catcher)
-
-    if o['polcubes'] and o['compress_polcubes']:
-        # cthreads and flist exist
-        for thread in cthreads:
-            if thread.isAlive():
-                warn('Waiting for a compression thread to finish')
-                thread.join()
-        if o['delete_compressed']:
-            for f in flist:
-                warn('Deleting compressed file %s' % f)
-                os.remove(f)
+        stokesv_products=['image_full_low_stokesV.dirty.corr.fits']
+        add_step('stokesv',make_stokesv,(colname,CurrentDDkMSSolName,low_uvrange,low_imsize),
+                 inputs=final_products,outputs=stokesv_products)
 
     if o['do_dynspec']:
-        separator('Dynamic spectra')
+        add_step('dynspec',make_dynspec,(colname,CurrentDDkMSSolName),
+                 inputs=final_products+offset_products+stokesv_products)
 
-        if o['bright_threshold'] is not None and o['method'] is not None:
-            warn('Finding bright sources from offsets list')
-            from find_bright_offset_sources import find_bright
-            find_bright(cutoff=o['bright_threshold'])
-        
-        LastImage="image_full_ampphase_di_m.NS.int.restored.fits"
-        m=MSList(o['full_mslist'])
-        uobsid = set(m.obsids)
-    
-        for obsid in uobsid:
-            LastImageI="image_full_ampphase_di_m.NS.int.restored.fits"
-            LastImageV="image_full_low_stokesV.dirty.corr.fits"
-            warn('Running ms2dynspec for obsid %s' % obsid)
-            umslist='mslist-%s.txt' % obsid
-            print 'Writing temporary ms list',umslist
-            with open(umslist,'w') as file:
-                for ms,ob in zip(m.mss,m.obsids):
-                    if ob==obsid:
-                        file.write(ms+'\n')
-
-            g=glob.glob('DynSpec*'+obsid+'*')
-            if len(g)>0:
-                warn('DynSpecs results directory %s already exists, skipping DynSpecs' % g[0])
-            else:
-                runcommand="ms2dynspec.py --ms %s --data %s --model DD_PREDICT --sols %s --rad 2. --imageI %s --imageV %s --LogBoring %i --SolsDir %s --BeamModel LOFAR --BeamNBand 1"%(umslist,colname,CurrentDDkMSSolName,LastImageI,LastImageV,o['nobar'],o["SolsDir"])
-                if o['bright_threshold'] is not None:
-                    runcommand+=' --srclist brightlist.csv'
-                run(runcommand,dryrun=o['dryrun'],log=logfilename('ms2dynspec.log'),quiet=o['quiet'])
-                if use_database():
-                    ingest_dynspec(obsid)
+    run_steps()
+
+    spectral_mslist=None
+    if spectral_step is not None:
+        spectral_mslist=spectral_step.result
 
     if o['compress_ms']:
         separator('Compressing MS for archive')
@@ -1799,6 +1934,10 @@ def main(o=None):
         if o['polcubes']:
             extras+=glob.glob('stokes-mslist*.txt')
         full_clearcache(o,extras=extras)
+        try:
+            rmtglob(find_cache_dir(o)+'/step-*')
+        except OSError:
+            pass
     
     if use_database():
         update_status(None,'Complete',time='end_date',av=4)
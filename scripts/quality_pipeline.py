@@ -15,7 +15,8 @@ try:
     import bdsf as bdsm
 except ImportError:
     import lofar.bdsm as bdsm
-from auxcodes import report,get_rms,warn,die,sepn,get_centpos
+from auxcodes import report,warn,die,sepn,get_centpos
+from noise import get_rms
 import numpy as np
 from crossmatch_utils import match_catalogues,filter_catalogue,select_isolated_sources,bootstrap
 from quality_make_plots import plot_flux_ratios,plot_flux_errors,plot_position_offset
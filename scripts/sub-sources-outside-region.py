@@ -8,6 +8,7 @@ from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.io import ascii
 import glob
+from solfiles import get_solutions_timerange
 
 # NOTE, applybeam NDPPP step does not work on phase-shifted data, do not use it.
 
@@ -49,11 +50,6 @@ def number_of_unique_obsids(msfiles):
     return len(np.unique(obsids))
 
 
-def get_solutions_timerange(sols):
-    t = np.load(sols)['BeamTimes']
-    return np.min(t),np.max(t)
-
-
 def fixsymlinks():
     # Code from Tim for fixing symbolic links for DDS3_
     #dds3smoothed = glob.glob('SOLSDIR/*/*killMS.DDS3_full_smoothed*npz')
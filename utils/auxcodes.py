@@ -1,12 +1,14 @@
 import numpy as np
 from scipy.optimize import leastsq
 import scipy
+import scipy.ndimage
 import os,sys
-from pipeline_logging import run_log
-from subprocess import call
+from pipeline_logging import run_log,run_timed
+from noise import get_rms,get_rms_array
 from astropy.io import fits
 from astropy.wcs import WCS
 import signal
+import threading
 from facet_offsets import RegPoly
 import pyregion
 from surveys_db import use_database,update_status
@@ -29,12 +31,26 @@ def separator(s):
     print
 
     
+def in_main_thread():
+    return isinstance(threading.current_thread(),threading._MainThread)
+
 def die(s,database=True):
     print bcolors.FAIL+s+bcolors.ENDC
-    if database and use_database():
+    # in a worker thread (e.g. a scheduled step) other work may still
+    # be running, so the main thread records the failure once it has
+    # stopped
+    if database and use_database() and in_main_thread():
         update_status(None,'Failed')
     raise Exception(s)
 
+def fail(s):
+    # in the main thread, clean up shared memory and die; in a worker
+    # thread just raise, since cleaning up would kill the DDF or kMS
+    # processes running alongside it
+    if in_main_thread():
+        os.system('CleanSHM.py')
+    die(s)
+
 def report(s):
     print bcolors.OKGREEN+s+bcolors.ENDC
 
@@ -46,36 +62,15 @@ def run(s,proceed=False,dryrun=False,log=None,quiet=False):
     if not dryrun:
 #      retval=os.system(s)
         if log is None:
-            retval=call(s,shell=True)
+            retval=run_timed(s)
         else:
             retval=run_log(s,log,quiet)
         if not(proceed) and retval!=0:
-           os.system('CleanSHM.py')
-           die('FAILED to run '+s+': return value is '+str(retval))
+           fail('FAILED to run '+s+': return value is '+str(retval))
         return retval
     else:
         warn('Dry run, skipping this step')
 
-def get_rms(hdu,boxsize=1000,niter=20,eps=1e-6,verbose=False):
-
-    data=hdu[0].data
-    if len(data.shape)==4:
-        _,_,ys,xs=data.shape
-        subim=data[0,0,ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
-    else:
-        ys,xs=data.shape
-        subim=data[ys/2-boxsize/2:ys/2+boxsize/2,xs/2-boxsize/2:xs/2+boxsize/2].flatten()
-    subim=subim[~np.isnan(subim)]
-    oldrms=1
-    for i in range(niter):
-        rms=np.std(subim)
-        if verbose: print len(subim),rms
-        if np.abs(oldrms-rms)/rms < eps:
-            return rms
-        subim=subim[np.abs(subim)<5*rms]
-        oldrms=rms
-    raise Exception('Failed to converge')
-
 def flatten(f):
     """ Flatten a fits file so that it becomes a 2D image. Return new header and data """
 
@@ -170,20 +165,6 @@ def fit_gaussian_histogram(pixelvals,plotting):
     
     return (x[3]*abs(cellsizes[1]-cellsizes[0]))
 
-def get_rms_array(subim,size=500000,niter=25,eps=1e-6,verbose=False):
-    oldrms=1
-    if len(subim)>size:
-        subim=np.random.choice(subim,size,replace=False)
-    for i in range(niter):
-        rms=np.std(subim)
-        if verbose: print len(subim),rms
-        if np.abs(oldrms-rms)/rms < eps:
-            return rms
-        subim=subim[np.abs(subim)<5*rms]
-        oldrms=rms
-    print 'Warning -- failed to converge!',rms,oldrms
-    return rms
-
 def polylist_to_string(poly):
     polystring='polygon('
     for j in range(0,len(poly)):
@@ -207,19 +188,32 @@ def convert_regionfile_to_poly(inregfile):
         polystringlist.append(polystring[:-1])
     return polystringlist
 
+def facet_directions(ds9region,header):
+    # label image giving the direction number of each pixel (-1
+    # outside all facets), numbering the directions in the same order
+    # as convert_regionfile_to_poly, and the number of directions
+    from facet_offsets import facet_label_image
+    cra,cdec=get_centpos()
+    r=RegPoly(ds9region,cra,cdec)
+    plab=sorted(list(set(r.plab_int)))
+    lookup=np.array([plab.index(p) for p in r.plab_int]+[-1],dtype=np.int16)
+    # polygon -1 (outside) picks up the last entry of lookup
+    return lookup[facet_label_image(ds9region,header,cra,cdec)],len(plab)
+
 def get_rms_map(infilename,ds9region,outfilename):
 
-    polylist = convert_regionfile_to_poly(ds9region)
     hdu=fits.open(infilename)
     hduflat = flatten(hdu)
-    map=hdu[0].data
-
-    for direction,ds9region in enumerate(polylist):
-        print direction,ds9region
-        r = pyregion.parse(ds9region)
-        manualmask = r.get_mask(hdu=hduflat)
-        rmsval = get_rms_array(hdu[0].data[0][0][np.where(manualmask == True)])
-        hdu[0].data[0][0][np.where(manualmask == True)] = rmsval
+    directions,ndir=facet_directions(ds9region,hduflat.header)
+    plane=hdu[0].data[0][0]
+    slices=scipy.ndimage.find_objects(directions+1,ndir)
+
+    for direction in range(ndir):
+        if slices[direction] is None:
+            continue
+        region=directions[slices[direction]]==direction
+        rmsval = get_rms_array(plane[slices[direction]][region])
+        plane[slices[direction]][region] = rmsval
         print 'RMS = %s for direction %i'%(rmsval,direction)
     hdu.writeto(outfilename,clobber=True)
 
@@ -230,18 +224,18 @@ def get_rms_map2(infilename,ds9region,outfilename):
     run(runcommand,log=None)
 
     infilename = '%s.noise.fits'%infilename
-    polylist = convert_regionfile_to_poly(ds9region)
     hdu=fits.open(infilename)
     hduflat = flatten(hdu)
-    map=hdu[0].data
-
-    for direction,ds9region in enumerate(polylist):
-        print direction,ds9region
-        r = pyregion.parse(ds9region)
-        manualmask = r.get_mask(hdu=hduflat)
-        rmsval = np.mean(hdu[0].data[0][0][np.where(manualmask == True)])
-        hdu[0].data[0][0][np.where(manualmask == True)] = rmsval
-        print 'RMS = %s for direction %i'%(rmsval,direction)
+    directions,ndir=facet_directions(ds9region,hduflat.header)
+    plane=hdu[0].data[0][0]
+
+    # mean of each facet in one pass
+    inside=directions>=0
+    counts=np.bincount(directions[inside],minlength=ndir)
+    sums=np.bincount(directions[inside],weights=plane[inside],minlength=ndir)
+    for direction in range(ndir):
+        print 'RMS = %s for direction %i'%(sums[direction]/counts[direction],direction)
+    plane[inside]=(sums/counts)[directions[inside]]
     hdu.writeto(outfilename,clobber=True)
     
 class dotdict(dict):
@@ -300,7 +294,7 @@ class MSList(object):
         """
         mslist is the MS list filename
         """
-        import pyrap.tables as pt
+        from ms_metadata import get_metadata,chan_freq
         if mss is not None:
             self.mss=mss
             self.mslist=None
@@ -308,20 +302,11 @@ class MSList(object):
             self.mslist=mslist
             self.mss=[s.strip() for s in open(mslist).readlines()]
         self.obsids = [os.path.basename(ms).split('_')[0] for ms in self.mss]
-        self.freqs=[]
-        self.channels=[]
-        self.hascorrected=[]
-        self.dysco=[]
-        for ms in self.mss:
-            t = pt.table(ms,readonly=True,ack=False)
-            colname='CORRECTED_DATA'
-            try:
-                dummy=t.getcoldesc(colname)
-            except RuntimeError:
-                dummy=None
-            self.hascorrected.append(not(dummy is None))
-            self.dysco.append('Dysco' in t.showstructure())
-            t.close()
-            t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-            self.freqs.append(t[0]['REF_FREQUENCY'])
-            self.channels.append(t[0]['CHAN_FREQ'])
+        self.metadata=get_metadata(self.mss)
+        for ms,meta in zip(self.mss,self.metadata):
+            if meta is None:
+                raise RuntimeError('Failed to open table '+ms)
+        self.freqs=[meta['ref_frequency'] for meta in self.metadata]
+        self.channels=[chan_freq(meta) for meta in self.metadata]
+        self.hascorrected=[meta['hascorrected'] for meta in self.metadata]
+        self.dysco=[meta['dysco'] for meta in self.metadata]
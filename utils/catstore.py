@@ -0,0 +1,147 @@
+# Store of the downloaded comparison catalogues used for the
+# astrometric offsets. Each downloaded tile or PanSTARRS HEALPix pixel
+# is converted once to an npy file of float64 (ra,dec) rows in
+# <method>/store, with an index recording the file it came from, so
+# that merging the catalogue is a concatenation of memory-mapped arrays
+# rather than a parse of every VOTable or text file.
+
+import os
+import glob
+import json
+import numpy as np
+
+store_dir='store'
+index_name='index.json'
+
+def column_names(method):
+    # RA and DEC column names in the downloaded tiles
+    if 'panstarrs' in method:
+        return 'ramean','decmean'
+    return 'ra','dec'
+
+def store_path(method):
+    return os.path.join(method,store_dir)
+
+def load_index(method):
+    filename=os.path.join(store_path(method),index_name)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+def save_index(method,index):
+    filename=os.path.join(store_path(method),index_name)
+    tmpname=filename+'.tmp.%i' % os.getpid()
+    with open(tmpname,'w') as f:
+        json.dump(index,f,sort_keys=True)
+    os.rename(tmpname,filename)
+
+def is_current(entry,source):
+    st=os.stat(source)
+    return entry.get('size')==st.st_size and entry.get('mtime')==st.st_mtime
+
+def add_tile(method,key,ra,dec,source,index):
+    """
+    Store the positions from one tile under key, recording the source
+    file in index (which the caller saves)
+    """
+    path=store_path(method)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    a=np.empty((len(ra),2))
+    a[:,0]=ra
+    a[:,1]=dec
+    filename=os.path.join(path,key+'.npy')
+    tmpname=filename+'.tmp.%i' % os.getpid()
+    with open(tmpname,'wb') as f:
+        np.save(f,a)
+    os.rename(tmpname,filename)
+    st=os.stat(source)
+    index[key]={'file':key+'.npy','nrows':len(a),'source':os.path.abspath(source),
+                'size':st.st_size,'mtime':st.st_mtime}
+
+def read_vo(filename,rastr,decstr):
+    from astropy.table import Table
+    try:
+        t=Table.read(filename)
+    except:
+        print 'Error reading table',filename
+        raise
+    return np.array(t[rastr],dtype=np.float64),np.array(t[decstr],dtype=np.float64)
+
+def read_healpix_text(filename):
+    # PanSTARRS HEALPix pixel files have RA DEC ObjID on each line
+    a=np.loadtxt(filename,usecols=(0,1),ndmin=2)
+    return a[:,0],a[:,1]
+
+def update_store(method,rastr='ra',decstr='dec'):
+    """
+    Add any VOTable tiles in the method directory that are missing
+    from the store or have changed since they were stored
+    """
+    index=load_index(method)
+    changed=False
+    for f in sorted(glob.glob(method+'/*.vo')):
+        key=os.path.basename(f)[:-3]
+        if key in index and is_current(index[key],f):
+            continue
+        ra,dec=read_vo(f,rastr,decstr)
+        add_tile(method,key,ra,dec,f,index)
+        changed=True
+    if changed:
+        save_index(method,index)
+    return index
+
+def healpix_key(pixel):
+    return 'hp-%i' % pixel
+
+def add_healpix_pixels(method,pixelfiles):
+    """
+    Add HEALPix pixel files, given as a dictionary of pixel number and
+    file name, that are missing from the store
+    """
+    index=load_index(method)
+    for pixel in sorted(pixelfiles):
+        pixelfile=pixelfiles[pixel]
+        if not os.path.isfile(pixelfile):
+            raise RuntimeError('Pixel file '+pixelfile+' does not exist')
+        key=healpix_key(pixel)
+        if key in index and is_current(index[key],pixelfile):
+            continue
+        print 'Storing pixel',pixel
+        ra,dec=read_healpix_text(pixelfile)
+        add_tile(method,key,ra,dec,pixelfile,index)
+        save_index(method,index)
+    return index
+
+def unique_positions(ra,dec):
+    # remove duplicate positions, e.g. from overlapping tiles, leaving
+    # them sorted by ra and then dec as astropy's unique() does
+    order=np.lexsort((dec,ra))
+    ra=ra[order]
+    dec=dec[order]
+    keep=np.ones(len(ra),dtype=bool)
+    keep[1:]=(ra[1:]!=ra[:-1]) | (dec[1:]!=dec[:-1])
+    return ra[keep],dec[keep]
+
+def merge_store(method,keys=None):
+    """
+    Return a table of the unique positions in the stored tiles given
+    by keys, or all of them
+    """
+    from astropy.table import Table
+    index=load_index(method)
+    if keys is None:
+        keys=sorted(index)
+    arrays=[np.load(os.path.join(store_path(method),index[k]['file']),mmap_mode='r') for k in keys]
+    if len(arrays)==0:
+        raise RuntimeError('No stored catalogue tiles for '+method)
+    a=np.concatenate(arrays)
+    ra,dec=unique_positions(a[:,0],a[:,1])
+    t=Table()
+    t['ra']=ra
+    t['dec']=dec
+    return t
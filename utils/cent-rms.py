@@ -4,7 +4,7 @@
 
 import numpy as np
 from astropy.io import fits
-from auxcodes import get_rms
+from noise import get_rms
 
 if __name__=='__main__':
     import sys
@@ -19,7 +19,54 @@ def filter_catalogue(t,c_ra,c_dec,radius):
     r=separation(c_ra,c_dec,t['RA'],t['DEC'])
     return t[r<radius]
 
-def select_isolated_sources(t,radius):
+def radec_to_xyz(ra,dec):
+    # unit vectors for positions in degrees, for spatial indexing
+    ra=np.asarray(ra,dtype=float)*np.pi/180.0
+    dec=np.asarray(dec,dtype=float)*np.pi/180.0
+    return np.array([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)]).T
+
+def chord(radius):
+    # chord length on the unit sphere for an angle in arcsec
+    return 2.0*np.sin(radius*np.pi/(180.0*3600.0)/2.0)
+
+def source_tree(t):
+    # spatial index of the positions in table t, in row order
+    from scipy.spatial import cKDTree
+    return cKDTree(radec_to_xyz(t['RA'],t['DEC']))
+
+def nearest_neighbour_distances(t,tree=None,k=8):
+    # distance in arcsec from each source in t to its nearest
+    # neighbour, measured with separation(). tree, if given, is
+    # source_tree(t). The tree gives true angular neighbours, which
+    # can be ordered slightly differently by separation(), so the
+    # minimum is taken over the k closest
+    ra=np.array(t['RA'])
+    dec=np.array(t['DEC'])
+    n=len(t)
+    if n<2:
+        return np.inf*np.ones(n)
+    if tree is None:
+        tree=source_tree(t)
+    k=min(k,n)
+    _,idx=tree.query(radec_to_xyz(ra,dec),k=k)
+    dist=separation(ra[:,None],dec[:,None],ra[idx],dec[idx])
+    # exclude the source itself, but not other sources at the same
+    # position
+    dist[idx==np.arange(n)[:,None]]=np.inf
+    return 3600.0*np.min(dist,axis=1)
+
+def select_isolated_sources(t,radius,return_tree=False):
+    # keep sources with no neighbour within radius arcsec. If
+    # return_tree, also return a spatial index of the selected sources
+    # that can be passed to match_catalogues
+    t['NN_dist']=nearest_neighbour_distances(t)
+    t=t[t['NN_dist']>radius]
+    if return_tree:
+        return t,source_tree(t)
+    return t
+
+def select_isolated_sources_loop(t,radius):
+    # the original version, kept for comparison
     t['NN_dist']=np.nan
     for r in t:
         dist=3600.0*separation(r['RA'],r['DEC'],t['RA'],t['DEC'])
@@ -30,11 +77,38 @@ def select_isolated_sources(t,radius):
     t=t[t['NN_dist']>radius]
     return t
 
-def match_catalogues(t,tab,radius,label,group=None):
+def candidate_pairs(ra1,dec1,ra2,dec2,radius,tree1=None,margin=2.0):
+    # all pairs (i,j) of positions in the two lists within radius
+    # arcsec of each other, plus some further away: the tree is
+    # searched out to margin times the radius so that any pair that is
+    # a match with the flat-sky separation() is included. tree1, if
+    # given, is an existing tree of the first list, which is then
+    # searched instead of building one for the second
+    from scipy.spatial import cKDTree
+    if len(ra1)==0 or len(ra2)==0:
+        return np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+    if tree1 is None:
+        tree=cKDTree(radec_to_xyz(ra2,dec2))
+        found=tree.query_ball_point(radec_to_xyz(ra1,dec1),chord(margin*radius))
+    else:
+        found=tree1.query_ball_point(radec_to_xyz(ra2,dec2),chord(margin*radius))
+    counts=np.array([len(f) for f in found],dtype=int)
+    q=np.repeat(np.arange(len(found)),counts)
+    if counts.sum()==0:
+        f=np.zeros(0,dtype=int)
+    else:
+        f=np.concatenate([f for f in found if len(f)]).astype(int)
+    if tree1 is None:
+        return q,f
+    return f,q
+
+def match_catalogues(t,tab,radius,label,group=None,tree=None):
     # a replacement for STILTS
     # t is the original catalogue to which we append results from tab labelled by label
     # group is a label which is used in bootstrap: if set then t['g_count_'+str(label)]
     # must exist
+    # tree is an optional spatial index of t from source_tree() or
+    # select_isolated_sources()
 
     oldv=['Total_flux','E_Total_flux','Peak_flux','E_Peak_flux','RA','DEC']
     newv=['_'+s for s in oldv]
@@ -48,6 +122,49 @@ def match_catalogues(t,tab,radius,label,group=None):
     maxdec=np.max(t['DEC']+rdeg)
     # pre-filter tab, which may be all-sky
     tab=tab[(tab['RA']>minra) & (tab['RA']<maxra) & (tab['DEC']>mindec) & (tab['DEC']<maxdec)]
+
+    # find candidates with a tree, then apply the same separation
+    # test as before to them
+    ra=np.array(t['RA'])
+    dec=np.array(t['DEC'])
+    tra=np.array(tab['RA'])
+    tdec=np.array(tab['DEC'])
+    i,j=candidate_pairs(ra,dec,tra,tdec,radius,tree1=tree)
+    dist=3600.0*separation(ra[i],dec[i],tra[j],tdec[j])
+    close=dist<radius
+    i=i[close]
+    j=j[close]
+    dist=dist[close]
+    # only a unique match counts
+    unique=np.bincount(i,minlength=len(t))[i]==1
+    i=i[unique]
+    j=j[unique]
+    dist=dist[unique]
+
+    for k in range(len(oldv)):
+        if oldv[k] in tab.colnames:
+            t[label+newv[k]][i]=np.array(tab[oldv[k]])[j]
+    t[label+'_separation'][i]=dist
+    t[label+'_dRA'][i]=3600.0*np.cos(np.pi*dec[i]/180.0)*(ra[i]-tra[j])
+    t[label+'_dDEC'][i]=3600.0*(dec[i]-tdec[j])
+    if group is not None:
+        t['g_count_'+str(group)][i]+=1
+
+    return len(i)
+
+def match_catalogues_loop(t,tab,radius,label,group=None):
+    # the original row-by-row version, kept for comparison
+    oldv=['Total_flux','E_Total_flux','Peak_flux','E_Peak_flux','RA','DEC']
+    newv=['_'+s for s in oldv]
+    blankv=['_separation','_dRA','_dDEC']
+    for s in newv+blankv:
+        t[label+s]=np.nan
+    rdeg=radius/3600.0
+    minra=np.min(t['RA']-rdeg)
+    maxra=np.max(t['RA']+rdeg)
+    mindec=np.min(t['DEC']-rdeg)
+    maxdec=np.max(t['DEC']+rdeg)
+    tab=tab[(tab['RA']>minra) & (tab['RA']<maxra) & (tab['DEC']>mindec) & (tab['DEC']<maxdec)]
     matches=0
     for r in t:
         dist=3600.0*separation(r['RA'],r['DEC'],tab['RA'],tab['DEC'])
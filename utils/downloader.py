@@ -0,0 +1,201 @@
+# Run a set of downloads concurrently. Each download is a function
+# that fetches one file and writes it in place; the scheduler runs
+# them in a thread pool, limits the number running against any one
+# server, and retries failures with exponential backoff. Downloads
+# write to a temporary file that is renamed when complete, so an
+# interrupted run can be resumed by skipping the files that exist.
+
+import os
+import random
+import threading
+import traceback
+from time import sleep
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+class RetryDownload(Exception):
+    # raised by a download function for a failure worth retrying,
+    # e.g. a bad or incomplete response
+    pass
+
+def backoff_time(count,base=5.0,maximum=600.0):
+    # exponential backoff with some jitter so that retries of
+    # downloads that failed together don't all hit the server at once
+    return min(maximum,base*2**count)*random.uniform(0.5,1.0)
+
+def temporary_name(filename):
+    # name to download to before renaming to filename
+    return filename+'.part.%i.%i' % (os.getpid(),threading.current_thread().ident)
+
+def write_atomic(filename,data,mode='w'):
+    tmpname=temporary_name(filename)
+    with open(tmpname,mode) as f:
+        f.write(data)
+    os.rename(tmpname,filename)
+
+class DownloadScheduler(object):
+    def __init__(self,jobs=4,per_host=2,retries=100,backoff=5.0,max_backoff=600.0,retry_on=(),sleep=sleep):
+        # retry_on is a tuple of further exception types (e.g. timeouts
+        # from requests) that should be retried
+        self.jobs=jobs
+        self.per_host=per_host
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+        self.retry_on=(RetryDownload,)+tuple(retry_on)
+        self.sleep=sleep
+        self.tasks=[]
+        self.hosts={}
+        self.lock=threading.Lock()
+
+    def add(self,url,function,outfile,label=None):
+        """
+        Schedule function() to download url to outfile, unless outfile
+        already exists. The url is used for the per-server limit
+        """
+        if os.path.isfile(outfile):
+            print 'File',outfile,'already present'
+            return
+        self.tasks.append((url,function,outfile,label or outfile))
+
+    def host_semaphore(self,url):
+        host=urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host]=threading.Semaphore(self.per_host)
+            return self.hosts[host]
+
+    def run_task(self,task):
+        url,function,outfile,label=task
+        semaphore=self.host_semaphore(url)
+        count=0
+        while True:
+            # the server slot is released while waiting to retry
+            with semaphore:
+                try:
+                    print 'Downloading',label
+                    function()
+                except self.retry_on as e:
+                    error=e
+                else:
+                    print 'Downloaded',label
+                    return None
+            count+=1
+            if count>=self.retries:
+                return 'Number of retries exceeded for %s (%s)' % (label,error)
+            delay=backoff_time(count-1,self.backoff,self.max_backoff)
+            print 'Download of %s failed (%s), retry %i in %.0f seconds' % (label,error,count,delay)
+            self.sleep(delay)
+
+    def run_task_safe(self,task):
+        try:
+            return self.run_task(task)
+        except Exception as e:
+            traceback.print_exc()
+            return 'Failed to download %s (%s)' % (task[3],e)
+
+    def run(self):
+        """
+        Run all the scheduled downloads. All of them are attempted; if
+        any fail, a RuntimeError listing them is raised at the end
+        """
+        if len(self.tasks)==0:
+            return
+        jobs=max(1,min(self.jobs,len(self.tasks)))
+        pool=ThreadPool(jobs)
+        try:
+            results=pool.map(self.run_task_safe,self.tasks)
+        finally:
+            pool.close()
+            pool.join()
+        self.tasks=[]
+        failed=[r for r in results if r is not None]
+        if failed:
+            raise RuntimeError('%i downloads failed: %s' % (len(failed),'; '.join(failed)))
+
+def test_server(fail_fraction=0.3,delay=0.2,port=0):
+    """
+    Start a local HTTP server standing in for a catalogue server: it
+    fails a random fraction of requests and records the largest number
+    of requests it was serving at once. Returns the server and its URL
+    """
+    from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
+    from SocketServer import ThreadingMixIn
+    import time
+
+    class Server(ThreadingMixIn,HTTPServer):
+        daemon_threads=True
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self):
+            with server.lock:
+                server.active+=1
+                server.max_active=max(server.max_active,server.active)
+                server.requests+=1
+            try:
+                time.sleep(delay)
+                if random.random()<fail_fraction:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body='ra dec %s\n' % self.path
+                self.send_response(200)
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                with server.lock:
+                    server.active-=1
+        do_GET=reply
+        do_POST=reply
+        def log_message(self,*args):
+            pass
+
+    server=Server(('127.0.0.1',port),Handler)
+    server.lock=threading.Lock()
+    server.active=0
+    server.max_active=0
+    server.requests=0
+    t=threading.Thread(target=server.serve_forever)
+    t.daemon=True
+    t.start()
+    return server,'http://127.0.0.1:%i' % server.server_address[1]
+
+if __name__=='__main__':
+    # Self-test against a local stand-in server: python downloader.py
+    import requests
+    import shutil
+    import tempfile
+    server,url=test_server()
+    workdir=tempfile.mkdtemp()
+
+    def fetch(u,outfile):
+        def function():
+            r=requests.get(u,timeout=10)
+            if r.status_code!=200:
+                raise RetryDownload('code %i' % r.status_code)
+            write_atomic(outfile,r.text)
+        return function
+
+    try:
+        for per_host in [1,3]:
+            s=DownloadScheduler(jobs=8,per_host=per_host,backoff=0.05,max_backoff=0.2,retry_on=(requests.exceptions.RequestException,))
+            for i in range(20):
+                outfile=os.path.join(workdir,'tile-%i-%i' % (per_host,i))
+                s.add(url+'/tile/%i' % i,fetch(url+'/tile/%i' % i,outfile),outfile)
+            server.max_active=0
+            server.requests=0
+            s.run()
+            ok=all(open(os.path.join(workdir,'tile-%i-%i' % (per_host,i))).read()=='ra dec /tile/%i\n' % i for i in range(20))
+            print 'per_host=%i: %i requests, at most %i at once, all files correct: %s' % (per_host,server.requests,server.max_active,ok)
+            assert ok and server.max_active<=per_host
+            # a second run finds everything present and does nothing
+            for i in range(20):
+                outfile=os.path.join(workdir,'tile-%i-%i' % (per_host,i))
+                s.add(url+'/tile/%i' % i,fetch(url+'/tile/%i' % i,outfile),outfile)
+            assert len(s.tasks)==0
+        assert not [f for f in os.listdir(workdir) if '.part.' in f]
+        print 'Downloader self-test passed'
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
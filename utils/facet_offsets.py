@@ -126,13 +126,27 @@ class RegPoly(object):
         else:
             dra=ra
             ddec=dec
-        check=((dra>=self.bbox[:,0]) & (dra<=self.bbox[:,1]) & (ddec>=self.bbox[:,2]) & (ddec<=self.bbox[:,3]))
+        i=int(self.which_polys(np.array([dra]),np.array([ddec]))[0])
+        if i<0:
+            return None
+        return i
+
+    def which_polys(self,dra,ddec):
+        ''' Return the index of the first polygon containing each of
+        the points given by the arrays of offset co-ordinates dra,ddec,
+        or -1 for points outside all of them '''
+        from matplotlib.path import Path
+        dra=np.asarray(dra,dtype=float)
+        ddec=np.asarray(ddec,dtype=float)
+        result=-np.ones(len(dra),dtype=int)
         for i,poly in enumerate(self.clist):
-            if not check[i]:
+            check=((result<0) & (dra>=self.bbox[i,0]) & (dra<=self.bbox[i,1]) & (ddec>=self.bbox[i,2]) & (ddec<=self.bbox[i,3]))
+            idx=np.flatnonzero(check)
+            if len(idx)==0:
                 continue
-            if point_inside_polygon(dra,ddec,poly):
-                return i
-        return None
+            inside=Path(np.array(poly)).contains_points(np.array([dra[idx],ddec[idx]]).T)
+            result[idx[inside]]=i
+        return result
 
     def labels_to_integers(self):
         plab_int=[]
@@ -145,16 +159,9 @@ class RegPoly(object):
 
     def add_facet_labels(self,t):
         ''' Add integer labels to an astropy table t '''
-        facets=[]
         dra,ddec=self.coordconv(np.array(t['RA']),np.array(t['DEC']))[1] # strip units
-        
-        for i in range(len(t)):
-            poly=self.which_poly(dra[i],ddec[i],convert=False)
-            if poly is not None:
-                facets.append(self.plab_int[poly])
-            else:
-                facets.append(-1)
-        t['Facet']=facets
+        poly=self.which_polys(dra,ddec)
+        t['Facet']=np.where(poly>=0,np.array(self.plab_int)[poly],-1)
         return t
         
 def plot_offsets(t,poly,color):
@@ -204,6 +211,55 @@ def label_table(t,regfile,cra,cdec):
     r.add_facet_labels(t)
     return t
 
+def polygon_label_image(r,header,maxpix=1000000):
+    ''' Return an int16 image on the celestial grid of header giving
+    the index in r.oclist of the polygon containing each pixel centre,
+    or -1 for pixels outside all the polygons '''
+    from astropy.wcs import WCS
+    from matplotlib.path import Path
+    w=WCS(header).celestial
+    ny,nx=header['NAXIS2'],header['NAXIS1']
+    labels=-np.ones((ny,nx),dtype=np.int16)
+    for i,poly in enumerate(r.oclist):
+        a=np.array(poly)
+        x,y=w.wcs_world2pix(a[:,0],a[:,1],0)
+        path=Path(np.array([x,y]).T)
+        xmin=max(0,int(np.floor(np.min(x))))
+        xmax=min(nx,int(np.ceil(np.max(x)))+1)
+        ymin=max(0,int(np.floor(np.min(y))))
+        ymax=min(ny,int(np.ceil(np.max(y)))+1)
+        if xmin>=xmax or ymin>=ymax:
+            continue
+        xs=np.arange(xmin,xmax)
+        step=max(1,maxpix/len(xs))
+        for y0 in range(ymin,ymax,step):
+            ys=np.arange(y0,min(y0+step,ymax))
+            X,Y=np.meshgrid(xs,ys)
+            inside=path.contains_points(np.array([X.flatten(),Y.flatten()]).T).reshape(X.shape)
+            labels[y0:y0+len(ys),xmin:xmax][inside]=i
+    return labels
+
+def facet_label_image(regfile,header,cra,cdec):
+    ''' Polygon label image for the region file regfile on the grid
+    of header, cached next to the region file. The cache name depends on
+    the grid and on the region file, so different grids get different
+    files and a changed region file is not reused '''
+    import os
+    import hashlib
+    from astropy.wcs import WCS
+    st=os.stat(regfile)
+    # the whole celestial WCS (including PC/CD, projection parameters
+    # and the reference frame) and the image shape define the grid
+    key=[st.st_size,st.st_mtime,cra,cdec,header['NAXIS1'],header['NAXIS2'],
+         WCS(header).celestial.to_header_string()]
+    cachefile=regfile+'.labels-'+hashlib.sha1(repr(key)).hexdigest()[:12]+'.npz'
+    if os.path.isfile(cachefile):
+        return np.load(cachefile)['labels']
+    r=RegPoly(regfile,cra,cdec)
+    labels=polygon_label_image(r,header)
+    np.savez_compressed(cachefile,labels=labels)
+    return labels
+
 #if __name__=='__main__':
 #
 #    do_plot_facet_offsets('image_full_ampphase1m.cat.fits_FIRST_match_filtered.fits','image_full_ampphase1m.tessel.reg')
@@ -2,27 +2,18 @@
 
 # Determine scale factors by fitting polynomials to data
 
-from scipy.optimize import curve_fit
 #from astropy.table import Table
 import numpy as np
 import sys
-from fitting_factors import pl,chi2,read_frequencies_fluxes
+from fitting_factors import fit_pl,read_frequencies_fluxes
 
 def fitall(scale,frequencies,fluxes,errors,smask):
 
-    alphas=[]
-    norms=[]
-    chiv=[]
-    d,f=fluxes.shape
-    for i in range(d):
-        sf=np.copy(fluxes[i])
-        ef=np.copy(errors[i])
-        sf[smask]*=scale
-        ef[smask]*=scale
-        popt, pcov = curve_fit(pl, frequencies, sf, sigma=ef, p0=[1.0,-1],maxfev=20000)
-        chiv.append(chi2(frequencies,sf,ef,*popt))
-        alphas.append(popt[1])
-        norms.append(popt[0])
+    sf=np.copy(fluxes)
+    ef=np.copy(errors)
+    sf[:,smask]*=scale
+    ef[:,smask]*=scale
+    norms,alphas,chiv=fit_pl(frequencies,sf,ef)
     return np.array((norms,alphas,chiv))
 
 def run_all(run, name=''):
@@ -5,7 +5,7 @@ from astropy.io import fits
 import numpy as np
 from scipy.special import gammaln
 import emcee
-from auxcodes import get_rms
+from noise import get_rms
 
 def model(cbins,norm,alpha):
     return (10**norm)*ds*(cbins/fluxnorm)**(-alpha)
@@ -17,7 +17,106 @@ def pl(freq,norm,alpha):
 def chi2(freq,data,errors,norm,alpha):
     return np.sum(((data-pl(freq,norm,alpha))**2.0)/(2*errors)**2.0)
 
+def fit_pl(freq,data,errors,p0=None,niter=100,tol=1.49012e-8):
+    """
+    Weighted least-squares fit of pl() to every row of data at once,
+    giving the same solutions as running curve_fit on each row.
+    Returns arrays of norm, alpha and chi2() for each row. The fits
+    start from a weighted straight-line fit in log space, or from p0
+    (one pair per row) if given, and are refined with batched
+    Levenberg-Marquardt steps until chi^2 changes by less than tol
+    (fractionally), the default tolerance of curve_fit
+    """
+    d,f=data.shape
+    x=freq/140e6
+    lx=np.log(x)
+    w=1.0/errors**2
+    if p0 is None:
+        # straight line fit to log(data), weighted by (data/errors)**2,
+        # using only the positive data
+        pos=data>0
+        lw=np.where(pos,w*data**2,0)
+        ly=np.log(np.where(pos,data,1))
+        sw=np.sum(lw,axis=1)
+        sx=np.sum(lw*lx,axis=1)
+        sy=np.sum(lw*ly,axis=1)
+        sxx=np.sum(lw*lx*lx,axis=1)
+        sxy=np.sum(lw*lx*ly,axis=1)
+        det=sw*sxx-sx*sx
+        with np.errstate(divide='ignore',invalid='ignore'):
+            alpha=(sw*sxy-sx*sy)/det
+            norm=np.exp((sy-alpha*sx)/sw)
+        bad=(np.sum(pos,axis=1)<2) | ~np.isfinite(alpha) | ~np.isfinite(norm)
+        norm[bad]=data[bad,min(4,f-1)]
+        alpha[bad]=-0.8
+    else:
+        norm=np.array(p0[:,0],dtype=float)
+        alpha=np.array(p0[:,1],dtype=float)
+
+    cs=np.sum(w*(data-pl(freq,norm[:,None],alpha[:,None]))**2,axis=1)
+    lam=1e-3*np.ones(d)
+    # indices of the rows still being fitted
+    act=np.arange(d)
+    for i in range(niter):
+        wa=w[act]
+        da=data[act]
+        xa=x**alpha[act,None]
+        m=norm[act,None]*xa
+        r=da-m
+        # Jacobian of the model with respect to (norm,alpha)
+        j0=xa
+        j1=m*lx
+        a00=np.sum(wa*j0*j0,axis=1)
+        a01=np.sum(wa*j0*j1,axis=1)
+        a11=np.sum(wa*j1*j1,axis=1)
+        b0=np.sum(wa*j0*r,axis=1)
+        b1=np.sum(wa*j1*r,axis=1)
+        l=lam[act]
+        d00=a00*(1+l)
+        d11=a11*(1+l)
+        det=d00*d11-a01*a01
+        with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+            nnorm=norm[act]+(d11*b0-a01*b1)/det
+            nalpha=alpha[act]+(d00*b1-a01*b0)/det
+            ncs=np.sum(wa*(da-pl(freq,nnorm[:,None],nalpha[:,None]))**2,axis=1)
+        ocs=cs[act]
+        better=np.isfinite(ncs) & (ncs<=ocs)
+        ba=act[better]
+        norm[ba]=nnorm[better]
+        alpha[ba]=nalpha[better]
+        cs[ba]=ncs[better]
+        lam[act]=np.where(better,l/10.0,l*10.0)
+        # finished if the step changes chi^2 by a negligible amount,
+        # whether or not it was accepted, or if the damping is so
+        # large that nothing can change
+        done=(np.abs(ocs-ncs)<=tol*ocs) | (lam[act]>1e10)
+        act=act[~done]
+        if len(act)==0:
+            break
+    # chi2() for each row
+    chi=np.sum(((data-pl(freq,norm[:,None],alpha[:,None]))**2.0)/(2*errors)**2.0,axis=1)
+    return norm,alpha,chi
+
 def lnlike(scale,frequencies,fluxes,errors):
+    d,f=fluxes.shape
+    sf=np.copy(fluxes)
+    ef=np.copy(errors)
+    sf[:,smask]*=scale
+    ef[:,smask]*=scale
+    norm,alpha,chi=fit_pl(frequencies,sf,ef)
+    bad=~np.isfinite(chi)
+    if np.any(bad):
+        print 'Failed fits:',np.sum(bad),scale
+        chi[bad]=1e6
+    cs=np.sum(chi)
+    retval=-0.5*cs-d*np.sum(np.log(scale))
+    if np.isnan(retval):
+         return -np.inf
+    else:
+         return retval
+
+def lnlike_curve_fit(scale,frequencies,fluxes,errors):
+    # the original one-source-at-a-time version, kept for comparison
     cs=0
     d,f=fluxes.shape
     for i in range(d):
@@ -32,7 +131,6 @@ def lnlike(scale,frequencies,fluxes,errors):
         except RuntimeError:
             print 'Caught maxfev error:',scale
             cs+=1e6
-#        print i,pcov[1],chi
     retval=-0.5*cs-d*np.sum(np.log(scale))
     if np.isnan(retval):
          return -np.inf
@@ -46,7 +144,10 @@ def lnprior(X):
     return np.sum(-np.log(X))
 
 def lnpost(scale,x,y,yerr):
-    return lnprior(scale)+lnlike(scale,frequencies,fluxes,errors)
+    lp=lnprior(scale)
+    if not np.isfinite(lp):
+        return -np.inf
+    return lp+lnlike(scale,frequencies,fluxes,errors)
 
 def read_frequencies_fluxes(intable,name=''):
     lines=open(name+'frequencies.txt').readlines()
@@ -79,7 +180,8 @@ def read_frequencies_fluxes(intable,name=''):
 
     return frequencies,fluxes,errors,smask,data
 
-def run_all(run, name=''):
+def run_all(run, name='', ncpu=None):
+    # ncpu>1 evaluates the walkers in parallel with a process pool
 
     global fluxes
     global errors
@@ -104,10 +206,21 @@ def run_all(run, name=''):
         scale=[np.abs(np.random.normal(loc=1.0,scale=0.1,size=ndim))
                for i in range(nwalkers)]
 
-    # run MCMC
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost,
-                                    args=(frequencies,fluxes,errors))
-    sampler.run_mcmc(scale, 1000)
+    # run MCMC. The pool is created after the globals above are set,
+    # so the worker processes inherit them
+    if ncpu is not None and ncpu>1:
+        from multiprocessing import Pool
+        pool=Pool(min(ncpu,nwalkers))
+    else:
+        pool=None
+    try:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost,
+                                        args=(frequencies,fluxes,errors),pool=pool)
+        sampler.run_mcmc(scale, 1000)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     samples=sampler.chain[:, 400:, :].reshape((-1, ndim))
     samplest=samples.transpose()
@@ -124,5 +237,7 @@ def run_all(run, name=''):
 if __name__=='__main__':
     if len(sys.argv) == 2:
         run_all(int(sys.argv[1]))
-    else:
+    elif len(sys.argv) == 3:
         run_all(int(sys.argv[1]),name=sys.argv[2])
+    else:
+        run_all(int(sys.argv[1]),name=sys.argv[2],ncpu=int(sys.argv[3]))
@@ -5,29 +5,76 @@ import requests
 import astropy.coordinates as coord
 import astropy.units as u
 import os
-from time import sleep
 from download_file import download_file
+from downloader import DownloadScheduler,RetryDownload,write_atomic,temporary_name
+from catstore import column_names,update_store,add_healpix_pixels,load_index,healpix_key
 
 CSIZE=0.5
 PSBASE='/data/lofar/panstarrs/healpix'
+PSURL='http://archive.stsci.edu/panstarrs/search.php'
+PSHEALPIXURL='http://uhhpc.herts.ac.uk/panstarrs-healpix/'
+IRSAURL='https://irsa.ipac.caltech.edu/'
 
 def tile(file):
     return hextile(file,CSIZE*0.9)
 
+def healpix_pixels(pos):
+    # HEALPix pixels of the local PanSTARRS database covering the tiles
+    from astropy_healpix import HEALPix
+    hp = HEALPix(nside=64)
+    hplist=[]
+    for p in pos:
+        hplist += list(hp.cone_search_lonlat(p[0]*u.deg, p[1]*u.deg, radius=CSIZE*u.deg))
+    return sorted(set(hplist))
+
 def download_required(method):
-    if method=='pslocal':
-        #pslocal makes the merged file directly
-        return ~os.path.isfile(method+'/'+method+'.txt')
-            
     ra_factor,pos=tile('image_ampphase1.app.restored.fits')
 
+    if method=='pslocal':
+        # pslocal puts the pixels straight into the catalogue store
+        index=load_index(method)
+        for pixel in healpix_pixels(pos):
+            if healpix_key(pixel) not in index:
+                return True
+        return False
+
     for i,p in enumerate(pos):
         outfile=method+'/'+method+'-'+str(i)+'.vo'
         if not os.path.isfile(outfile):
             return True
     return False
 
-def get_cat(method,retries=100):
+def panstarrs_download(p,outfile,url=PSURL):
+    def function():
+        r = requests.post(url, data = {'ra':p[0],'dec':p[1],'SR':CSIZE,'max_records':100000,'nDetections':">+5",'action':'Search','selectedColumnsCsv':'objid,ramean,decmean'},timeout=300)
+        if r.status_code!=200:
+            raise RetryDownload('code %i' % r.status_code)
+        if 'Warning' in r.text or 'Please' in r.text:
+            raise RetryDownload('bad response')
+        write_atomic(outfile,r.text)
+    return function
+
+def wise_download(p,outfile):
+    def function():
+        from astroquery.irsa import Irsa
+        Irsa.ROW_LIMIT=1000000
+        t=Irsa.query_region(coord.SkyCoord(p[0],p[1],unit=(u.deg,u.deg)), catalog='allwise_p3as_psd', radius='0d30m0s')
+        tmpname=temporary_name(outfile)
+        t.write(tmpname,format='votable')
+        os.rename(tmpname,outfile)
+    return function
+
+def healpix_download(url,outfile):
+    def function():
+        tmpname=temporary_name(outfile)
+        download_file(url,tmpname)
+        os.rename(tmpname,outfile)
+    return function
+
+def get_cat(method,retries=100,jobs=4,per_host=2,psurl=PSURL,healpixurl=PSHEALPIXURL):
+    # jobs tiles are downloaded at once, at most per_host of them from
+    # any one server; psurl and healpixurl can be pointed at a
+    # stand-in server for testing
 
     cwd=os.getcwd()
     try:
@@ -35,74 +82,41 @@ def get_cat(method,retries=100):
     except OSError:
         pass
 
-    if method=='pslocal':
-        hplist=[]
-    
-    if method=='wise':
-        from astroquery.irsa import Irsa
-        Irsa.ROW_LIMIT=1000000
-
+    scheduler=DownloadScheduler(jobs=jobs,per_host=per_host,retries=retries,retry_on=(requests.exceptions.RequestException,))
     ra_factor,pos=tile(cwd+'/image_ampphase1.app.restored.fits')
     print 'Downloading catalogues for',len(pos),'sky positions'
-    for i,p in enumerate(pos):
-        outfile=method+'/'+method+'-'+str(i)+'.vo'
-        if os.path.isfile(outfile):
-            print 'Catalogue at position',p,'already present'
-            continue
-        print 'Downloading at position',p
-        if method=='panstarrs':
-            count=0
-            while True:
-                try:
-                    r = requests.post('http://archive.stsci.edu/panstarrs/search.php', data = {'ra':p[0],'dec':p[1],'SR':CSIZE,'max_records':100000,'nDetections':">+5",'action':'Search','selectedColumnsCsv':'objid,ramean,decmean'},timeout=300)
-                except requests.exceptions.Timeout:
-                    print 'Timeout, retrying!'
-                else:
-                    if 'Warning' not in r.text and 'Please' not in r.text:
-                        break
-                    else:
-                        # will go round the loop again
-                        print 'Bad response, retry download (%i)' % count
-                        sleep(5+count*15)
-                count+=1
-                if count>=retries:
-                    raise RuntimeError('Number of retries exceeded for download')
-                        
-            f=open(outfile,'w')
-            f.writelines(r.text)
-            f.close()
-        elif method=='wise':
-            t=Irsa.query_region(coord.SkyCoord(p[0],p[1],unit=(u.deg,u.deg)), catalog='allwise_p3as_psd', radius='0d30m0s')
-            t.write(outfile,format='votable')
-        elif method=='pslocal':
-            from astropy_healpix import HEALPix
-            hp = HEALPix(nside=64)
-            cs = hp.cone_search_lonlat(p[0]*u.deg, p[1]*u.deg, radius=CSIZE*u.deg)
-            hplist += list(cs)
-            if not os.path.isdir(PSBASE):
-                # we don't have a local PS database, so download
-                for pix in cs:
-                    outfile=method+'/'+str(pix)
-                    if not os.path.isfile(outfile):
-                        print 'Downloading healpix pixel',pix
-                        download_file('http://uhhpc.herts.ac.uk/panstarrs-healpix/'+str(pix),outfile)
-        else:
-            raise NotImplementedError('Method '+method)
     if method=='pslocal':
-        hplist=list(set(hplist))
+        hplist=healpix_pixels(pos)
         print 'Found',len(hplist),'unique healpix pixels'
-        outname=method+'/'+method+'.txt'
-        with open(outname,'w') as outfile:
-            outfile.write('# RA DEC ObjID\n')
+        if not os.path.isdir(PSBASE):
+            # we don't have a local PS database, so download
+            for pix in hplist:
+                outfile=method+'/'+str(pix)
+                url=healpixurl+str(pix)
+                scheduler.add(url,healpix_download(url,outfile),outfile,'healpix pixel %i' % pix)
+    else:
+        for i,p in enumerate(pos):
+            outfile=method+'/'+method+'-'+str(i)+'.vo'
+            label='catalogue at position %s' % str(p)
+            if method=='panstarrs':
+                scheduler.add(psurl,panstarrs_download(p,outfile,psurl),outfile,label)
+            elif method=='wise':
+                scheduler.add(IRSAURL,wise_download(p,outfile),outfile,label)
+            else:
+                raise NotImplementedError('Method '+method)
+    scheduler.run()
+
+    # convert what was downloaded to the catalogue store
+    if method=='pslocal':
+        pixelfiles={}
         for pixel in hplist:
-            print 'Appending pixel',pixel
             if os.path.isdir(PSBASE):
-                pixelfile=PSBASE+'/'+str(pixel)
+                pixelfiles[pixel]=PSBASE+'/'+str(pixel)
             else:
-                pixelfile=method+'/'+str(pixel)
-            if not os.path.isfile(pixelfile):
-                raise RuntimeError('Pixel file '+pixelfile+'does not exist')
-            os.system('cat '+pixelfile+' >> '+outname)
+                pixelfiles[pixel]=method+'/'+str(pixel)
+        add_healpix_pixels(method,pixelfiles)
+    else:
+        update_store(method,*column_names(method))
         
 if __name__=='__main__':
     import sys
@@ -0,0 +1,132 @@
+# Step ledger used to decide whether a pipeline step can be skipped on
+# restart. For each step we record a hash of its command line and of
+# the size and modification time of its input files, together with the
+# fingerprints of the outputs it produced. A step is only skipped if
+# all of these still match, so a change of parset or of an upstream
+# product causes a re-run, and outputs left behind by a step that
+# crashed part-way through (which never got a ledger entry) are not
+# trusted.
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+
+# command-line settings that change how a step runs but not what it
+# produces
+volatile=[r'--Parallel-NCPU[= ]\S+',r'--NCPU[= ]\S+',r'--dist-ncpu[= ]\S+',
+          r'--Cache-\S+?[= ]\S+',r'--DDFCacheDir[= ]\S+',
+          r'--Log-\S+?[= ]\S+',r'--DoBar[= ]\S+']
+
+def normalize_command(command):
+    for v in volatile:
+        command=re.sub(v,'',command)
+    return ' '.join(command.split())
+
+def fingerprint(path):
+    """
+    Return a size+mtime fingerprint for a file, or for every file in a
+    directory such as an MS. Symlinks are followed, so a link to a
+    solutions file has the fingerprint of its target.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        fp=[]
+        for root,dirs,files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                filename=os.path.join(root,f)
+                st=os.stat(filename)
+                fp.append([os.path.relpath(filename,path),st.st_size,st.st_mtime])
+        return fp
+    st=os.stat(path)
+    return [st.st_size,st.st_mtime]
+
+class StepLedger(object):
+    def __init__(self,filename='step-ledger.json'):
+        self.filename=filename
+        self.lock=threading.Lock()
+
+    def load(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        with open(self.filename) as f:
+            try:
+                return json.load(f)
+            except ValueError:
+                return {}
+
+    def digest(self,command,inputs):
+        inputs=sorted(set(i for i in inputs if i is not None))
+        key=[normalize_command(command),[(i,fingerprint(i)) for i in inputs]]
+        return hashlib.sha1(json.dumps(key,sort_keys=True)).hexdigest()
+
+    def check(self,name,command,inputs,outputs):
+        """
+        Return None if the step is up to date, otherwise a string
+        giving the reason it needs to be run
+        """
+        entry=self.load().get(name)
+        if entry is None:
+            return 'no ledger entry'
+        for f in outputs:
+            if not os.path.exists(f):
+                return 'output '+f+' is missing'
+            if entry['outputs'].get(f)!=fingerprint(f):
+                return 'output '+f+' has changed since the step completed'
+        if entry['digest']!=self.digest(command,inputs):
+            return 'command line or inputs have changed'
+        return None
+
+    def commit(self,name,command,inputs,outputs):
+        entry={'digest':self.digest(command,inputs),
+               'command':command,
+               'outputs':dict((f,fingerprint(f)) for f in outputs)}
+        with self.lock:
+            # the lock file serialises updates from other processes
+            # (e.g. bootstrap): re-read under it in case they have added
+            # entries, then replace the file in one rename
+            with open(self.filename+'.lock','a') as lockfile:
+                fcntl.flock(lockfile.fileno(),fcntl.LOCK_EX)
+                try:
+                    ledger=self.load()
+                    ledger[name]=entry
+                    tmpname=self.filename+'.tmp.%i.%i' % (os.getpid(),threading.current_thread().ident)
+                    with open(tmpname,'w') as f:
+                        json.dump(ledger,f,indent=1,sort_keys=True)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.rename(tmpname,self.filename)
+                finally:
+                    fcntl.flock(lockfile.fileno(),fcntl.LOCK_UN)
+
+ledger=StepLedger()
+
+def skip_step(options,command,inputs,outputs,name=None):
+    """
+    Decide whether a step can be skipped on restart. With the ledger
+    disabled this falls back to checking that the outputs exist.
+    """
+    if not options['restart']:
+        return False
+    if not options['ledger']:
+        return all(os.path.exists(f) for f in outputs)
+    if name is None:
+        name=outputs[0]
+    reason=ledger.check(name,command,inputs,outputs)
+    if reason is None:
+        return True
+    if any(os.path.exists(f) for f in outputs):
+        from auxcodes import warn
+        warn('Re-running step for '+name+': '+reason)
+    return False
+
+def commit_step(options,command,inputs,outputs,name=None):
+    if options['dryrun'] or not options['ledger']:
+        return
+    if name is None:
+        name=outputs[0]
+    ledger.commit(name,command,inputs,outputs)
@@ -1,11 +1,12 @@
 from astropy.io import fits
 from astropy.wcs import WCS
-from auxcodes import get_rms_map,get_rms,get_rms_map2
+from auxcodes import get_rms_map,get_rms_map2
+from noise import get_rms
 from auxcodes import flatten
+from modify_mask import catalogue_mask
 import scipy.ndimage as nd
 import numpy as np
 import pyregion
-from scipy.signal import convolve2d
 
 def add_manual_mask(infile,ds9region,outfile):
     hdu=fits.open(infile)
@@ -28,6 +29,69 @@ def merge_mask(in1,in2,outfile):
     hdu1[0].data = (map1 | map2).astype(np.float32)
     hdu1.writeto(outfile,clobber=True)
 
+def compose_mask(templatename,outfile,include_template=False,masks=None,region=None,catalogue=None):
+    """
+    Combine several mask sources on the pixel grid of templatename and
+    write the result to outfile once. The sources are the template's
+    own data (if include_template), a list of FITS masks on the same
+    grid, a ds9 region file, and a catalogue, given as a dictionary of
+    keyword arguments for modify_mask.catalogue_mask (table, radius,
+    fluxlim...). outfile may be the same as templatename. The template
+    data are only read if include_template is set or a region is given
+    (which needs a flattened copy of the image)
+    """
+    hdu=fits.open(templatename)
+    header=hdu[0].header
+    naxis=header['NAXIS']
+    fullshape=tuple(header['NAXIS%i' % i] for i in range(naxis,0,-1))
+    shape=fullshape[-2:]
+    plane=(0,)*(naxis-2)
+    if include_template:
+        mask=(hdu[0].data[plane]!=0)
+    else:
+        mask=np.zeros(shape,dtype=bool)
+    if catalogue is not None:
+        mask|=catalogue_mask(WCS(header),shape,**catalogue).astype(bool)
+    if region is not None:
+        r=pyregion.open(region)
+        mask|=r.get_mask(hdu=flatten(hdu))
+    if masks is not None:
+        for m in masks:
+            mhdu=fits.open(m)
+            mask|=(mhdu[0].data[plane]!=0)
+            mhdu.close()
+    data=np.zeros(fullshape,dtype=np.float32)
+    data[...]=mask
+    hdu[0].data=data
+    hdu.writeto(outfile,clobber=True)
+    hdu.close()
+
+def regrid_box(mask,w,wf,maskf,xminf,xmaxf,yminf,ymaxf,maxpix=1000000):
+    # set the pixels of maskf (full-res, WCS wf) in the given box whose
+    # centres fall in a set pixel of mask (low-res, WCS w). The box is
+    # processed in strips of at most maxpix pixels
+    ny,nx=mask.shape
+    nyf,nxf=maskf.shape
+    xs=np.arange(max(xminf,0),min(xmaxf,nxf))
+    if len(xs)==0:
+        return
+    step=max(1,maxpix/len(xs))
+    for y0 in range(max(yminf,0),min(ymaxf,nyf),step):
+        ys=np.arange(y0,min(y0+step,ymaxf,nyf))
+        x,y=np.meshgrid(xs,ys)
+        x=x.flatten()
+        y=y.flatten()
+        pix=np.array([x,y,np.zeros_like(x),np.zeros_like(x)]).T
+        world=wf.wcs_pix2world(pix,0)
+        opix=w.wcs_world2pix(world,0)
+        ox=opix[:,0].astype(int)
+        oy=opix[:,1].astype(int)
+        # pixels that fall outside the low-res image, e.g. through wcs
+        # mismatches, are ignored
+        inside=(ox>=0) & (ox<nx) & (oy>=0) & (oy<ny)
+        inside[inside]=mask[oy[inside],ox[inside]]
+        maskf[y[inside],x[inside]]=1
+
 def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=25000,rootname=None,verbose=False,rmsfacet=False,ds9region='image_dirin_SSD_m_c.tessel.reg'):
     ''' infile is the input low-res image, fullresfile is the full-resolution template image, sizethresh the minimum island size in pixels '''
 
@@ -58,15 +122,12 @@ def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=
     print 'Found',len(big_regions)-1,'large islands'
     if verbose: print counts[big]
 
-    mask=np.zeros_like(det,dtype=int)
-    for l in big_regions:
-        if l: mask+=l*(labels==l)
+    big[0]=False
+    mask=big[labels]
 
-    slices=nd.find_objects(mask)
+    slices=nd.find_objects(labels)
     big_slices=[slices[i-1] for i in big_regions if i]
-    kernel = np.ones((3,3))
-    mask = convolve2d(mask, kernel, mode='same', fillvalue=0)
-    mask = (mask>1)
+    mask=nd.binary_dilation(mask,structure=np.ones((3,3),dtype=bool))
     w=WCS(hdu[0].header)
     hdu[0].data=mask.astype(np.float32)
     hdu.writeto(prefix+'mask-low.fits',clobber=True)
@@ -100,21 +161,7 @@ def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=
             xmaxf=int(pixlim[:,0].max())
             yminf=int(pixlim[:,1].min())
             ymaxf=int(pixlim[:,1].max())
-            xs=np.arange(xminf,xmaxf)
-            ys=np.arange(yminf,ymaxf)
-            x,y=np.meshgrid(xs,ys)
-            x=x.flatten()
-            y=y.flatten()
-            pix=np.array([x,y,np.zeros_like(x),np.zeros_like(x)]).T
-            world=wf.wcs_pix2world(pix,0)
-            opix=w.wcs_world2pix(world,0)
-            for xv,yv,op in zip(x,y,opix):
-                try:
-                    if mask[int(op[1]),int(op[0])]>0:
-                        maskf[yv,xv]=1
-                except IndexError:
-                    # catch wcs mismatches or similar
-                    pass
+            regrid_box(mask,w,wf,maskf,xminf,xmaxf,yminf,ymaxf)
 
         hduf[0].data=maskf.astype(np.float32)
         hduf.writeto(prefix+'mask-high.fits',clobber=True)
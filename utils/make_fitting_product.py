@@ -27,7 +27,7 @@ def make_catalogue(name,c_ra,c_dec,radius,cats,outnameprefix=''):
         raise RuntimeError('No bright sources for crossmatching')
 
     # Filter for isolated sources
-    t=select_isolated_sources(t,100)
+    t,tree=select_isolated_sources(t,100,return_tree=True)
     print 'Remove close neighbours:',len(t)
     if len(t)==0:
         raise RuntimeError('No sources in table before crossmatching')
@@ -46,7 +46,7 @@ def make_catalogue(name,c_ra,c_dec,radius,cats,outnameprefix=''):
         t['g_count_'+str(g)]=0
     for i,(n,sh,group,cmrad) in enumerate(cats):
         tab=ctab[i]
-        match_catalogues(t,tab,cmrad,sh,group=group)
+        match_catalogues(t,tab,cmrad,sh,group=group,tree=tree)
 #        
 #        t[sh+'_flux']=np.nan
 #        t[sh+'_e_flux']=np.nan
@@ -19,11 +19,125 @@ def ellipse(x,y,xp,yp,major,minor,angle):
     b=np.power(sina*(xp-x)-cosa*(yp-y),2)
     return (a/dd)+(b/DD)
 
-def modify_mask(infile,outfile,table,radius,fluxlim,save_filtered=None,do_extended=False,cellsize=1.5,pointsize=30.0):
-    """Take a pre-existing mask file, in infile: find all entries in FITS
-    table table that lie in the map region, and add their positions to
-    the mask with a fixed radius radius in pixels: write the mask out
-    to outfile, which may be the same as infile.
+def stamp_source(mask,xv,yv,radius,major=None,minor=None,pa=None,cellsize=1.5):
+    # add one source to the 2D mask by testing every pixel in a box
+    # around it. This is the original method, used for sources near
+    # the lower edges of the map, where the box is clipped
+    ymax,xmax=mask.shape
+    if major is not None:
+        r=major+radius
+    else:
+        r=radius
+    cxmin=xv-r-1
+    if cxmin<0: cxmin=0
+    cxmax=xv+r+1
+    if cxmax>xmax: cxmax=xmax
+    cymin=yv-r-1
+    if cymin<0: cymin=0
+    cymax=yv+r+1
+    if cymax>ymax: cymax=ymax
+    X, Y = np.meshgrid(np.arange(cxmin,cxmax,1.0), np.arange(cymin,cymax,1.0))
+    if major is not None:
+        ellv=ellipse(xv,yv,X,Y,major/cellsize+radius*2.0,minor/cellsize+radius*2.0,pa)
+        mask[Y[ellv<1.0].astype(int),X[ellv<1.0].astype(int)]=1
+    else:
+        rv=np.sqrt((X+0.5-xv)**2.0+(Y+0.5-yv)**2.0)
+        mask[Y[rv<radius].astype(int),X[rv<radius].astype(int)]=1
+
+def stamp_points(mask,x,y,radius,batch=10000):
+    # away from the lower edges the box for each source starts at
+    # x-radius-1, so the pixels inside the circle are at fixed integer
+    # offsets from there: compute these once and stamp all the
+    # sources with them
+    ymax,xmax=mask.shape
+    k=np.arange(int(np.ceil(2*radius+2))+1)
+    dx=k-radius-0.5
+    ky,kx=np.nonzero(np.sqrt(dx[None,:]**2.0+dx[:,None]**2.0)<radius)
+    for i in range(0,len(x),batch):
+        X=(x[i:i+batch]-radius-1)[:,None]+kx[None,:]
+        Y=(y[i:i+batch]-radius-1)[:,None]+ky[None,:]
+        good=(X<xmax) & (Y<ymax)
+        mask[Y[good].astype(int),X[good].astype(int)]=1
+
+def stamp_ellipses(mask,x,y,major,minor,pa,radius,cellsize=1.5,maxpix=4000000):
+    # ellipses differ in size and shape, so evaluate them in batches
+    # of similar size on a common box, limited to maxpix test pixels.
+    # The box used by stamp_source (half-size major+radius) is much
+    # larger than the ellipse, so only the part of it within the
+    # ellipse's half major axis of the centre is tested, keeping the
+    # same pixel grid
+    ymax,xmax=mask.shape
+    r=major+radius
+    h=major/cellsize/2.0+radius+1
+    k0=np.maximum(0,np.floor(r+1-h))
+    size=(np.ceil(2*h)+2).astype(int)
+    order=np.argsort(size)
+    i=0
+    while i<len(order):
+        j=i+1
+        while j<len(order) and (j+1-i)*size[order[j]]**2<=maxpix:
+            j+=1
+        b=order[i:j]
+        k=np.arange(size[order[j-1]],dtype=float)
+        xb=x[b][:,None,None]
+        yb=y[b][:,None,None]
+        rb=r[b][:,None,None]
+        kb=k0[b][:,None,None]
+        X=(xb-rb-1)+(kb+k[None,None,:])
+        Y=(yb-rb-1)+(kb+k[None,:,None])
+        ellv=ellipse(xb,yb,X,Y,(major[b]/cellsize+radius*2.0)[:,None,None],(minor[b]/cellsize+radius*2.0)[:,None,None],pa[b][:,None,None])
+        inside=(ellv<1.0) & (X<xb+rb+1) & (Y<yb+rb+1) & (X<xmax) & (Y<ymax)
+        X,Y=np.broadcast_arrays(X,Y)
+        mask[Y[inside].astype(int),X[inside].astype(int)]=1
+        i=j
+
+def rasterise_sources(shape,x,y,radius,major=None,minor=None,pa=None,cellsize=1.5,pointsize=30.0):
+    """
+    Return a uint8 mask of the given 2D shape with pixels within
+    radius pixels of each source position set. If major, minor and
+    pa are given, sources with major axis larger than pointsize
+    (arcsec) are masked with an ellipse instead.
+    """
+    mask=np.zeros(shape,dtype=np.uint8)
+    x=np.asarray(x,dtype=float)
+    y=np.asarray(y,dtype=float)
+    if major is not None:
+        major=np.asarray(major,dtype=float)
+        minor=np.asarray(minor,dtype=float)
+        pa=np.asarray(pa,dtype=float)
+        extended=major>pointsize
+        r=np.where(extended,major+radius,radius)
+    else:
+        extended=np.zeros(len(x),dtype=bool)
+        r=radius
+    edge=(x-r-1<0) | (y-r-1<0)
+    for i in np.where(edge)[0]:
+        if extended[i]:
+            stamp_source(mask,x[i],y[i],radius,major[i],minor[i],pa[i],cellsize)
+        else:
+            stamp_source(mask,x[i],y[i],radius)
+    points=~edge & ~extended
+    stamp_points(mask,x[points],y[points],radius)
+    ellipses=~edge & extended
+    if np.any(ellipses):
+        stamp_ellipses(mask,x[ellipses],y[ellipses],major[ellipses],minor[ellipses],pa[ellipses],radius,cellsize)
+    return mask
+
+def rasterise_sources_loop(shape,x,y,radius,major=None,minor=None,pa=None,cellsize=1.5,pointsize=30.0):
+    # one source at a time, kept for comparison
+    mask=np.zeros(shape,dtype=np.uint8)
+    for i,(xv,yv) in enumerate(zip(x,y)):
+        if major is not None and major[i]>pointsize:
+            stamp_source(mask,xv,yv,radius,major[i],minor[i],pa[i],cellsize)
+        else:
+            stamp_source(mask,xv,yv,radius)
+    return mask
+
+def catalogue_mask(w,shape,table,radius,fluxlim,save_filtered=None,do_extended=False,cellsize=1.5,pointsize=30.0):
+    """Return a uint8 mask with the given 2D shape and WCS w (of the
+    full 4D image) in which the entries in FITS table table above
+    fluxlim that lie in the map region are masked with a fixed radius
+    radius in pixels.
 
     save_filtered, if not None, should be a filename to save the
     filtered table to.
@@ -34,54 +148,63 @@ def modify_mask(infile,outfile,table,radius,fluxlim,save_filtered=None,do_extend
     t=t[t['Peak_flux']>fluxlim]
     if len(t)==0:
         raise Exception('Flux-filtered table is zero-length. Check your table fluxes and/or positions')
-    hdu=fits.open(infile)
-    w=WCS(hdu[0].header)
-    map=hdu[0].data
-    mask=np.zeros_like(map,dtype=int)
-    _,_,ymax,xmax=map.shape
+    ymax,xmax=shape
     x,y,_,_=w.wcs_world2pix(t['RA'],t['DEC'],0,0,0)
     filter=(x>=0) & (x<xmax) & (y>=0) & (y<ymax)
     t=t[filter]
     x=x[filter]
     y=y[filter]
-    for i,(xv,yv) in enumerate(zip(x,y)):
-        do_ellipse=False
-        r=radius
-        if do_extended:
-            # check whether the major axis exceeds a limit
-            major=t[i]['Maj']
-            minor=t[i]['Min']
-            pa=t[i]['PA']
-            if major>pointsize:
-                do_ellipse=True
-                r=major+radius
-                # print 'Doing ellipse with',major,minor,pa
-
-        cxmin=xv-r-1
-        if cxmin<0: cxmin=0
-        cxmax=xv+r+1
-        if cxmax>xmax: cxmax=xmax
-        cymin=yv-r-1
-        if cymin<0: cymin=0
-        cymax=yv+r+1
-        if cymax>ymax: cymax=ymax
-        X, Y = np.meshgrid(np.arange(cxmin,cxmax,1.0), np.arange(cymin,cymax,1.0))
-        if do_ellipse:
-            ellv=ellipse(xv,yv,X,Y,major/cellsize+radius*2.0,minor/cellsize+radius*2.0,pa)
-            mask[0,0,Y[ellv<1.0].astype(int),X[ellv<1.0].astype(int)]=1
-        else:
-            rv=np.sqrt((X+0.5-xv)**2.0+(Y+0.5-yv)**2.0)
-            mask[0,0,Y[rv<radius].astype(int),X[rv<radius].astype(int)]=1
-
-    hdu[0].data=(map.astype(int) | mask).astype(np.float32)
-    hdu.writeto(outfile,clobber=True)
+    if do_extended:
+        mask=rasterise_sources((ymax,xmax),x,y,radius,t['Maj'],t['Min'],t['PA'],cellsize=cellsize,pointsize=pointsize)
+    else:
+        mask=rasterise_sources((ymax,xmax),x,y,radius)
     if save_filtered is not None:
         t.write(save_filtered,overwrite=True)
+    return mask
+
+def modify_mask(infile,outfile,table,radius,fluxlim,save_filtered=None,do_extended=False,cellsize=1.5,pointsize=30.0):
+    """Take a pre-existing mask file, in infile: find all entries in FITS
+    table table that lie in the map region, and add their positions to
+    the mask with a fixed radius radius in pixels: write the mask out
+    to outfile, which may be the same as infile.
+
+    save_filtered, if not None, should be a filename to save the
+    filtered table to.
+
+    """
+
+    hdu=fits.open(infile)
+    map=hdu[0].data
+    mask=catalogue_mask(WCS(hdu[0].header),map.shape[-2:],table,radius,fluxlim,save_filtered=save_filtered,do_extended=do_extended,cellsize=cellsize,pointsize=pointsize)
+    map[0,0][mask.astype(bool)]=1
+    hdu[0].data=map.astype(np.float32)
+    hdu.writeto(outfile,clobber=True)
         
 
+def benchmark(size=10000,nsources=5000,extfrac=0.1,radius=8.0,cellsize=1.5,pointsize=30.0):
+    # compare with the one-source-at-a-time method on random sources,
+    # using the default tgss_radius and tgss_pointlike
+    import time
+    x=np.random.uniform(0,size,nsources)
+    y=np.random.uniform(0,size,nsources)
+    major=np.where(np.random.uniform(size=nsources)<extfrac,np.random.uniform(pointsize,200,nsources),10.0)
+    minor=major*np.random.uniform(0.3,1.0,nsources)
+    pa=np.random.uniform(0,180,nsources)
+    t0=time.time()
+    m1=rasterise_sources_loop((size,size),x,y,radius,major,minor,pa,cellsize,pointsize)
+    t1=time.time()
+    m2=rasterise_sources((size,size),x,y,radius,major,minor,pa,cellsize,pointsize)
+    t2=time.time()
+    print 'Loop: %.2f s, vectorised: %.2f s, speedup %.1f' % (t1-t0,t2-t1,(t1-t0)/(t2-t1))
+    print 'Masked pixels %i %i, differing %i' % (np.sum(m1),np.sum(m2),np.sum(m1!=m2))
+
 if __name__=='__main__':
     import sys
 
+    if sys.argv[1]=='benchmark':
+        benchmark()
+        sys.exit(0)
+
     infile=sys.argv[1]
     outfile=sys.argv[2]
     table=sys.argv[3]
@@ -0,0 +1,149 @@
+# Cache of basic MS metadata (frequencies, columns, time range, row
+# count...) shared by the parts of the pipeline that need it. Opening
+# tables is slow on some filesystems, so the results are kept in a
+# file in the working directory, keyed on the MS path and the
+# modification time of its table.dat, which changes when columns are
+# added or removed. Missing or stale entries are filled in parallel.
+
+import os
+import json
+import fcntl
+import threading
+import numpy as np
+
+metadata_file='ms-metadata.json'
+metadata_lock=threading.Lock()
+
+def table_mtime(ms):
+    try:
+        return os.path.getmtime(ms+'/table.dat')
+    except OSError:
+        return None
+
+def read_ms_metadata(ms):
+    """
+    Read the metadata for one MS directly from the tables. Returns
+    None if the MS can't be opened
+    """
+    import pyrap.tables as pt
+    try:
+        t = pt.table(ms,readonly=True,ack=False)
+    except RuntimeError:
+        return None
+    meta={'mtime':table_mtime(ms),
+          'colnames':t.colnames(),
+          'nrows':t.nrows(),
+          'dysco':'Dysco' in t.showstructure(),
+          'flagfrac':None}
+    meta['hascorrected']='CORRECTED_DATA' in meta['colnames']
+    t.close()
+    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
+    meta['ref_frequency']=t[0]['REF_FREQUENCY']
+    meta['chan_freq']=list(t[0]['CHAN_FREQ'])
+    t.close()
+    t = pt.table(ms+'/OBSERVATION', readonly=True, ack=False)
+    meta['time_range']=list(t.getcell('TIME_RANGE',0))
+    t.close()
+    t = pt.table(ms+'/FIELD', readonly=True, ack=False)
+    meta['phase_dir']=list(t[0]['PHASE_DIR'][0])
+    t.close()
+    return meta
+
+def load_cache(workdir='.'):
+    filename=os.path.join(workdir,metadata_file)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+def save_entries(entries,workdir='.',removed=()):
+    # entries are added to the cache file and the keys in removed
+    # deleted from it
+    filename=os.path.join(workdir,metadata_file)
+    with metadata_lock:
+        # the lock file serialises updates from other processes (e.g.
+        # make_mslists): re-read under it so that their entries are
+        # kept, then replace the file in one rename
+        with open(filename+'.lock','a') as lockfile:
+            fcntl.flock(lockfile.fileno(),fcntl.LOCK_EX)
+            try:
+                cache=load_cache(workdir)
+                cache.update(entries)
+                for key in removed:
+                    cache.pop(key,None)
+                tmpname=filename+'.tmp.%i.%i' % (os.getpid(),threading.current_thread().ident)
+                with open(tmpname,'w') as f:
+                    json.dump(cache,f,sort_keys=True)
+                os.rename(tmpname,filename)
+            finally:
+                fcntl.flock(lockfile.fileno(),fcntl.LOCK_UN)
+
+def get_metadata(mss,jobs=8,workdir='.'):
+    """
+    Return a list of metadata dictionaries, one per MS in mss (None for
+    an MS that can't be opened), using the cache where it is up to date
+    """
+    cache=load_cache(workdir)
+    keys=[os.path.abspath(ms) for ms in mss]
+    stale=[]
+    for ms,key in zip(mss,keys):
+        if key not in cache or cache[key]['mtime']!=table_mtime(ms):
+            if ms not in stale:
+                stale.append(ms)
+    if stale:
+        jobs=max(1,min(jobs,len(stale)))
+        if jobs==1:
+            results=[read_ms_metadata(ms) for ms in stale]
+        else:
+            # threads rather than processes: this is casacore I/O, and
+            # it is called from the step scheduler's threads, where
+            # forking could deadlock the children on locks held by
+            # other threads
+            from multiprocessing.pool import ThreadPool
+            pool=ThreadPool(jobs)
+            try:
+                results=pool.map(read_ms_metadata,stale)
+            finally:
+                pool.close()
+                pool.join()
+        entries={}
+        removed=[]
+        for ms,meta in zip(stale,results):
+            key=os.path.abspath(ms)
+            if meta is not None:
+                entries[key]=meta
+            elif key in cache:
+                # the MS has gone or no longer opens: don't hand back
+                # its old metadata
+                removed.append(key)
+                del cache[key]
+        if entries or removed:
+            save_entries(entries,workdir,removed=removed)
+            cache.update(entries)
+    return [cache.get(key) for key in keys]
+
+def update_metadata(updates,workdir='.'):
+    """
+    Add derived values (e.g. flagfrac) to the cache entries of several
+    MSs in one write. updates is a dictionary of MS name and dictionary
+    of values
+    """
+    mss=sorted(updates)
+    entries={}
+    for ms,meta in zip(mss,get_metadata(mss,workdir=workdir)):
+        if meta is None:
+            raise RuntimeError('Cannot read metadata for '+ms)
+        meta.update(updates[ms])
+        entries[os.path.abspath(ms)]=meta
+    if entries:
+        save_entries(entries,workdir)
+
+def has_column(ms,colname):
+    meta=get_metadata([ms])[0]
+    return meta is not None and colname in meta['colnames']
+
+def chan_freq(meta):
+    return np.array(meta['chan_freq'])
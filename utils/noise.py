@@ -0,0 +1,131 @@
+# Robust noise estimates: the rms of the data after iteratively
+# removing values more than 5 sigma from zero.
+#
+# Each iteration keeps the values with |x| below a threshold that only
+# ever decreases, so the sums over the kept values are the sums over
+# all the data minus those over the tail above the threshold. The tail
+# (a few per cent of the data for noise-like images) is extracted once,
+# sorted by |x| and summed cumulatively, so each iteration is just a
+# lookup: the full data are read a handful of times in total, instead
+# of several times per iteration, and are never copied except to drop
+# NaNs.
+
+import numpy as np
+
+def tail_sums(a,absa,lower):
+    # cumulative sums over the values with |x|>=lower, from the top
+    # down, indexed by position in the sorted |x| of the tail
+    sel=absa>=lower
+    ta=absa[sel]
+    t=a[sel].astype(np.float64)
+    order=np.argsort(ta)
+    ta=ta[order]
+    t=t[order]
+    suf1=np.concatenate((np.cumsum(t[::-1])[::-1],[0]))
+    suf2=np.concatenate((np.cumsum((t*t)[::-1])[::-1],[0]))
+    return ta,suf1,suf2
+
+def clipped_rms(values,nsigma=5,niter=25,eps=1e-6,tailfrac=0.5,verbose=False,fail=False):
+    """
+    Return the sigma-clipped rms of values, ignoring NaNs. If the
+    iteration doesn't converge in niter steps, raise an exception if
+    fail is True, otherwise print a warning and return the last value
+    """
+    a=np.asarray(values).ravel()
+    a=a[~np.isnan(a)]
+    absa=np.abs(a)
+    # sums are accumulated in double precision whatever the type of
+    # the data
+    N=len(a)
+    S1=np.sum(a,dtype=np.float64)
+    S2=np.einsum('i,i->',a,a,dtype=np.float64)
+    n,s1,s2=N,S1,S2
+    # start the tail well below where the threshold should end up,
+    # judging from the median absolute value of a sample of the data
+    lower=tailfrac*nsigma*1.4826*np.median(absa[::max(1,N//100000)])
+    ta=None
+    oldrms=1
+    thresh=None
+    for i in range(niter):
+        mean=s1/n
+        rms=np.sqrt(max(s2/n-mean**2,0))
+        if verbose: print n,rms
+        if np.abs(oldrms-rms)/rms < eps:
+            return rms
+        if thresh is None:
+            thresh=nsigma*rms
+        else:
+            thresh=min(thresh,nsigma*rms)
+        if thresh<lower:
+            lower=tailfrac*thresh
+            ta=None
+        if ta is None:
+            ta,suf1,suf2=tail_sums(a,absa,lower)
+        j=np.searchsorted(ta,thresh)
+        n=N-(len(ta)-j)
+        s1=S1-suf1[j]
+        s2=S2-suf2[j]
+        oldrms=rms
+    if fail:
+        raise Exception('Failed to converge')
+    print 'Warning -- failed to converge!',rms,oldrms
+    return rms
+
+def clipped_rms_iterative(subim,niter=25,eps=1e-6):
+    # the original method, kept for comparison
+    subim=subim[~np.isnan(subim)]
+    oldrms=1
+    for i in range(niter):
+        rms=np.std(subim)
+        if np.abs(oldrms-rms)/rms < eps:
+            return rms
+        subim=subim[np.abs(subim)<5*rms]
+        oldrms=rms
+    raise Exception('Failed to converge')
+
+def central_box(hdu,boxsize=1000):
+    # read only the central box of the first plane of the image
+    shape=hdu[0].shape
+    ys,xs=shape[-2:]
+    plane=(0,)*(len(shape)-2)
+    return hdu[0].section[plane+(slice(ys/2-boxsize/2,ys/2+boxsize/2),slice(xs/2-boxsize/2,xs/2+boxsize/2))]
+
+def get_rms(hdu,boxsize=1000,niter=20,eps=1e-6,verbose=False):
+    """
+    Return the clipped rms of the central boxsize x boxsize pixels of
+    the image in the HDU list hdu
+    """
+    return clipped_rms(central_box(hdu,boxsize),niter=niter,eps=eps,verbose=verbose,fail=True)
+
+def get_rms_array(subim,size=500000,niter=25,eps=1e-6,verbose=False):
+    """
+    Return the clipped rms of an array of values, using a random
+    subset of at most size values
+    """
+    if len(subim)>size:
+        subim=np.random.choice(subim,size,replace=False)
+    return clipped_rms(subim,niter=niter,eps=eps,verbose=verbose)
+
+if __name__=='__main__':
+    # Regression check against the iterative method, on the images
+    # given on the command line or on a synthetic image
+    import sys
+    import time
+    from astropy.io import fits
+    if len(sys.argv)>1:
+        boxes=[]
+        for name in sys.argv[1:]:
+            boxes.append((name,np.array(central_box(fits.open(name)),dtype=np.float64)))
+    else:
+        im=np.random.normal(0,1e-4,(1000,1000))
+        # some sources and blanked pixels
+        im[np.random.randint(0,1000,5000),np.random.randint(0,1000,5000)]+=np.random.exponential(1e-2,5000)
+        im[:20,:]=np.nan
+        boxes=[('synthetic',im)]
+    for name,box in boxes:
+        t0=time.time()
+        r1=clipped_rms_iterative(box.flatten())
+        t1=time.time()
+        r2=clipped_rms(box)
+        t2=time.time()
+        print '%s: iterative %g (%.3f s), one-pass %g (%.3f s), fractional difference %.2g' % (name,r1,t1-t0,r2,t2-t1,r2/r1-1)
@@ -4,6 +4,22 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                   'Number of CPUS to use for DDF'),
                 ( 'machine', 'NCPU_killms', int, getcpus(),
                   'Number of CPUS to use for KillMS' ),
+                ( 'machine', 'killms_jobs', int, 1,
+                  'Number of MS to run KillMS on at the same time. NCPU_killms is divided between them' ),
+                ( 'machine', 'solutions_jobs', int, 4,
+                  'Number of observations whose solutions are merged and smoothed at the same time' ),
+                ( 'machine', 'subtract_rows', int, 100000,
+                  'Number of MS rows read at a time when subtracting visibility columns. Bounds the memory used per MS' ),
+                ( 'machine', 'subtract_jobs', int, 4,
+                  'Number of MS to subtract visibility columns in at the same time' ),
+                ( 'machine', 'NCPU_budget', int, getcpus(),
+                  'Total number of CPUs shared between late pipeline steps that are allowed to run at the same time' ),
+                ( 'machine', 'memory_budget', float, None,
+                  'Total memory in GB shared between late pipeline steps that run at the same time. If None, use the physical memory of the machine' ),
+                ( 'machine', 'NCPU_step', int, None,
+                  'Number of CPUs to give each concurrently scheduled late imaging step. If None, NCPU_DDF is used' ),
+                ( 'machine', 'memory_step', float, 0,
+                  'Memory in GB to reserve for each concurrently scheduled late imaging step' ),
                 ( 'data', 'mslist', str, None,
                   'Initial measurement set list to use -- must be specified' ),
                 ( 'data', 'full_mslist', str, None,
@@ -76,6 +92,7 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                 ( 'control', 'logging', str, 'logs', 'Name of directory to save logs to, or \'None\' for no logging' ),
                 ( 'control', 'dryrun', bool, False, 'If True, don\'t run anything, just print what would be run' ),
                 ( 'control', 'restart', bool, True, 'If True, skip steps that would re-generate existing files' ),
+                ( 'control', 'ledger', bool, True, 'If True, on restart only skip a step if the step ledger shows that its command line and input files are unchanged since it completed. If False, skip any step whose output files exist' ),
                 ( 'control', 'cache_dir', str, None, 'Directory for ddf cache files -- default is working directory'),
                 ( 'control', 'clearcache', bool, True, 'If True, clear all DDF cache before running' ),
                 ( 'control', 'clearcache_end', bool, True, 'If True, clear all DDF cache at successful end of the pipeline' ),
@@ -102,6 +119,9 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                 ( 'offsets', 'method', str, None, 'Offset correction method to use. None -- no correction'),
                 ( 'offsets', 'fit', str, 'mcmc', 'Histogram fit method' ),
                 ( 'offsets', 'mode', str, 'normal', 'Mode of operation: normal or test' ),
+                ( 'offsets', 'vectorize', bool, True, 'Evaluate the MCMC histogram fit likelihood for all walkers at once' ),
+                ( 'offsets', 'download_jobs', int, 4, 'Number of catalogue tiles to download at once' ),
+                ( 'offsets', 'download_per_host', int, 2, 'Largest number of the downloads running at once that may use the same server' ),
                 ( 'spectra', 'do_dynspec', bool, True, 'Do dynamic spectra'),
                 ( 'spectra', 'bright_threshold', float, 1.0, 'Threshold for auto-selection of bright sources'),
                 ( 'inputmodel',  'basedicomodel',str,None,'Input dicomodel for calibration'),
@@ -1,9 +1,103 @@
 import subprocess
 import sys
+import os
 import select
 import datetime
+import time
+import json
+import socket
+import threading
 
-def run_log(cmd,logfile,quiet=False):
+# Every command run through run_log/run_timed appends one JSON record
+# to this file in the working directory: timings, exit code, CPU time
+# and peak memory from the rusage of the child, and I/O from /proc
+timeline_file='timeline.jsonl'
+timeline_lock=threading.Lock()
+
+def read_proc_io(pid):
+    # cumulative I/O of a process, including its reaped children
+    io={}
+    try:
+        with open('/proc/%i/io' % pid) as f:
+            for l in f:
+                key,value=l.split(':')
+                io[key]=int(value)
+    except (IOError,OSError,ValueError):
+        pass
+    return io
+
+def is_zombie(pid):
+    try:
+        with open('/proc/%i/stat' % pid) as f:
+            # state is the field after the bracketed command name
+            return f.read().rsplit(')',1)[1].split()[0]=='Z'
+    except (IOError,OSError,IndexError):
+        return True
+
+def wait_with_usage(proc):
+    """
+    Wait for a Popen process, returning its return value, its rusage
+    (which includes the children the shell waited for) and its I/O
+    counters read just before it is reaped
+    """
+    io={}
+    while True:
+        newio=read_proc_io(proc.pid)
+        if newio:
+            io=newio
+        if is_zombie(proc.pid):
+            break
+        time.sleep(0.1)
+    newio=read_proc_io(proc.pid)
+    if newio:
+        io=newio
+    _,status,rusage=os.wait4(proc.pid,0)
+    if os.WIFSIGNALED(status):
+        retval=-os.WTERMSIG(status)
+    else:
+        retval=os.WEXITSTATUS(status)
+    proc.returncode=retval
+    return retval,rusage,io
+
+def write_timeline(cmd,logfile,start,end,retval,rusage,io,step=None):
+    if step is None:
+        if logfile is not None:
+            step=os.path.basename(logfile)
+            if step.endswith('.log'):
+                step=step[:-4]
+        else:
+            step=os.path.basename(cmd.split()[0])
+    record={'step':step,
+            'command':cmd,
+            'log':logfile,
+            'host':socket.gethostname(),
+            'start':start,
+            'end':end,
+            'start_time':'{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.fromtimestamp(start)),
+            'elapsed':end-start,
+            'retval':retval,
+            'utime':rusage.ru_utime,
+            'stime':rusage.ru_stime,
+            'maxrss_kb':rusage.ru_maxrss,
+            'read_bytes':io.get('read_bytes'),
+            'write_bytes':io.get('write_bytes'),
+            'rchar':io.get('rchar'),
+            'wchar':io.get('wchar')}
+    with timeline_lock:
+        with open(timeline_file,'a') as f:
+            f.write(json.dumps(record,sort_keys=True)+'\n')
+
+def run_timed(cmd,step=None):
+    # run with output to the terminal, recording only the timeline
+    start=time.time()
+    proc=subprocess.Popen(cmd, shell=True)
+    retval,rusage,io=wait_with_usage(proc)
+    write_timeline(cmd,None,start,time.time(),retval,rusage,io,step=step)
+    return retval
+
+def run_log(cmd,logfile,quiet=False,step=None):
+    start=time.time()
+    logname=logfile
     logfile = open(logfile, 'w')
     logfile.write('Running process with command: '+cmd+'\n')
     proc=subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -20,8 +114,10 @@ def run_log(cmd,logfile,quiet=False):
         ts='{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
         logfile.write(ts+': '+line)
         logfile.flush()
-    retval=proc.wait()
+    retval,rusage,io=wait_with_usage(proc)
     logfile.write('Process terminated with return value %i\n' % retval)
+    logfile.close()
+    write_timeline(cmd,logname,start,time.time(),retval,rusage,io,step=step)
     return retval
 
 if __name__=='__main__':
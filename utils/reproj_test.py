@@ -10,6 +10,8 @@ from astropy.io import fits
 from astropy.wcs import WCS
 import numpy as np
 from multiprocessing import Pool
+from scipy.ndimage import map_coordinates
+from getcpus import getcpus
 import sys
 
 def reproject_interp_chunk_2d(input_data, output_projection, shape_out=None, hdu_in=0,
@@ -80,53 +82,182 @@ def reproject_exact_chunk_2d(input_data, output_projection, shape_out=None, hdu_
     return array, footprint
 
 
-def reproject_worker(a):
-    imin,imax,jmin,jmax,array_in,wcs_in,wcs_out_sub,shape_out_sub,order=a
-    print 'worker:',imin,jmin
-    array_sub, footprint_sub = _reproject_celestial(array_in, wcs_in, wcs_out_sub,
-                                                    shape_out=shape_out_sub, order=order)
-    return imin,imax,jmin,jmax,array_sub,footprint_sub
+# Arrays and WCS used by the reprojection workers. These are set before
+# the pool is created so that the forked workers share them with the
+# parent (copy-on-write) instead of having the input images pickled
+# into every task; input images opened with memmap stay on disk
+shared_arrays=None
+shared_wcs_in=None
+shared_wcs_out=None
+
+def interp_bilinear(array,x,y):
+    """
+    Bilinear interpolation of array at pixel positions x,y (0-based)
+    as reproject_interp does it: values are defined out to half a pixel
+    beyond the outer pixel centres, and are NaN further out
+    """
+    ny,nx=array.shape
+    with np.errstate(invalid='ignore'):
+        bad=~((x>=-0.5) & (x<=nx-0.5) & (y>=-0.5) & (y<=ny-0.5))
+    xc=np.clip(np.where(bad,0,x),0,nx-1)
+    yc=np.clip(np.where(bad,0,y),0,ny-1)
+    values=map_coordinates(array,[yc,xc],order=1,mode='nearest')
+    values[bad]=np.nan
+    return values
+
+def reproject_tile(a):
+    # worker: reproject all the shared arrays onto one output tile,
+    # computing the co-ordinate transformation once
+    imin,imax,jmin,jmax=a
+    y,x=np.mgrid[imin:imax,jmin:jmax]
+    ra,dec=shared_wcs_out.wcs_pix2world(x.ravel(),y.ravel(),0)
+    xin,yin=shared_wcs_in.wcs_world2pix(ra,dec,0)
+    results=[interp_bilinear(array,xin,yin).reshape(imax-imin,jmax-jmin) for array in shared_arrays]
+    return imin,imax,jmin,jmax,results
+
+def output_bbox(wcs_in,shape_in,wcs_out,shape_out,step=16,margin=2):
+    """
+    Return the range of output pixels (imin,imax,jmin,jmax) that the
+    input image can cover, from the output positions of points around
+    its edge, or the whole output image if they can't be found
+    """
+    ny,nx=shape_in
+    xs=np.append(np.arange(0,nx,step),nx-1)
+    ys=np.append(np.arange(0,ny,step),ny-1)
+    x=np.concatenate([xs,xs,np.zeros(len(ys)),(nx-1)*np.ones(len(ys))])
+    y=np.concatenate([np.zeros(len(xs)),(ny-1)*np.ones(len(xs)),ys,ys])
+    # the image extends half a pixel beyond the edge pixel centres
+    x=np.where(x==0,-0.5,np.where(x==nx-1,nx-0.5,x))
+    y=np.where(y==0,-0.5,np.where(y==ny-1,ny-0.5,y))
+    ra,dec=wcs_in.wcs_pix2world(x,y,0)
+    xo,yo=wcs_out.wcs_world2pix(ra,dec,0)
+    if not (np.all(np.isfinite(xo)) and np.all(np.isfinite(yo))):
+        return 0,shape_out[0],0,shape_out[1]
+    imin=int(max(0,np.floor(np.min(yo))-margin))
+    imax=int(min(shape_out[0],np.ceil(np.max(yo))+margin+1))
+    jmin=int(max(0,np.floor(np.min(xo))-margin))
+    jmax=int(min(shape_out[1],np.ceil(np.max(xo))+margin+1))
+    return imin,max(imin,imax),jmin,max(jmin,jmax)
 
 def reproject_interp_chunk_2d_multi(input_data, output_projection, shape_out=None, hdu_in=0,
-                                    order='bilinear', blocks=(1000, 1000), parallel=True):
+                                    order='bilinear', blocks=(1000, 1000), parallel=True, ncpu=None,
+                                    return_footprint=True):
     """
-    For a 2D image, reproject in chunks
+    For 2D images, reproject in chunks with a pool of ncpu processes
+    (default all the CPUs), giving the same result as
+    reproject_interp_chunk_2d. input_data may be a list of images on
+    the same grid, e.g. an image and its weights, which are then
+    reprojected together; lists of arrays and footprints are returned
+    in that case. If return_footprint is False only the arrays are
+    returned, and no full-size footprint arrays are made
     """
-    
-    array_in, wcs_in = parse_input_data(input_data, hdu_in=hdu_in)
-    wcs_out, shape_out = parse_output_projection(output_projection, shape_out=shape_out)
+    global shared_arrays,shared_wcs_in,shared_wcs_out
 
+    if isinstance(input_data,list):
+        inputs=input_data
+    else:
+        inputs=[input_data]
     if isinstance(order, six.string_types):
         order = ORDER[order]
+    if order!=1:
+        raise NotImplementedError('Only bilinear interpolation is supported')
 
-    # Create output arrays
-    array = np.zeros(shape_out, dtype=float)
-    footprint = np.zeros(shape_out, dtype=float)
-    # Arguments for pool
-    args=[] 
-    print 'chunking for pool'
-    for imin in range(0, array.shape[0], blocks[0]):
-        imax = min(imin + blocks[0], array.shape[0])
-        for jmin in range(0, array.shape[1], blocks[1]):
-            jmax = min(jmin + blocks[1], array.shape[1])
-            shape_out_sub = (imax - imin, jmax - jmin)
-            wcs_out_sub = wcs_out.deepcopy()
-            wcs_out_sub.wcs.crpix[0] -= jmin
-            wcs_out_sub.wcs.crpix[1] -= imin
-            args.append((imin,imax,jmin,jmax,array_in,wcs_in,wcs_out_sub,shape_out_sub,order))
+    parsed=[parse_input_data(i, hdu_in=hdu_in) for i in inputs]
+    arrays=[p[0] for p in parsed]
+    wcs_in=parsed[0][1]
+    for a,w in parsed[1:]:
+        if a.shape!=arrays[0].shape or not w.wcs.compare(wcs_in.wcs):
+            raise ValueError('Images to be reprojected together must be on the same grid')
+    wcs_out, shape_out = parse_output_projection(output_projection, shape_out=shape_out)
 
-    print 'pooling'
-    p=Pool(16)
-    results=p.map(reproject_worker,args)
-    for r in results:
-        imin,imax,jmin,jmax,array_sub,footprint_sub=r
-        array[imin:imax, jmin:jmax] = array_sub
-        footprint[imin:imax, jmin:jmax] = footprint_sub
+    # Create output arrays: tiles outside the input image are never
+    # computed and stay blank
+    outputs=[np.full(shape_out, np.nan) for a in arrays]
+    if return_footprint:
+        footprints=[np.zeros(shape_out, dtype=float) for a in arrays]
+    bimin,bimax,bjmin,bjmax=output_bbox(wcs_in,arrays[0].shape,wcs_out,shape_out)
+    args=[]
+    for imin in range(bimin, bimax, blocks[0]):
+        imax = min(imin + blocks[0], bimax)
+        for jmin in range(bjmin, bjmax, blocks[1]):
+            jmax = min(jmin + blocks[1], bjmax)
+            args.append((imin,imax,jmin,jmax))
 
-    return array, footprint
+    if ncpu is None:
+        ncpu=getcpus()
+    ncpu=max(1,min(ncpu,len(args)))
+    print 'Reprojecting %i images in %i tiles with %i processes' % (len(arrays),len(args),ncpu)
+    shared_arrays=arrays
+    shared_wcs_in=wcs_in
+    shared_wcs_out=wcs_out
+    pool=None
+    try:
+        if parallel and ncpu>1:
+            pool=Pool(ncpu)
+            results=pool.imap_unordered(reproject_tile,args)
+        else:
+            results=(reproject_tile(a) for a in args)
+        for imin,imax,jmin,jmax,tiles in results:
+            print '.',
+            sys.stdout.flush()
+            for k,tile in enumerate(tiles):
+                outputs[k][imin:imax, jmin:jmax] = tile
+                if return_footprint:
+                    # as reproject_interp, 1 where the output is not NaN
+                    footprints[k][imin:imax, jmin:jmax] = ~np.isnan(tile)
+        print
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shared_arrays=None
+        shared_wcs_in=None
+        shared_wcs_out=None
+
+    if not isinstance(input_data,list):
+        outputs=outputs[0]
+        if return_footprint:
+            footprints=footprints[0]
+    if return_footprint:
+        return outputs, footprints
+    return outputs
+
+def compare_interp(xsize=2000,ysize=2000,rsize=5000,ncpu=None):
+    # check and time the pool version against reproject_interp_chunk_2d
+    import time
+    rwcs=WCS(naxis=2)
+    rwcs.wcs.ctype=('RA---SIN','DEC--SIN')
+    rwcs.wcs.cdelt=(-1.5/3600,1.5/3600)
+    rwcs.wcs.crval=[180.0,45.0]
+    rwcs.wcs.crpix=[rsize/2,rsize/2]
+    rheader=rwcs.to_header()
+    rheader['NAXIS']=2
+    rheader['NAXIS1']=rsize
+    rheader['NAXIS2']=rsize
+    w=WCS(naxis=2)
+    w.wcs.ctype=('RA---SIN','DEC--SIN')
+    w.wcs.cdelt=(-1.5/3600,1.5/3600)
+    w.wcs.crval=[180.3,45.2]
+    w.wcs.crpix=[xsize/2,ysize/2]
+    header=w.to_header()
+    hdus=[fits.PrimaryHDU(header=header,data=np.random.rand(ysize,xsize).astype(np.float32)) for i in range(2)]
+    hdus[1].data[:100,:100]=np.nan
+    t0=time.time()
+    old=[reproject_interp_chunk_2d(h, rheader, hdu_in=0) for h in hdus]
+    t1=time.time()
+    new,footprints=reproject_interp_chunk_2d_multi(hdus, rheader, hdu_in=0, ncpu=ncpu)
+    t2=time.time()
+    for (o,of),n,nf in zip(old,new,footprints):
+        same=np.isnan(o)==np.isnan(n)
+        print 'NaNs agree: %s, footprints agree: %s, largest difference %g' % (np.all(same),np.all(of==nf),np.nanmax(np.abs(o-n)))
+    print 'Serial %.1f s, pool %.1f s' % (t1-t0,t2-t1)
 
 if __name__=='__main__':
 
+    if len(sys.argv)>1 and sys.argv[1]=='compare':
+        compare_interp()
+        sys.exit(0)
+
     reproj=reproject_exact_chunk_2d
 
     mra=180.0
@@ -0,0 +1,134 @@
+# Dependency-graph scheduler for pipeline steps. Each step declares
+# the files it reads and the files it writes; a step can start once
+# every step producing one of its inputs has finished and there is
+# room for it in the CPU and memory budget. Inputs that no scheduled
+# step produces are assumed to exist already.
+
+import sys
+import threading
+from auxcodes import report,warn
+
+def get_physical_memory():
+    # in GB
+    import psutil
+    return psutil.virtual_memory().total/1024.0**3
+
+class Step(object):
+    def __init__(self,name,function,args=(),kwargs=None,inputs=None,outputs=None,ncpu=1,memory=0):
+        self.name=name
+        self.function=function
+        self.args=args
+        if kwargs is None:
+            kwargs={}
+        self.kwargs=kwargs
+        self.inputs=[] if inputs is None else list(inputs)
+        self.outputs=[] if outputs is None else list(outputs)
+        self.ncpu=ncpu
+        self.memory=memory
+        self.depends=[]
+        self.finished=False
+        self.result=None
+        self.exc_info=None
+
+    def execute(self,condition):
+        try:
+            self.result=self.function(*self.args,**self.kwargs)
+        except BaseException:
+            # includes SystemExit from stop() inside a step
+            self.exc_info=sys.exc_info()
+        with condition:
+            self.finished=True
+            condition.notify_all()
+
+class StepScheduler(object):
+    """
+    Run a set of pipeline steps, starting independent ones at the same
+    time within an overall CPU and memory budget
+    """
+    def __init__(self,ncpu,memory=None):
+        """
+        ncpu is the total number of CPUs that running steps may claim,
+        memory the total memory in GB (default: physical memory)
+        """
+        self.ncpu=ncpu
+        if memory is None:
+            memory=get_physical_memory()
+        self.memory=memory
+        self.steps=[]
+
+    def add(self,name,function,args=(),kwargs=None,inputs=None,outputs=None,ncpu=1,memory=0):
+        for s in self.steps:
+            if s.name==name:
+                raise RuntimeError('Step %s added twice' % name)
+        step=Step(name,function,args=args,kwargs=kwargs,inputs=inputs,outputs=outputs,ncpu=ncpu,memory=memory)
+        self.steps.append(step)
+        return step
+
+    def resolve(self):
+        producers={}
+        for s in self.steps:
+            for f in s.outputs:
+                if f in producers:
+                    raise RuntimeError('File %s is written by both step %s and step %s' % (f,producers[f].name,s.name))
+                producers[f]=s
+        for s in self.steps:
+            s.depends=[]
+            for f in s.inputs:
+                p=producers.get(f)
+                if p is not None and p is not s and p not in s.depends:
+                    s.depends.append(p)
+        # check for cycles by repeatedly removing steps whose
+        # dependencies have all been removed
+        remaining=list(self.steps)
+        while remaining:
+            free=[s for s in remaining if not any(d in remaining for d in s.depends)]
+            if not free:
+                raise RuntimeError('Dependency cycle between steps '+', '.join(s.name for s in remaining))
+            remaining=[s for s in remaining if s not in free]
+
+    def run(self):
+        self.resolve()
+        condition=threading.Condition()
+        pending=list(self.steps)
+        running=[]
+        completed=[]
+        failed=None
+        freecpu=self.ncpu
+        freemem=self.memory
+        with condition:
+            while pending or running:
+                for s in [s for s in running if s.finished]:
+                    running.remove(s)
+                    freecpu+=min(s.ncpu,self.ncpu)
+                    freemem+=min(s.memory,self.memory)
+                    if s.exc_info is not None:
+                        warn('Step '+s.name+' failed')
+                        if failed is None:
+                            failed=s
+                    else:
+                        report('Step '+s.name+' finished')
+                        completed.append(s)
+                if failed is not None:
+                    # don't start anything new, let the running steps finish
+                    pending=[]
+                # start ready steps in the order they were added while they fit
+                for s in list(pending):
+                    if not all(d in completed for d in s.depends):
+                        continue
+                    ncpu=min(s.ncpu,self.ncpu)
+                    memory=min(s.memory,self.memory)
+                    if running and (ncpu>freecpu or memory>freemem):
+                        continue
+                    freecpu-=ncpu
+                    freemem-=memory
+                    pending.remove(s)
+                    running.append(s)
+                    report('Starting step %s with %i CPUs (%i steps running)' % (s.name,ncpu,len(running)))
+                    thread=threading.Thread(target=s.execute,args=(condition,),name=s.name)
+                    thread.daemon=True
+                    thread.start()
+                if running and not any(s.finished for s in running):
+                    # timeout keeps the main thread responsive to signals
+                    condition.wait(10)
+        if failed is not None:
+            raise failed.exc_info[0],failed.exc_info[1],failed.exc_info[2]
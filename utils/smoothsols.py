@@ -4,7 +4,7 @@ import optparse
 import pickle
 import numpy as np
 import os
-from itertools import product as ItP
+from solfiles import SolutionsFile
 #from DDFacet.Other import MyLogger
 #log=MyLogger.getLogger("ClassSmooth")
 
@@ -18,8 +18,10 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     approaches, such as moving averages techniques.
     Parameters
     ----------
-    y : array_like, shape (N,)
-        the values of the time history of the signal.
+    y : array_like, shape (N,) or (N,...)
+        the values of the time history of the signal. If y has more
+        than one dimension each series along the first axis is
+        smoothed independently.
     window_size : int
         the length of the window. Must be an odd integer number.
     order : int
@@ -29,7 +31,7 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
         the order of the derivative to compute (default = 0 means only smoothing)
     Returns
     -------
-    ys : ndarray, shape (N)
+    ys : ndarray, shape (N) or (N,...)
         the smoothed signal (or it's n-th derivative).
     Notes
     -----
@@ -80,7 +82,14 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
     lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
     y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve( m[::-1], y, mode='valid')
+    if y.ndim==1:
+        return np.convolve( m[::-1], y, mode='valid')
+    # same as the convolution above, applied to all the series at once
+    n=y.shape[0]-window_size+1
+    ys=np.zeros((n,)+y.shape[1:])
+    for i in range(window_size):
+        ys+=m[i]*y[i:i+n]
+    return ys
 
     
 def read_options():
@@ -107,22 +116,13 @@ def read_options():
 
 
 def NormMatrices(G):
-    nt,nch,na,_,_=G.shape
-
-    for iChan,it in ItP(range(nch),range(nt)):
-        Gt=G[it,iChan,:,:]
-        u,s,v=np.linalg.svd(Gt[0])
-        # #J0/=np.linalg.det(J0)
-        # J0=Gt[0]
-        # JJ=np.dot(J0.T.conj(),J0)
-        # sqJJ=ModLinAlg.sqrtSVD(JJ)
-        # sqJJinv=ModLinAlg.invSVD(JJ)
-        # U=np.dot(J0,sqJJinv)
-        U=np.dot(u,v)
-        for iAnt in range(0,na):
-            Gt[iAnt,:,:]=np.dot(U.T.conj(),Gt[iAnt,:,:])
-            #Gt[iAnt,:,:]=np.dot(np.dot(u,Gt[iAnt,:,:]),v.T.conj())
-            #Gt[iAnt,:,:]=np.dot(Gt[iAnt,:,:],J0)
+    # G has shape (nt,nch,na,...,2,2), where any axes after the
+    # antenna axis (e.g. directions) are normalised independently.
+    # For each time and channel the unitary part U of the Jones matrix
+    # of the first antenna is removed from all the antennas, G -> U^H G
+    u,s,v=np.linalg.svd(G[:,:,0])
+    U=np.einsum('...ij,...jk->...ik',u,v)
+    G[:]=np.einsum('tc...ji,tca...jk->tca...ik',U.conj(),G)
     return G
 
 
@@ -133,7 +133,7 @@ class ClassSmooth():
         self.FileName="/".join([os.path.abspath(MSName),SolsName])
         self.OutName=OutName
         print "Smoothing from %s"%self.FileName
-        self.DicoFile=dict(np.load(self.FileName))
+        self.DicoFile=SolutionsFile(self.FileName)
         self.Sols=self.DicoFile["Sols"]
         self.Sols=self.Sols.view(np.recarray)
         self.WSize=WSize
@@ -144,10 +144,7 @@ class ClassSmooth():
 
     def NormAllDirs(self):
         print "  Normalising Jones matrices ...."
-        nt,nch,na,nd,_,_=self.Sols.G.shape
-        for iDir in range(nd):
-            G=self.Sols.G[:,:,:,iDir,:,:]
-            self.Sols.G[:,:,:,iDir,:,:]=NormMatrices(G)
+        self.Sols.G=NormMatrices(self.Sols.G)
 
     def Smooth(self):
         Sols0=self.Sols
@@ -167,17 +164,12 @@ class ClassSmooth():
 #        Sols1.tm=Sols0.tm
 
         print "  Smoothing"
+        # smooth the amplitudes of all directions, antennas and
+        # polarisations along the time axis, keeping the phases
+        G1[:]=savitzky_golay(np.abs(G0[:,0]), self.WSize, self.Order)
+        G1*=np.exp(1j*np.angle(G0[:,0]))
         for iDir in range(nd):
             for iAnt in range(na):
-                for ipol in Pols:
-                    # Amplitude
-                    yp=np.abs(G0[:,0,iAnt,iDir,ipol])
-                    # Do some smoothing on the amps
-                    yp = np.copy(savitzky_golay(yp, self.WSize, self.Order))
-                    G1[:,iAnt,iDir,ipol]=yp[:]
-                    # Phase
-                    yp=np.angle(G0[:,0,iAnt,iDir,ipol])
-                    G1[:,iAnt,iDir,ipol]*=np.exp(1j*yp[:])
                 if self.doplot:
                     import matplotlib.pyplot as plt
                     xp=(Sols0.t0+Sols0.t1)/2.
@@ -212,7 +204,7 @@ class ClassSmooth():
             Name=".".join(FileName.split(".")[1:-2])
             OutName="%skillMS.%s.Smooth.sols.npz"%(Path,Name)
         print "  Saving smoothed solutions in: %s"%OutName
-        np.savez(OutName,**self.DicoFile)
+        self.DicoFile.save(OutName)
 
         
 def test():
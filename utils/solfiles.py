@@ -0,0 +1,161 @@
+# Access to killMS solution files (npz archives) without loading them
+# whole. Members are read only when asked for, and members stored
+# uncompressed (as np.savez writes them) are memory-mapped rather than
+# read. A small JSON index is kept next to each solution file giving
+# its time range, number of directions and solution shape, so that
+# e.g. grouping solutions by start time doesn't need to read any data.
+
+import os
+import json
+import struct
+import zipfile
+import numpy as np
+
+index_suffix='.index.json'
+
+class SolutionsFile(object):
+    """
+    Dictionary-like view of an npz file. Values assigned to keys
+    replace the file contents for those keys, so a modified set of
+    solutions can be written out with save()
+    """
+    def __init__(self,filename,mode='c'):
+        # mode is the memmap mode: 'c' (copy-on-write) allows members
+        # to be modified in memory without touching the file
+        self.filename=filename
+        self.mode=mode
+        self.zf=zipfile.ZipFile(filename)
+        self.members={}
+        for info in self.zf.infolist():
+            name=info.filename
+            if name.endswith('.npy'):
+                name=name[:-4]
+            self.members[name]=info
+        self.loaded={}
+
+    def keys(self):
+        return self.members.keys()
+
+    def __contains__(self,key):
+        return key in self.members
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __getitem__(self,key):
+        if key not in self.loaded:
+            self.loaded[key]=self.read_member(key)
+        return self.loaded[key]
+
+    def __setitem__(self,key,value):
+        self.loaded[key]=value
+        if key not in self.members:
+            self.members[key]=None
+
+    def data_offset(self,info):
+        # start of the member data: the local header is 30 bytes
+        # followed by the name and the extra field
+        with open(self.filename,'rb') as f:
+            f.seek(info.header_offset)
+            header=f.read(30)
+        namelen,extralen=struct.unpack('<HH',header[26:30])
+        return info.header_offset+30+namelen+extralen
+
+    def read_header(self,key):
+        """
+        Return the shape, Fortran order flag, dtype and file offset of
+        the array data for a member; the offset is None if the member
+        is compressed
+        """
+        info=self.members[key]
+        if info.compress_type==zipfile.ZIP_STORED:
+            f=open(self.filename,'rb')
+            f.seek(self.data_offset(info))
+        else:
+            f=self.zf.open(info)
+        try:
+            version=np.lib.format.read_magic(f)
+            if version==(1,0):
+                shape,fortran,dtype=np.lib.format.read_array_header_1_0(f)
+            else:
+                shape,fortran,dtype=np.lib.format.read_array_header_2_0(f)
+            if info.compress_type==zipfile.ZIP_STORED:
+                offset=f.tell()
+            else:
+                offset=None
+        finally:
+            f.close()
+        return shape,fortran,dtype,offset
+
+    def read_member(self,key):
+        info=self.members[key]
+        shape,fortran,dtype,offset=self.read_header(key)
+        if offset is None or dtype.hasobject or len(shape)==0 or 0 in shape:
+            f=self.zf.open(info)
+            try:
+                return np.lib.format.read_array(f)
+            finally:
+                f.close()
+        return np.memmap(self.filename,dtype=dtype,mode=self.mode,offset=offset,
+                         shape=shape,order='F' if fortran else 'C')
+
+    def save(self,filename):
+        np.savez(filename,**dict((k,self[k]) for k in self.keys()))
+
+    def close(self):
+        self.zf.close()
+
+def index_filename(sols):
+    # keep the index with the real file rather than with a symlink to it
+    return os.path.realpath(sols)+index_suffix
+
+def make_index(sols):
+    s=SolutionsFile(sols)
+    try:
+        st=os.stat(sols)
+        index={'size':st.st_size,'mtime':st.st_mtime}
+        t=s['BeamTimes']
+        index['t0']=float(np.min(t))
+        index['t1']=float(np.max(t))
+        if 'Sols' in s:
+            shape,fortran,dtype,offset=s.read_header('Sols')
+            gshape=dtype['G'].shape
+            index['nt']=shape[0]
+            index['shape']=list(gshape)
+            index['ndir']=gshape[2]
+        elif 'ClusterCat' in s:
+            index['ndir']=s.read_header('ClusterCat')[0][0]
+        index['members']=sorted(s.keys())
+    finally:
+        s.close()
+    return index
+
+def solutions_index(sols):
+    """
+    Return the index for a solution file, rebuilding it if the file
+    has changed since it was written
+    """
+    st=os.stat(sols)
+    filename=index_filename(sols)
+    if os.path.isfile(filename):
+        try:
+            with open(filename) as f:
+                index=json.load(f)
+        except ValueError:
+            index=None
+        if index is not None and index['size']==st.st_size and index['mtime']==st.st_mtime:
+            return index
+    index=make_index(sols)
+    try:
+        tmpname=filename+'.tmp.%i' % os.getpid()
+        with open(tmpname,'w') as f:
+            json.dump(index,f,sort_keys=True)
+        os.rename(tmpname,filename)
+    except (IOError,OSError):
+        # e.g. read-only solutions directory: just don't cache
+        pass
+    return index
+
+def get_solutions_timerange(sols):
+    index=solutions_index(sols)
+    return index['t0'],index['t1']
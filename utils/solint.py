@@ -0,0 +1,138 @@
+# Choice of solution intervals for the DI self-calibration steps from
+# the signal-to-noise of the data. The statistics are estimated from
+# evenly spaced blocks of rows rather than from the whole MS, which
+# gives the same intervals at a small fraction of the I/O.
+
+import numpy as np
+import pyrap.tables as pt
+from auxcodes import warn
+
+def ms_statistics(msname,DataCol="DATA",blockrows=10000,maxblocks=50):
+    """
+    Return the number of channels, the integration time, the mean
+    amplitude of unflagged XX and the standard deviation of unflagged
+    XY/YX visibilities, reading at most maxblocks blocks of blockrows
+    rows spread evenly through the MS
+    """
+    t=pt.table(msname,ack=False)
+    nrows=t.nrows()
+    dt_bin_sec=t.getcol("INTERVAL",0,1,1)[0]
+    nblocks=int(np.ceil(nrows/float(blockrows)))
+    if nblocks<=maxblocks:
+        starts=range(0,nrows,blockrows)
+    else:
+        starts=np.linspace(0,nrows-blockrows,maxblocks).astype(int)
+    # running sums for the cross-hand std and the XX mean amplitude
+    n=0
+    s=0j
+    s2=0.0
+    na=0
+    sa=0.0
+    for start in starts:
+        nr=min(blockrows,nrows-start)
+        d=t.getcol(DataCol,start,nr)
+        f=t.getcol("FLAG",start,nr)
+        dps=d[:,:,1:3][f[:,:,1:3]==0]
+        n+=dps.size
+        s+=np.sum(dps,dtype=np.complex128)
+        s2+=np.sum(dps.real.astype(np.float64)**2+dps.imag.astype(np.float64)**2)
+        da=np.abs(d[:,:,0][f[:,:,0]==0])
+        na+=da.size
+        sa+=np.sum(da,dtype=np.float64)
+    _,nch,_=d.shape
+    t.close()
+    S=np.sqrt(s2/n-np.abs(s/n)**2)
+    M=sa/na
+    return nch,dt_bin_sec,M,S
+
+def solution_intervals(nch,M,S,T=10.):
+    # time and channel steps giving a signal-to-noise of T
+    nb=T**2/(M/S)**2
+
+    # find the size of the channel step
+    nch_step=int(round(np.sqrt(nb)))
+    nch_step=np.max([1,nch_step])
+    nch_step=np.min([nch,nch_step])
+    warn('nch_step=%i'%(nch_step))
+
+    # find the step to have equal interval size
+    #nch_bin=int(nch/nch_step)+1
+    #nch_step=int(nch/float(nch_bin))
+    lDiv=np.array([i for i in range(1,nch+1) if nch%i==0])
+    inch=np.argmin(np.abs(lDiv-nch_step))
+    nch_step=lDiv[inch]
+    nch_step=np.max([1,nch_step])
+    nch_step=np.min([nch,nch_step])
+
+    nt_step=int(round(nb/float(nch_step)))
+    nt_step=np.max([1,nt_step])
+    return nt_step,nch_step
+
+def give_dt_dnu(msname,DataCol="DATA",ModelCol="DI_PREDICT",T=10.,blockrows=10000,maxblocks=50):
+    # ModelCol is not needed for the estimate but is kept for the
+    # existing callers
+    nch,dt_bin_sec,M,S=ms_statistics(msname,DataCol=DataCol,blockrows=blockrows,maxblocks=maxblocks)
+    nt_step,nch_step=solution_intervals(nch,M,S,T=T)
+
+    SNR=np.sqrt(nt_step*nch_step)*M/S
+    warn('Using (dt,df)=(%i,%i) for self-cal run of %s with (<|model|>,std)=(%.2f,%.2f) giving SNR=%.2f'%(nt_step,nch_step,msname,M,S,SNR))
+
+    return nt_step, nt_step*dt_bin_sec/60.0, nch_step, nch/nch_step
+
+def full_statistics(msname,DataCol="DATA"):
+    # the original whole-column estimate, kept for comparison
+    t=pt.table(msname,ack=False)
+    d=t.getcol(DataCol)
+    f=t.getcol("FLAG")
+    t.close()
+    fp=f[:,:,np.array([1,2])]
+    dp=d[:,:,np.array([1,2])]
+    dps=dp[fp==0]
+    da=np.abs(d[:,:,0][f[:,:,0]==0])
+    return np.mean(da),np.std(dps)
+
+def make_test_ms(msname,ntimes=600,nbl=1830,nch=16,signal=3.0,flagfrac=0.1):
+    # a table with just the columns give_dt_dnu reads
+    desc=pt.maketabdesc([pt.makearrcoldesc('DATA',0j,shape=[nch,4],valuetype='complex'),
+                         pt.makearrcoldesc('FLAG',False,shape=[nch,4]),
+                         pt.makescacoldesc('INTERVAL',0.0)])
+    t=pt.table(msname,desc,nrow=ntimes*nbl,readonly=False,ack=False)
+    t.putcol('INTERVAL',np.ones(ntimes*nbl)*8.0)
+    for i in range(ntimes):
+        d=(np.random.normal(size=(nbl,nch,4))+1j*np.random.normal(size=(nbl,nch,4))).astype(np.complex64)
+        d[:,:,0]+=signal
+        d[:,:,3]+=signal
+        t.putcol('DATA',d,i*nbl,nbl)
+        t.putcol('FLAG',np.random.uniform(size=(nbl,nch,4))<flagfrac,i*nbl,nbl)
+    t.close()
+
+if __name__=='__main__':
+    # Benchmark the sampled estimate against the full-column one on a
+    # real or synthetic MS, e.g.
+    # python solint.py --ntimes 1200 --nch 20 solint-test.ms
+    import argparse
+    import os
+    import time
+    parser=argparse.ArgumentParser(description='Compare the sampled and full-column estimates of the DI solution intervals')
+    parser.add_argument('msname',nargs='?',default='solint-test.ms',help='MS to use; a synthetic one is made if it does not exist')
+    parser.add_argument('--ntimes',type=int,default=600,help='Number of time steps in a synthetic MS')
+    parser.add_argument('--nbl',type=int,default=1830,help='Number of baselines in a synthetic MS')
+    parser.add_argument('--nch',type=int,default=16,help='Number of channels in a synthetic MS')
+    args=parser.parse_args()
+    msname=args.msname
+    if not os.path.isdir(msname):
+        print 'Making synthetic MS %s with %i rows and %i channels' % (msname,args.ntimes*args.nbl,args.nch)
+        np.random.seed(1)
+        make_test_ms(msname,ntimes=args.ntimes,nbl=args.nbl,nch=args.nch)
+    os.system('sync')
+    # the sampled read goes first, so that any caching can only help
+    # the full one
+    t0=time.time()
+    nch,dt_bin_sec,Ms,Ss=ms_statistics(msname)
+    t1=time.time()
+    M,S=full_statistics(msname)
+    t2=time.time()
+    print 'Sampled read: <|XX|>=%.4f std=%.4f in %.2f s' % (Ms,Ss,t1-t0)
+    print 'Full read:    <|XX|>=%.4f std=%.4f in %.2f s' % (M,S,t2-t1)
+    print 'Speedup %.1f, fractional differences %.2g %.2g' % ((t2-t1)/(t1-t0),Ms/M-1,Ss/S-1)
+    print 'Intervals (dt,df) from sampled read: %i,%i, from full read: %i,%i' % (solution_intervals(nch,Ms,Ss)+solution_intervals(nch,M,S))